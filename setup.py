@@ -11,6 +11,7 @@ setup(
             'stream-proxy = securestream_endpoint.proxy:proxy_main',
             'stream-controller = securestream_controller.app:controller_main',
             'stream-rsagen = securestream_endpoint.rsa:rsagen_main',
+            'stream-bench = securestream_endpoint.bench:bench_main',
         ],
     },
     name='securestream',
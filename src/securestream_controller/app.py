@@ -2,9 +2,12 @@
 Basic flask application.
 """
 
+import json
+import math
 import os
+import threading
 from argparse import ArgumentParser
-from flask import Flask, request, redirect, render_template, make_response
+from flask import Flask, request, redirect, render_template, make_response, Response
 from flask import request, jsonify
 
 ROOT_PATH = os.path.dirname(os.path.realpath(__file__))
@@ -17,31 +20,105 @@ def home_page():
     return render_template("index.html")
 
 
-sc_drop = 0
-cs_drop = 0
-recv_delay = 0
+# Proxy impairments, applied in each direction under the direction's prefix; see Impairment for their units
+IMPAIRMENTS = {
+    "drop": 0,
+    "delay": 0,
+    "jitter": 0,
+    "bandwidth": 0,
+    "reorder": 0,
+    "duplicate": 0,
+    "burst_enter": 0,
+    "burst_exit": 100,
+    "burst_drop": 100,
+}
+
+# Percentages; the other impairments (milliseconds, or kilobytes per second for bandwidth) have no upper bound
+PERCENTAGES = {"drop", "reorder", "duplicate", "burst_enter", "burst_exit", "burst_drop"}
+
+config = {
+    **{f"client_server_{key}": value for key, value in IMPAIRMENTS.items()},
+    **{f"server_client_{key}": value for key, value in IMPAIRMENTS.items()},
+    "recv_delay": 0,
+}
+
+# Incremented on every configuration change; subscribers of /config/stream are woken through config_changed
+config_version = 0
+config_changed = threading.Condition()
+
+# Interval at which an idle /config/stream sends a comment, so subscribers can detect a dead connection
+CONFIG_KEEPALIVE = 15
+
+
+def config_limit(key: str) -> float:
+    """
+    Largest value the configuration key accepts; every key accepts values from 0.
+    """
+    if any(key.endswith(f"_{name}") for name in PERCENTAGES):
+        return 100
+
+    return math.inf
 
 
 @app.route("/config", methods=["POST"])
 def apply_config():
-    global sc_drop, cs_drop, recv_delay
-    content = request.json
-    cs_drop = content["client_server_drop"]
-    sc_drop = content["server_client_drop"]
-    recv_delay = content["recv_delay"]
+    """
+    Updates the configuration keys present in the request; the others keep their values. Each value must be a
+    number within the range of its key.
+    """
+    global config_version
+    content = request.get_json(silent=True)
+
+    if not isinstance(content, dict):
+        return "Expected a JSON object of configuration keys", 400
+
+    unknown = [key for key in content if key not in config]
+
+    if unknown:
+        return f"Unknown configuration keys: {', '.join(unknown)}", 400
+
+    invalid = [key for key, value in content.items()
+               if isinstance(value, bool) or not isinstance(value, (int, float)) or not math.isfinite(value)
+               or not 0 <= value <= config_limit(key)]
+
+    if invalid:
+        return f"Invalid configuration values: {', '.join(invalid)}", 400
+
+    with config_changed:
+        config.update(content)
+        config_version += 1
+        config_changed.notify_all()
 
     return ""
 
 
 @app.route("/config", methods=["GET"])
 def get_config():
-    global sc_drop, cs_drop, recv_delay
+    return dict(config)
 
-    return {
-        "client_server_drop": cs_drop,
-        "server_client_drop": sc_drop,
-        "recv_delay": recv_delay,
-    }
+
+@app.route("/config/stream", methods=["GET"])
+def stream_config():
+    """
+    Server-Sent Events stream of the configuration. The current configuration is sent when a subscriber
+    connects and again whenever it changes, with its version as the event id.
+    """
+    def events():
+        version = None
+
+        while True:
+            with config_changed:
+                config_changed.wait_for(lambda: config_version != version, timeout=CONFIG_KEEPALIVE)
+                changed = config_version != version
+                version = config_version
+                current = get_config()
+
+            if changed:
+                yield f"id: {version}\ndata: {json.dumps({'version': version, 'config': current})}\n\n"
+            else:
+                yield ": keepalive\n\n"
+
+    return Response(events(), mimetype="text/event-stream", headers={"Cache-Control": "no-cache"})
 
 
 statistics = {
@@ -93,7 +170,8 @@ def controller_main():
 
     args = parser.parse_args()
 
-    app.run(port=args.port)
+    # Each /config/stream subscriber holds a request thread for as long as it is connected
+    app.run(port=args.port, threaded=True)
 
 
 if __name__ == "__main__":
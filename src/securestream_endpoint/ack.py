@@ -0,0 +1,26 @@
+class AckPolicy:
+    """
+    Decides when received data is acknowledged. In-order segments are acknowledged once 'segments' of them
+    are unacknowledged, or 'delay' seconds after the first of them arrived, so one ack covers several
+    segments. Out of order and duplicate segments are always acknowledged immediately, so loss is reported
+    without delay, as are the first 'quick' segments of a stream, while remote's window is still too small
+    to fill a batch. 'delay' is in seconds; 'segments' and 'quick' are counts of segments.
+    """
+    SEGMENTS = 2
+    DELAY = 0.02
+    QUICK = 16
+
+    def __init__(self, segments: int = SEGMENTS, delay: float = DELAY, quick: int = QUICK):
+        if segments < 1:
+            raise ValueError("An ack must be sent at least every segment")
+
+        self.segments = segments
+        self.delay = delay
+        self.quick = quick
+
+    @staticmethod
+    def immediate() -> 'AckPolicy':
+        """
+        Acknowledges received segments as soon as they are processed, without waiting for more to arrive.
+        """
+        return AckPolicy(1, 0.0, 0)
@@ -0,0 +1,249 @@
+import asyncio
+import math
+import queue
+from collections import deque
+from queue import Empty
+from typing import Optional, Callable, Deque, List
+
+from .ack import AckPolicy
+from .congestion import CongestionControl
+from .stream import PacketMutator, NoOpPacketMutator, StreamEngine, Stream, fit_segment_size
+from .subsystem import Subsystem, SubsystemClosedException, Packet
+
+
+class AsyncSubsystem(Subsystem):
+    """
+    Base for subsystems driven by an asyncio event loop. Packets parsed by the transport protocol are buffered
+    until the owning AsyncStream collects them, and the stream is woken through a listener callback.
+    """
+
+    def __init__(self):
+        self.received: Deque[Packet] = deque()
+        self.closed = False
+        self.writable = True
+        self.listener: Optional[Callable[[], None]] = None
+
+    def set_listener(self, listener: Callable[[], None]):
+        self.listener = listener
+
+    def notify(self):
+        if self.listener:
+            self.listener()
+
+    def packet_received(self, packet: Packet):
+        self.received.append(packet)
+        self.notify()
+
+    def recv(self, timeout: float = 0) -> Optional[Packet]:
+        if self.received:
+            return self.received.popleft()
+
+        if self.closed:
+            raise SubsystemClosedException()
+
+        return None
+
+    def recv_many(self, timeout: float = 0) -> List[Packet]:
+        if not self.received and self.closed:
+            raise SubsystemClosedException()
+
+        packets = list(self.received)
+        self.received.clear()
+
+        return packets
+
+    def get_dataseg_limit(self) -> int:
+        return 1024 * 2
+
+    def is_closed(self) -> bool:
+        return self.closed
+
+    # asyncio flow control; stop queueing new segments while the transport's write buffer is full
+    def pause_writing(self):
+        self.writable = False
+
+    def resume_writing(self):
+        self.writable = True
+        self.notify()
+
+    def connection_lost(self, exc: Optional[Exception]):
+        self.closed = True
+        self.notify()
+
+
+class AsyncStream(object):
+    """
+    Stream implemented on an asyncio event loop rather than a worker thread. Must be created from a coroutine
+    running on the loop which owns the subsystem.
+    """
+    SEND_BUFFER_SEGMENTS = 10
+
+    def __init__(self, subsystem: AsyncSubsystem, *, recv_filter: Optional[PacketMutator] = None,
+                 transmit_filter: Optional[PacketMutator] = None, sack: bool = True,
+                 congestion_control: Optional[CongestionControl] = None,
+                 recv_buffer_segments: int = Stream.RECV_BUFFER_SEGMENTS, header_version: int = Packet.V2,
+                 ack_policy: Optional[AckPolicy] = None, segment_size: Optional[int] = None):
+        # The engine only ever touches these from the event loop, so they never block
+        self.data_in = queue.Queue(maxsize=AsyncStream.SEND_BUFFER_SEGMENTS)
+        self.data_out = queue.Queue(maxsize=recv_buffer_segments)
+        self.subsystem = subsystem
+        self.max_packet_size = fit_segment_size(subsystem.get_dataseg_limit(), transmit_filter) \
+            if segment_size is None else segment_size
+        self.closed = False
+        self.eof = False
+
+        self.engine = StreamEngine(
+            subsystem,
+            self.data_in,
+            self.data_out,
+            NoOpPacketMutator() if recv_filter is None else recv_filter,
+            NoOpPacketMutator() if transmit_filter is None else transmit_filter,
+            sack=sack,
+            congestion_control=congestion_control,
+            header_version=header_version,
+            ack_policy=ack_policy
+        )
+
+        self.wakeup = asyncio.Event()
+        self.readable = asyncio.Event()
+        self.writable = asyncio.Event()
+        self.drained = asyncio.Event()
+
+        subsystem.set_listener(self.wakeup.set)
+        self.task = asyncio.get_running_loop().create_task(self.run())
+
+    def get_preferred_segment_size(self):
+        return self.max_packet_size
+
+    @property
+    def srtt(self) -> Optional[float]:
+        return self.engine.rtt.srtt
+
+    @property
+    def rttvar(self) -> Optional[float]:
+        return self.engine.rtt.rttvar
+
+    @property
+    def rto(self) -> float:
+        return self.engine.rtt.rto
+
+    def update_events(self):
+        for event, state in ((self.readable, self.eof or not self.data_out.empty()),
+                             (self.writable, self.eof or not self.data_in.full()),
+                             (self.drained, self.eof or (self.data_in.empty() and not self.engine.pending))):
+            if state:
+                event.set()
+            else:
+                event.clear()
+
+    async def run(self):
+        loop = asyncio.get_running_loop()
+
+        try:
+            while not self.closed:
+                self.wakeup.clear()
+                self.engine.try_restore_backoff()
+                self.engine.deliver()
+
+                try:
+                    more = self.engine.try_receive()
+                except SubsystemClosedException:
+                    break
+
+                if self.subsystem.writable:
+                    self.engine.try_transmit()
+                else:
+                    # Acks are small enough to queue on the transport even while its buffer is full
+                    self.engine.try_send_ack()
+
+                self.update_events()
+
+                if more:
+                    await asyncio.sleep(0)
+                    continue
+
+                # Sleep until the transport delivers packets, the application reads or writes or a timer expires
+                timeout = self.engine.next_timeout()
+                timer = None if timeout is None else loop.call_later(timeout, self.wakeup.set)
+                await self.wakeup.wait()
+
+                if timer:
+                    timer.cancel()
+        finally:
+            self.eof = True
+            self.update_events()
+
+    def next_segment(self) -> bytes:
+        r = self.data_out.get_nowait()
+
+        # Reading may have made room for segments held back in the receive window
+        if self.engine.recv_window:
+            self.wakeup.set()
+
+        return r
+
+    async def read(self, min_read: int = 0) -> bytes:
+        segments = []
+        size = 0
+
+        while True:
+            try:
+                while True:
+                    r = self.next_segment()
+
+                    # Remote's end of stream marker
+                    if r is None:
+                        self.eof = True
+                        break
+
+                    segments.append(r)
+                    size += len(r)
+            except Empty:
+                pass
+
+            if size >= min_read or self.eof:
+                break
+
+            self.update_events()
+            await self.readable.wait()
+
+        return b''.join(segments)
+
+    async def write(self, data: bytes):
+        segments = math.ceil(len(data) / self.max_packet_size)
+
+        for i in range(segments):
+            # Backpressure; wait for the engine to move queued segments into the send window
+            while self.data_in.full() and not self.eof:
+                self.update_events()
+                await self.writable.wait()
+
+            if self.eof:
+                raise SubsystemClosedException()
+
+            self.data_in.put_nowait(data[i * self.max_packet_size : (i + 1) * self.max_packet_size])
+            self.wakeup.set()
+
+    async def drain(self):
+        """
+        Waits until remote has acknowledged everything written to the stream.
+        """
+        self.update_events()
+        await self.drained.wait()
+
+    def is_open(self):
+        return not self.closed and not (self.eof and self.data_out.empty())
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, type, value, traceback):
+        await self.close()
+
+    async def close(self):
+        if self.closed:
+            return
+
+        self.closed = True
+        self.wakeup.set()
+        await self.task
@@ -0,0 +1,143 @@
+import asyncio
+from typing import Optional, List, Set
+
+from .async_stream import AsyncSubsystem
+from .subsystem import SubsystemClosedException, Packet, FRAME_LENGTH
+
+
+class AsyncTcpSubsystem(AsyncSubsystem, asyncio.Protocol):
+    def __init__(self):
+        AsyncSubsystem.__init__(self)
+        self.transport: Optional[asyncio.Transport] = None
+        self.recv_buffer = bytearray()
+
+        # Packets sent before a server accepted its remote are written once the connection is made
+        self.unsent: List[bytes] = []
+
+    def connection_made(self, transport: asyncio.Transport):
+        self.transport = transport
+
+        for frame in self.unsent:
+            self.transport.write(frame)
+
+        self.unsent = []
+
+    def data_received(self, data: bytes):
+        self.recv_buffer += data
+        offset = 0
+
+        while len(self.recv_buffer) - offset >= FRAME_LENGTH.size:
+            expected = offset + FRAME_LENGTH.size + FRAME_LENGTH.unpack_from(self.recv_buffer, offset)[0]
+
+            if len(self.recv_buffer) < expected:
+                break
+
+            self.packet_received(Packet.load(bytes(memoryview(self.recv_buffer)[offset + FRAME_LENGTH.size:expected])))
+            offset = expected
+
+        del self.recv_buffer[:offset]
+
+    def send(self, packet: Packet):
+        if self.is_closed():
+            raise SubsystemClosedException()
+
+        transmit = packet.save_frame()
+
+        if self.transport is None:
+            self.unsent.append(transmit)
+        else:
+            self.transport.write(transmit)
+
+    def close(self):
+        self.closed = True
+
+        if self.transport:
+            self.transport.close()
+
+
+class TcpRejectProtocol(asyncio.Protocol):
+    def connection_made(self, transport: asyncio.Transport):
+        transport.close()
+
+
+class AsyncTcpClient:
+    def __init__(self, host: str, port: int):
+        self.connection_config = (host, port)
+        self.subsystem: Optional[AsyncTcpSubsystem] = None
+
+    async def __aenter__(self) -> AsyncTcpSubsystem:
+        _, self.subsystem = await asyncio.get_running_loop().create_connection(
+            AsyncTcpSubsystem, *self.connection_config)
+
+        return self.subsystem
+
+    async def __aexit__(self, exc_type, exc_val, exc_tb):
+        if self.subsystem:
+            self.subsystem.close()
+
+
+class AsyncTcpServerSingleRemote:
+    def __init__(self, port: int):
+        self.connection_config = ("0.0.0.0", port)
+        self.subsystem: Optional[AsyncTcpSubsystem] = None
+        self.server: Optional[asyncio.Server] = None
+        self.attached = False
+
+    def create_protocol(self) -> asyncio.Protocol:
+        # Only the first remote is served; the listening socket is closed once it has connected
+        if self.attached:
+            return TcpRejectProtocol()
+
+        # Closing the server while it is still creating this connection would abort it
+        self.attached = True
+        asyncio.get_running_loop().call_soon(self.server.close)
+
+        return self.subsystem
+
+    async def __aenter__(self) -> AsyncTcpSubsystem:
+        self.subsystem = AsyncTcpSubsystem()
+        self.server = await asyncio.get_running_loop().create_server(self.create_protocol, *self.connection_config)
+
+        return self.subsystem
+
+    async def __aexit__(self, exc_type, exc_val, exc_tb):
+        self.subsystem.close()
+        self.server.close()
+
+
+class AsyncTcpServerMulti:
+    """
+    Keeps listening, giving every remote which connects a subsystem of its own. Subsystems are collected with
+    accept in the order their remotes connected; all are served by the event loop, however many there are.
+    """
+
+    def __init__(self, port: int):
+        self.connection_config = ("0.0.0.0", port)
+        self.server: Optional[asyncio.Server] = None
+        self.accepted: Optional[asyncio.Queue] = None
+        self.subsystems: Set[AsyncTcpSubsystem] = set()
+
+    def create_protocol(self) -> asyncio.Protocol:
+        subsystem = AsyncTcpSubsystem()
+
+        # Remembered so they can be closed with the server; those which already closed are forgotten
+        self.subsystems = {s for s in self.subsystems if not s.is_closed()}
+        self.subsystems.add(subsystem)
+        self.accepted.put_nowait(subsystem)
+
+        return subsystem
+
+    async def accept(self) -> AsyncTcpSubsystem:
+        return await self.accepted.get()
+
+    async def __aenter__(self) -> 'AsyncTcpServerMulti':
+        self.accepted = asyncio.Queue()
+        self.server = await asyncio.get_running_loop().create_server(self.create_protocol, *self.connection_config)
+
+        return self
+
+    async def __aexit__(self, exc_type, exc_val, exc_tb):
+        self.server.close()
+
+        for subsystem in self.subsystems:
+            subsystem.close()
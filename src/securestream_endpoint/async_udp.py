@@ -0,0 +1,167 @@
+import asyncio
+import socket
+from typing import Optional, List, Tuple, Dict
+
+from .async_stream import AsyncSubsystem
+from .subsystem import SubsystemClosedException, Packet, FRAME_LENGTH
+
+
+class AsyncUdpSubsystem(AsyncSubsystem, asyncio.DatagramProtocol):
+    def __init__(self, host: Optional[str], port: int):
+        AsyncSubsystem.__init__(self)
+        self.host = host
+        self.port = port
+        self.transport: Optional[asyncio.DatagramTransport] = None
+        self.recv_buffer = bytearray()
+
+        # Packets sent before a server has heard from its remote are written once the address is known
+        self.unsent: List[bytes] = []
+
+    def connection_made(self, transport: asyncio.DatagramTransport):
+        self.transport = transport
+
+    def datagram_received(self, data: bytes, address: Tuple[str, int]):
+        self.host, self.port = address[:2]
+        self.flush_unsent()
+
+        # Framing matches UdpSocketSubsystem, so either implementation can be used on each end
+        self.recv_buffer += data
+        offset = 0
+
+        while len(self.recv_buffer) - offset >= FRAME_LENGTH.size:
+            expected = offset + FRAME_LENGTH.size + FRAME_LENGTH.unpack_from(self.recv_buffer, offset)[0]
+
+            if len(self.recv_buffer) < expected:
+                break
+
+            self.packet_received(Packet.load(bytes(memoryview(self.recv_buffer)[offset + FRAME_LENGTH.size:expected])))
+            offset = expected
+
+        del self.recv_buffer[:offset]
+
+    def error_received(self, exc: Exception):
+        pass
+
+    def flush_unsent(self):
+        for frame in self.unsent:
+            self.transport.sendto(frame, (self.host, self.port))
+
+        self.unsent = []
+
+    def send(self, packet: Packet):
+        if self.is_closed():
+            raise SubsystemClosedException()
+
+        transmit = packet.save_frame()
+
+        if self.host is None:
+            self.unsent.append(transmit)
+        else:
+            self.transport.sendto(transmit, (self.host, self.port))
+
+    def close(self):
+        self.closed = True
+
+        if self.transport:
+            self.transport.close()
+
+
+class AsyncUdpClient:
+    def __init__(self, host: str, port: int):
+        self.host = host
+        self.port = port
+        self.subsystem: Optional[AsyncUdpSubsystem] = None
+
+    async def __aenter__(self) -> AsyncUdpSubsystem:
+        transport, self.subsystem = await asyncio.get_running_loop().create_datagram_endpoint(
+            lambda: AsyncUdpSubsystem(self.host, self.port), family=socket.AF_INET)
+
+        transport.sendto(b'', (self.host, self.port))
+
+        return self.subsystem
+
+    async def __aexit__(self, exc_type, exc_val, exc_tb):
+        if self.subsystem:
+            self.subsystem.close()
+
+
+class AsyncUdpServerSingleRemote:
+    def __init__(self, port: int):
+        self.port = port
+        self.subsystem: Optional[AsyncUdpSubsystem] = None
+
+    async def __aenter__(self) -> AsyncUdpSubsystem:
+        _, self.subsystem = await asyncio.get_running_loop().create_datagram_endpoint(
+            lambda: AsyncUdpSubsystem(None, self.port), local_addr=("0.0.0.0", self.port))
+
+        return self.subsystem
+
+    async def __aexit__(self, exc_type, exc_val, exc_tb):
+        self.subsystem.close()
+
+
+class AsyncUdpPeerSubsystem(AsyncUdpSubsystem):
+    """
+    Subsystem for one remote of an AsyncUdpServerMulti, sending through the server's socket.
+    """
+
+    def __init__(self, server: 'AsyncUdpServerMulti', host: str, port: int):
+        super().__init__(host, port)
+        self.server = server
+
+    def close(self):
+        # The socket is shared with the server's other remotes, so only this remote is forgotten
+        self.closed = True
+        self.server.forget(self)
+        self.notify()
+
+
+class AsyncUdpServerMulti(asyncio.DatagramProtocol):
+    """
+    Serves every remote which sends to the port from a single socket, giving each source address a subsystem
+    of its own. Subsystems are collected with accept in the order their remotes were first heard from.
+    """
+
+    def __init__(self, port: int):
+        self.port = port
+        self.transport: Optional[asyncio.DatagramTransport] = None
+        self.accepted: Optional[asyncio.Queue] = None
+        self.peers: Dict[Tuple[str, int], AsyncUdpPeerSubsystem] = {}
+
+    def connection_made(self, transport: asyncio.DatagramTransport):
+        self.transport = transport
+
+    def datagram_received(self, data: bytes, address: Tuple[str, int]):
+        address = address[:2]
+        peer = self.peers.get(address)
+
+        if peer is None:
+            peer = AsyncUdpPeerSubsystem(self, *address)
+            peer.connection_made(self.transport)
+            self.peers[address] = peer
+            self.accepted.put_nowait(peer)
+
+        peer.datagram_received(data, address)
+
+    def error_received(self, exc: Exception):
+        pass
+
+    def connection_lost(self, exc: Optional[Exception]):
+        for peer in list(self.peers.values()):
+            peer.connection_lost(exc)
+
+    def forget(self, peer: AsyncUdpPeerSubsystem):
+        if self.peers.get((peer.host, peer.port)) is peer:
+            del self.peers[(peer.host, peer.port)]
+
+    async def accept(self) -> AsyncUdpPeerSubsystem:
+        return await self.accepted.get()
+
+    async def __aenter__(self) -> 'AsyncUdpServerMulti':
+        self.accepted = asyncio.Queue()
+        await asyncio.get_running_loop().create_datagram_endpoint(lambda: self, local_addr=("0.0.0.0", self.port))
+
+        return self
+
+    async def __aexit__(self, exc_type, exc_val, exc_tb):
+        self.transport.close()
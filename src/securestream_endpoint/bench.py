@@ -0,0 +1,550 @@
+import itertools
+import json
+import platform
+import socket
+import sys
+import threading
+import time
+from argparse import ArgumentParser
+from collections import deque
+from queue import Queue
+from typing import Optional, Deque, Dict, Iterable, Tuple, List
+
+from .congestion import CongestionControl, CONGESTION_CONTROLS, create_congestion_control
+from .crypto import CrtRsaCryptor, RsaCryptor, BlockRsaEncryptor, BlockRsaDecryptor, SessionEncryptor, \
+    SessionDecryptor
+from .parallel import ParallelMutatorSubsystem
+from .rsa import rsa_gen_key
+from .stream import StreamEngine, NoOpPacketMutator, PacketMutator, CompositeMutator, RandomDropMutator, Stream
+from .subsystem import Subsystem, Packet
+from .tcp import TcpClient, TcpServerSingleRemote
+from .udp import UdpClient, UdpServerSingleRemote
+
+"""
+Benchmarks for the stream protocol. Run with stream-bench <benchmark>, or python -m securestream_endpoint.bench
+"""
+
+
+class LoopbackSubsystem(Subsystem):
+    """
+    In-memory subsystem which delivers packets directly to its peer, so protocol overhead can be
+    measured without sockets.
+    """
+
+    def __init__(self):
+        self.inbox: Deque[Packet] = deque()
+        self.peer: Optional['LoopbackSubsystem'] = None
+
+    @staticmethod
+    def pair() -> Tuple['LoopbackSubsystem', 'LoopbackSubsystem']:
+        a = LoopbackSubsystem()
+        b = LoopbackSubsystem()
+        a.peer = b
+        b.peer = a
+
+        return a, b
+
+    def send(self, packet: Packet):
+        self.peer.inbox.append(packet)
+
+    def recv(self, timeout: float = 0) -> Optional[Packet]:
+        return self.inbox.popleft() if self.inbox else None
+
+    def get_dataseg_limit(self) -> int:
+        return 1024 * 2
+
+    def is_closed(self) -> bool:
+        return False
+
+
+class FixedWindow(CongestionControl):
+    def __init__(self, window: int):
+        super().__init__(window, window)
+
+
+def drain_receive(engine: StreamEngine):
+    while engine.try_receive():
+        pass
+
+
+def window_microbenchmark(window: int, packets: int) -> float:
+    """
+    Transfers 'packets' segments between two engines over a loopback subsystem with the send window held
+    at 'window' segments. Returns the mean protocol cost per segment in microseconds.
+    """
+    a, b = LoopbackSubsystem.pair()
+    noop = NoOpPacketMutator()
+
+    sender = StreamEngine(a, Queue(), Queue(maxsize=window), noop, noop,
+                          congestion_control=FixedWindow(window))
+    receiver = StreamEngine(b, Queue(), Queue(maxsize=window * 2), noop, noop)
+
+    payload = bytes(64)
+    for _ in range(packets):
+        sender.data_in.put_nowait(payload)
+
+    received = 0
+    start = time.perf_counter()
+
+    while received < packets:
+        sender.try_transmit()
+        drain_receive(receiver)
+        receiver.try_transmit()
+
+        while not receiver.data_out.empty():
+            receiver.data_out.get_nowait()
+            received += 1
+
+        drain_receive(sender)
+
+    return (time.perf_counter() - start) / packets * 1e6
+
+
+def run_window_benchmark(windows: Iterable[int], packets: int) -> Dict[int, float]:
+    results = {}
+
+    print(f"{'window':>8} {'us/segment':>12}")
+
+    for window in windows:
+        results[window] = window_microbenchmark(window, packets)
+        print(f"{window:>8} {results[window]:>12.2f}")
+
+    return results
+
+
+def crypto_microbenchmark(workers: int, packets: int, cryptor: CrtRsaCryptor) -> float:
+    """
+    Encrypts 'packets' packets with the private key, inline on this thread when workers is 0 or otherwise with
+    a ParallelMutatorSubsystem of that many processes. Returns the packets encrypted per second.
+    """
+    a, b = LoopbackSubsystem.pair()
+
+    # Small enough that the packet is a number below the modulus
+    packet = Packet(0, 0, 0, bytes(range(32)))
+
+    if workers == 0:
+        start = time.perf_counter()
+
+        for _ in range(packets):
+            a.send(cryptor(packet))
+
+        return packets / (time.perf_counter() - start)
+
+    with ParallelMutatorSubsystem(a, cryptor, workers) as pipeline:
+        # Wait for the processes to start, so only steady state is measured
+        pipeline.send(packet)
+        while not b.inbox:
+            time.sleep(0.001)
+
+        start = time.perf_counter()
+
+        for _ in range(packets):
+            pipeline.send(packet)
+
+        while len(b.inbox) < packets + 1:
+            time.sleep(0.001)
+
+        return packets / (time.perf_counter() - start)
+
+
+def run_crypto_benchmark(workers: Iterable[int], packets: int) -> Dict[int, float]:
+    _, private = rsa_gen_key()
+    cryptor = CrtRsaCryptor(private["k"], private["n"], private["p"], private["q"], private["dP"], private["dQ"],
+                            private["qInv"])
+    results = {}
+
+    print(f"{'workers':>8} {'packets/s':>12} {'speedup':>8}")
+
+    for count in workers:
+        results[count] = crypto_microbenchmark(count, packets, cryptor)
+        print(f"{count:>8} {results[count]:>12.0f} {results[count] / results[min(results)]:>8.2f}")
+
+    return results
+
+
+def run_keygen_benchmark(sizes: Iterable[int], workers: int, runs: int) -> Dict[int, float]:
+    """
+    Times rsa_gen_key for each modulus size. Prime search is random, so each size is averaged over 'runs' keys.
+    """
+    results = {}
+
+    print(f"{'bits':>8} {'mean s':>8} {'max s':>8}")
+
+    for bits in sizes:
+        times = []
+
+        for _ in range(runs):
+            start = time.perf_counter()
+            rsa_gen_key(bits, workers)
+            times.append(time.perf_counter() - start)
+
+        results[bits] = sum(times) / runs
+        print(f"{bits:>8} {results[bits]:>8.2f} {max(times):>8.2f}")
+
+    return results
+
+
+class DataPacketCounter(PacketMutator):
+    """
+    Counts the data packets passing through, first transmissions and retransmissions alike.
+    """
+
+    def __init__(self):
+        self.count = 0
+
+    def __call__(self, packet: Packet):
+        if not packet.is_ack():
+            self.count += 1
+
+        return packet
+
+
+def free_port(kind: int) -> int:
+    """
+    Returns a loopback port of the socket kind which no socket is bound to.
+    """
+    with socket.socket(socket.AF_INET, kind) as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def percentile(values: List[float], fraction: float) -> Optional[float]:
+    if not values:
+        return None
+
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+
+def create_cryptors(crypto: str, keys: Optional[Tuple[Dict, Dict]]) -> Tuple[Optional[PacketMutator],
+                                                                            Optional[PacketMutator]]:
+    """
+    Returns an encryptor and the matching decryptor for the crypto mode, each end encrypting with the private key
+    of keys and decrypting with the public key.
+    """
+    if crypto == "off":
+        return None, None
+
+    public, private = keys
+
+    if crypto == "session":
+        return SessionEncryptor(private["k"], private["n"]), SessionDecryptor(public["k"], public["n"])
+
+    return BlockRsaEncryptor(RsaCryptor(private["k"], private["n"])), \
+        BlockRsaDecryptor(RsaCryptor(public["k"], public["n"]))
+
+
+def create_filters(drop: float, crypto: str, keys: Optional[Tuple[Dict, Dict]],
+                   counter: Optional[DataPacketCounter] = None) -> Tuple[PacketMutator, PacketMutator,
+                                                                         Optional[PacketMutator]]:
+    """
+    Returns the transmit and receive filters of one end, along with its encryptor. Received packets are dropped
+    at random before they are decrypted, so lost packets cost no decryption.
+    """
+    encryptor, decryptor = create_cryptors(crypto, keys)
+    transmit_filter = NoOpPacketMutator() if counter is None else counter
+    recv_filter = RandomDropMutator(drop)
+
+    if encryptor is not None:
+        transmit_filter = CompositeMutator(transmit_filter, encryptor)
+        recv_filter = CompositeMutator(recv_filter, decryptor)
+
+    return transmit_filter, recv_filter, encryptor
+
+
+def transfer_benchmark(transport: str, segment_size: int, drop: float, window: int, crypto: str, size: int,
+                       congestion: str, keys: Optional[Tuple[Dict, Dict]], timeout: float) -> Dict:
+    """
+    Transfers size bytes from a sender to a receiver stream in this process, over a loopback TCP or UDP
+    subsystem, with received packets dropped at the drop percentage in both directions. Each segment's delivery
+    latency runs from the sender's write returning to the receiver reading it.
+    """
+    if transport == "udp":
+        port = free_port(socket.SOCK_DGRAM)
+        server = UdpServerSingleRemote(port)
+        client = UdpClient("127.0.0.1", port)
+    else:
+        port = free_port(socket.SOCK_STREAM)
+        server = TcpServerSingleRemote(port)
+        client = TcpClient("127.0.0.1", port)
+
+    counter = DataPacketCounter()
+    sender_transmit, sender_recv, encryptor = create_filters(drop / 100.0, crypto, keys, counter)
+    receiver_transmit, receiver_recv, _ = create_filters(drop / 100.0, crypto, keys)
+
+    if isinstance(encryptor, BlockRsaEncryptor):
+        segment_size = encryptor.segment_size(segment_size)
+
+    segments = -(-size // segment_size)
+    payload = bytes(segment_size)
+    written_at: List[float] = []
+    read_at: List[float] = []
+
+    with server as server_subsystem, client as client_subsystem:
+        receiver = Stream(server_subsystem, transmit_filter=receiver_transmit, recv_filter=receiver_recv,
+                          congestion_control=create_congestion_control(congestion), recv_buffer_segments=window,
+                          segment_size=segment_size)
+        sender = Stream(client_subsystem, transmit_filter=sender_transmit, recv_filter=sender_recv,
+                        congestion_control=create_congestion_control(congestion), recv_buffer_segments=window,
+                        segment_size=segment_size)
+
+        deadline = time.perf_counter() + timeout
+
+        def receive():
+            while len(read_at) < segments and time.perf_counter() < deadline:
+                received = receiver.read_segments(segment_size * window, timeout=0.1)
+                now = time.perf_counter()
+                read_at.extend(now for _ in received)
+
+        reader = threading.Thread(target=receive)
+
+        cpu = time.process_time()
+        start = time.perf_counter()
+        reader.start()
+
+        for _ in range(segments):
+            if time.perf_counter() >= deadline:
+                break
+
+            sender.write(payload)
+            written_at.append(time.perf_counter())
+
+        reader.join()
+        elapsed = time.perf_counter() - start
+        cpu = time.process_time() - cpu
+
+        # Data packets beyond the first transmission of each segment sent
+        retransmitted = max(counter.count - sender.stream_worker.local_write_offset, 0)
+
+        sender.close()
+        receiver.close()
+
+    completed = len(read_at) >= segments
+    latencies = [(read - written) * 1e3 for written, read in zip(written_at, read_at)]
+    delivered = min(len(read_at), segments) * segment_size
+    written = len(written_at)
+
+    return {
+        "transport": transport,
+        "segment_size": segment_size,
+        "drop": drop,
+        "window": window,
+        "crypto": crypto,
+        "congestion": congestion,
+        "bytes": delivered,
+        "completed": completed,
+        "seconds": elapsed,
+        "goodput_mb_per_s": delivered / elapsed / 1e6,
+        "latency_p50_ms": percentile(latencies, 0.5),
+        "latency_p99_ms": percentile(latencies, 0.99),
+        # Relative to the segments written, which fall short of segments when the run timed out
+        "retransmit_ratio": retransmitted / written if written else None,
+        "cpu_s_per_mb": cpu / (delivered / 1e6) if delivered else None,
+    }
+
+
+def run_transfer_benchmark(transports: Iterable[str], segment_sizes: Iterable[int], drops: Iterable[float],
+                           windows: Iterable[int], cryptos: Iterable[str], size: int, congestion: str,
+                           timeout: float) -> Dict:
+    """
+    Runs transfer_benchmark over every combination of the settings. Returns the results, along with the
+    versions they were measured with, so runs of different versions can be compared.
+    """
+    cryptos = list(cryptos)
+    keys = rsa_gen_key() if any(crypto != "off" for crypto in cryptos) else None
+    results = []
+
+    for transport, segment_size, drop, window, crypto in itertools.product(transports, segment_sizes, drops,
+                                                                           windows, cryptos):
+        result = transfer_benchmark(transport, segment_size, drop, window, crypto, size, congestion, keys, timeout)
+        results.append(result)
+
+        # Progress is reported on stderr, so stdout holds only the JSON
+        print(f"{transport} segment={segment_size} drop={drop}% window={window} crypto={crypto}: "
+              f"{result['goodput_mb_per_s']:.2f} MB/s{'' if result['completed'] else ' (timed out)'}", file=sys.stderr)
+
+    return {
+        "version": package_version(),
+        "python": platform.python_version(),
+        "results": results,
+    }
+
+
+def package_version() -> Optional[str]:
+    try:
+        from importlib.metadata import version, PackageNotFoundError
+    except ImportError:
+        return None
+
+    try:
+        return version("securestream")
+    except PackageNotFoundError:
+        return None
+
+
+def bench_main():
+    parser = ArgumentParser(
+        prog='bench',
+        description='Benchmarks for the stream protocol.')
+
+    benchmarks = parser.add_subparsers(dest="benchmark", required=True)
+
+    window = benchmarks.add_parser(
+        "window",
+        help="Per-segment protocol cost as the send window grows, over an in-memory subsystem.")
+
+    window.add_argument(
+        "--windows",
+        help="Send window sizes (in segments) to measure.",
+        type=int,
+        nargs="+",
+        default=[10, 100, 1000, 10000]
+    )
+
+    window.add_argument(
+        "--packets",
+        help="Number of segments transferred per window size.",
+        type=int,
+        default=100000
+    )
+
+    crypto = benchmarks.add_parser(
+        "crypto",
+        help="Private key encryption rate as packets are spread over more worker processes.")
+
+    crypto.add_argument(
+        "--workers",
+        help="Worker process counts to measure; 0 encrypts on the calling thread.",
+        type=int,
+        nargs="+",
+        default=[0, 1, 2, 4, 8]
+    )
+
+    crypto.add_argument(
+        "--packets",
+        help="Number of packets encrypted per worker count.",
+        type=int,
+        default=5000
+    )
+
+    keygen = benchmarks.add_parser(
+        "keygen",
+        help="Time taken to generate RSA keys of each size.")
+
+    keygen.add_argument(
+        "--bits",
+        help="Modulus sizes to measure.",
+        type=int,
+        nargs="+",
+        default=[2048, 3072, 4096]
+    )
+
+    keygen.add_argument(
+        "--workers",
+        help="Number of processes searching for primes.",
+        type=int,
+        default=1
+    )
+
+    keygen.add_argument(
+        "--runs",
+        help="Number of keys generated per size.",
+        type=int,
+        default=5
+    )
+
+    transfer = benchmarks.add_parser(
+        "transfer",
+        help="End to end transfers between a sender and receiver in this process, over loopback TCP and UDP, "
+             "for every combination of the settings. Reports goodput, delivery latency, retransmissions and CPU "
+             "time as JSON.")
+
+    transfer.add_argument(
+        "--transports",
+        help="Subsystems to transfer over.",
+        choices=["tcp", "udp"],
+        nargs="+",
+        default=["tcp", "udp"]
+    )
+
+    transfer.add_argument(
+        "--segment-sizes",
+        help="Segment sizes (in bytes) to measure.",
+        type=int,
+        nargs="+",
+        default=[1024, 2048]
+    )
+
+    transfer.add_argument(
+        "--drops",
+        help="Percentages of received packets dropped, in both directions.",
+        type=float,
+        nargs="+",
+        default=[0, 1]
+    )
+
+    transfer.add_argument(
+        "--windows",
+        help="Receive buffer sizes (in segments) to measure, which bound the window each end advertises.",
+        type=int,
+        nargs="+",
+        default=[Stream.RECV_BUFFER_SEGMENTS]
+    )
+
+    transfer.add_argument(
+        "--crypto",
+        help="Packet encryption to measure: off, session keys, or RSA in blocks the width of the modulus.",
+        choices=["off", "session", "block"],
+        nargs="+",
+        default=["off", "session"]
+    )
+
+    transfer.add_argument(
+        "--size",
+        help="Number of bytes transferred per combination.",
+        type=int,
+        default=2000000
+    )
+
+    transfer.add_argument(
+        "--congestion",
+        help="Congestion control algorithm used to size the send window.",
+        choices=list(CONGESTION_CONTROLS.keys()),
+        default="reno"
+    )
+
+    transfer.add_argument(
+        "--timeout",
+        help="Seconds after which a transfer is abandoned and reported as incomplete.",
+        type=float,
+        default=60
+    )
+
+    transfer.add_argument(
+        "--output",
+        help="Writes the JSON report to the specified file. Otherwise, it is written to stdout.",
+        type=str
+    )
+
+    args = parser.parse_args()
+
+    if args.benchmark == "window":
+        run_window_benchmark(args.windows, args.packets)
+    elif args.benchmark == "crypto":
+        run_crypto_benchmark(args.workers, args.packets)
+    elif args.benchmark == "keygen":
+        run_keygen_benchmark(args.bits, args.workers, args.runs)
+    elif args.benchmark == "transfer":
+        report = run_transfer_benchmark(args.transports, args.segment_sizes, args.drops, args.windows, args.crypto,
+                                        args.size, args.congestion, args.timeout)
+
+        if args.output is None:
+            json.dump(report, sys.stdout, indent=2)
+            print()
+        else:
+            with open(args.output, "w") as f:
+                json.dump(report, f, indent=2)
+
+
+if __name__ == "__main__":
+    bench_main()
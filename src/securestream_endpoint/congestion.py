@@ -0,0 +1,149 @@
+import math
+import time
+from typing import Optional, Dict, Type
+
+
+class CongestionControl:
+    """
+    Determines how many unacknowledged segments a StreamWorker may have in flight.
+    """
+    INITIAL_WINDOW = 2
+    MIN_WINDOW = 1
+    MAX_WINDOW = 65536
+
+    def __init__(self, initial_window: int = INITIAL_WINDOW, max_window: int = MAX_WINDOW):
+        self.cwnd = float(initial_window)
+        self.ssthresh = math.inf
+        self.max_window = max_window
+
+    def window(self) -> int:
+        return max(CongestionControl.MIN_WINDOW, min(int(self.cwnd), self.max_window))
+
+    def on_ack(self, acked: int, rtt: Optional[float]):
+        """
+        Invoked when remote has cumulatively acknowledged 'acked' new segments.
+        """
+        pass
+
+    def on_loss(self):
+        """
+        Invoked once per window when selective acknowledgements reveal a lost segment.
+        """
+        pass
+
+    def on_timeout(self):
+        """
+        Invoked when the retransmission timer expires.
+        """
+        pass
+
+    def slow_start(self, acked: int) -> int:
+        """
+        Grows the window by one segment per acknowledged segment until ssthresh is reached, returning
+        the number of acknowledged segments left over for congestion avoidance.
+        """
+        if self.cwnd >= self.ssthresh:
+            return acked
+
+        grow = min(acked, max(self.ssthresh - self.cwnd, 0))
+        self.cwnd = min(self.cwnd + grow, self.max_window)
+
+        return acked - int(grow)
+
+
+class RenoCongestionControl(CongestionControl):
+    """
+    Slow start followed by additive increase / multiplicative decrease.
+    """
+
+    def on_ack(self, acked: int, rtt: Optional[float]):
+        acked = self.slow_start(acked)
+
+        if acked > 0:
+            self.cwnd = min(self.cwnd + acked / self.cwnd, self.max_window)
+
+    def on_loss(self):
+        self.ssthresh = max(self.cwnd / 2, 2)
+        self.cwnd = self.ssthresh
+
+    def on_timeout(self):
+        self.ssthresh = max(self.cwnd / 2, 2)
+        self.cwnd = CongestionControl.MIN_WINDOW
+
+
+class CubicCongestionControl(CongestionControl):
+    """
+    CUBIC window growth (RFC 8312); the window is a cubic function of the time since the last
+    loss rather than of the round-trip time, so it scales to high bandwidth-delay paths.
+    """
+    C = 0.4
+    BETA = 0.7
+
+    def __init__(self, initial_window: int = CongestionControl.INITIAL_WINDOW,
+                 max_window: int = CongestionControl.MAX_WINDOW):
+        super().__init__(initial_window, max_window)
+        self.w_max = 0.0
+        self.k = 0.0
+        self.origin = 0.0
+        self.w_est = 0.0
+        self.epoch_start: Optional[float] = None
+
+    def on_ack(self, acked: int, rtt: Optional[float]):
+        acked = self.slow_start(acked)
+
+        if acked <= 0:
+            return
+
+        now = time.time()
+
+        if self.epoch_start is None:
+            self.epoch_start = now
+            self.w_est = self.cwnd
+
+            if self.cwnd < self.w_max:
+                self.k = ((self.w_max - self.cwnd) / CubicCongestionControl.C) ** (1 / 3)
+                self.origin = self.w_max
+            else:
+                self.k = 0.0
+                self.origin = self.cwnd
+
+        t = now - self.epoch_start + (rtt or 0.0)
+        target = self.origin + CubicCongestionControl.C * (t - self.k) ** 3
+
+        if target > self.cwnd:
+            self.cwnd += (target - self.cwnd) / self.cwnd * acked
+        else:
+            self.cwnd += 0.01 * acked / self.cwnd
+
+        # Never grow slower than Reno would in the same conditions
+        beta = CubicCongestionControl.BETA
+        self.w_est += 3 * (1 - beta) / (1 + beta) * acked / self.cwnd
+        self.cwnd = min(max(self.cwnd, self.w_est), self.max_window)
+
+    def on_loss(self):
+        # Fast convergence; release bandwidth sooner when the previous maximum was not reached
+        if self.cwnd < self.w_max:
+            self.w_max = self.cwnd * (1 + CubicCongestionControl.BETA) / 2
+        else:
+            self.w_max = self.cwnd
+
+        self.cwnd = max(self.cwnd * CubicCongestionControl.BETA, 2)
+        self.ssthresh = self.cwnd
+        self.epoch_start = None
+
+    def on_timeout(self):
+        self.on_loss()
+        self.cwnd = CongestionControl.MIN_WINDOW
+
+
+CONGESTION_CONTROLS: Dict[str, Type[CongestionControl]] = {
+    "reno": RenoCongestionControl,
+    "cubic": CubicCongestionControl
+}
+
+
+def create_congestion_control(name: str) -> CongestionControl:
+    if name not in CONGESTION_CONTROLS:
+        raise ValueError(f"Unknown congestion control algorithm '{name}'")
+
+    return CONGESTION_CONTROLS[name]()
@@ -1,5 +1,25 @@
 from .stream import PacketMutator, Packet
+from .subsystem import HEADER_V1, DATA_PACKET_OVERHEAD
+import hashlib
+import hmac
 import json
+import secrets
+import struct
+from typing import Optional, Tuple, Dict
+
+# Sealed packets begin with flags, the session id and the packet's sequence number within the session
+SESSION_HEADER = struct.Struct("<B8sQ")
+SESSION_KEY_LENGTH = struct.Struct("<H")
+
+SESSION_KEY_SIZE = 32
+SESSION_TAG_SIZE = 16
+
+# Block mode ciphertext begins with the length of the packet it encrypts
+BLOCK_PLAINTEXT_LENGTH = struct.Struct("<H")
+
+# Optional private key file fields; the primes of n, the exponent reduced modulo each prime less one, and the
+# inverse of q modulo p
+CRT_FIELDS = ("p", "q", "dP", "dQ", "qInv")
 
 
 class RsaCryptor(PacketMutator):
@@ -7,24 +27,295 @@ class RsaCryptor(PacketMutator):
         self.key = key
         self.n = n
 
+    def transform(self, num: int) -> int:
+        return pow(num, self.key, self.n)
+
     def __call__(self, packet: 'Packet'):
         b = packet.save()
 
         num = int.from_bytes(b, "big")
 
-        num = pow(num, self.key, self.n)
+        num = self.transform(num)
 
         encrypted = num.to_bytes((num.bit_length() + 7) // 8, "big")
 
         return packet.load(encrypted)
 
+    def overhead(self, size: int) -> int:
+        # The packet becomes a single number below n, so it is never wider than the modulus
+        return max((self.n.bit_length() + 7) // 8 - size, 0)
+
+
+class CrtRsaCryptor(RsaCryptor):
+    """
+    Private key cryptor which exponentiates modulo each prime of n, with exponents half the width of the private
+    exponent, and recombines the results by the Chinese remainder theorem. The result is the same as
+    RsaCryptor's, at roughly a third of the cost.
+    """
+
+    def __init__(self, key, n, p, q, dP, dQ, qInv):
+        super().__init__(key, n)
+        self.p = p
+        self.q = q
+        self.dP = dP
+        self.dQ = dQ
+        self.qInv = qInv
+
+    def transform(self, num: int) -> int:
+        m1 = pow(num, self.dP, self.p)
+        m2 = pow(num, self.dQ, self.q)
+
+        return m2 + (self.qInv * (m1 - m2) % self.p) * self.q
+
+
+class BlockRsaEncryptor(PacketMutator):
+    """
+    Encrypts packets of any size by splitting them into blocks one byte narrower than the modulus, so each is a
+    number below n, and encrypting every block of the packet with cryptor. Each block of ciphertext occupies
+    the full width of the modulus, behind the length of the packet.
+    """
+
+    def __init__(self, cryptor: RsaCryptor):
+        self.cryptor = cryptor
+        self.cipher_block_size = (cryptor.n.bit_length() + 7) // 8
+        self.block_size = self.cipher_block_size - 1
+
+    def segment_size(self, limit: int) -> int:
+        """
+        Returns the smallest segment size of at least limit for which a data packet fills whole blocks.
+        """
+        blocks = -(-(limit + DATA_PACKET_OVERHEAD) // self.block_size)
+        return blocks * self.block_size - DATA_PACKET_OVERHEAD
+
+    def __call__(self, packet: 'Packet'):
+        b = packet.save()
+
+        # Zero padding completes the last block; the length recorded ahead of the blocks removes it again
+        b += bytes(-len(b) % self.block_size)
+
+        blocks = [self.cryptor.transform(int.from_bytes(b[i:i + self.block_size], "big"))
+                  for i in range(0, len(b), self.block_size)]
+
+        return packet.load(BLOCK_PLAINTEXT_LENGTH.pack(packet.size()) +
+                           b"".join(block.to_bytes(self.cipher_block_size, "big") for block in blocks))
+
+    def overhead(self, size: int) -> int:
+        blocks = -(-size // self.block_size)
+
+        return BLOCK_PLAINTEXT_LENGTH.size + blocks * self.cipher_block_size - size
+
+
+class BlockRsaDecryptor(PacketMutator):
+    """
+    Decrypts packets encrypted by BlockRsaEncryptor. Packets which do not decode to whole blocks are dropped.
+    """
+
+    def __init__(self, cryptor: RsaCryptor):
+        self.cryptor = cryptor
+        self.cipher_block_size = (cryptor.n.bit_length() + 7) // 8
+        self.block_size = self.cipher_block_size - 1
+
+    def __call__(self, packet: 'Packet'):
+        b = packet.save()
+        length = BLOCK_PLAINTEXT_LENGTH.unpack_from(b)[0]
+        ciphertext = memoryview(b)[BLOCK_PLAINTEXT_LENGTH.size:]
+
+        if len(ciphertext) % self.cipher_block_size != 0 or not HEADER_V1.size <= length <= len(ciphertext):
+            return None
+
+        blocks = [self.cryptor.transform(int.from_bytes(ciphertext[i:i + self.cipher_block_size], "big"))
+                  for i in range(0, len(ciphertext), self.cipher_block_size)]
+
+        if any(block.bit_length() > self.block_size * 8 for block in blocks):
+            return None
+
+        plaintext = b"".join(block.to_bytes(self.block_size, "big") for block in blocks)
+
+        if length > len(plaintext):
+            return None
+
+        return packet.load(plaintext[:length])
+
+
+class SessionKeys:
+    """
+    Cipher and MAC keys derived from a session key. Packets are encrypted with a SHAKE-256 keystream seeded by
+    the cipher key and the packet's sequence number, and authenticated with a keyed BLAKE2b tag.
+    """
+
+    def __init__(self, session_key: bytes):
+        self.cipher_key = hashlib.blake2b(session_key, digest_size=32, person=b"stream-cipher").digest()
+        self.mac_key = hashlib.blake2b(session_key, digest_size=32, person=b"stream-mac").digest()
+
+    def apply_keystream(self, sequence: int, data: bytes) -> bytes:
+        keystream = hashlib.shake_256(self.cipher_key + sequence.to_bytes(8, "little")).digest(len(data))
+        result = int.from_bytes(data, "little") ^ int.from_bytes(keystream, "little")
+
+        return result.to_bytes(len(data), "little")
+
+    def tag(self, header: bytes, ciphertext: bytes) -> bytes:
+        mac = hashlib.blake2b(header, key=self.mac_key, digest_size=SESSION_TAG_SIZE)
+        mac.update(ciphertext)
+
+        return mac.digest()
+
+
+class SessionEncryptor(PacketMutator):
+    """
+    Transmit side of session mode. A random session key is generated once and sent wrapped with the RSA key, so
+    the RSA operation is performed once per stream rather than once per packet. The wrapped key accompanies the
+    first KEY_PACKETS packets and every KEY_INTERVAL-th packet after, so remote learns it despite loss.
+    """
+    FLAG_KEY = 0x01
+
+    KEY_PACKETS = 16
+    KEY_INTERVAL = 32
+
+    def __init__(self, key: int, n: int):
+        session_key = secrets.token_bytes(SESSION_KEY_SIZE)
+
+        self.keys = SessionKeys(session_key)
+        self.session_id = secrets.token_bytes(8)
+        self.wrapped_key = pow(int.from_bytes(session_key, "big"), key, n).to_bytes((n.bit_length() + 7) // 8, "big")
+        self.sequence = 0
+
+    def __call__(self, packet: 'Packet'):
+        sequence = self.sequence
+        self.sequence += 1
 
-def save_key(file: str, key: int, n: int):
+        if sequence < SessionEncryptor.KEY_PACKETS or sequence % SessionEncryptor.KEY_INTERVAL == 0:
+            header = SESSION_HEADER.pack(SessionEncryptor.FLAG_KEY, self.session_id, sequence) + \
+                     SESSION_KEY_LENGTH.pack(len(self.wrapped_key)) + self.wrapped_key
+        else:
+            header = SESSION_HEADER.pack(0, self.session_id, sequence)
+
+        ciphertext = self.keys.apply_keystream(sequence, packet.save())
+
+        return packet.load(header + ciphertext + self.keys.tag(header, ciphertext))
+
+    def overhead(self, size: int) -> int:
+        # Packets which carry the wrapped key are the largest
+        return SESSION_HEADER.size + SESSION_KEY_LENGTH.size + len(self.wrapped_key) + SESSION_TAG_SIZE
+
+
+class SessionDecryptor(PacketMutator):
+    """
+    Receive side of session mode. The session key is unwrapped with the RSA key when a packet of a new session
+    arrives; packets which fail authentication, or arrive before their session's key, are dropped and recovered
+    by retransmission.
+    """
+
+    def __init__(self, key: int, n: int):
+        self.key = key
+        self.n = n
+        self.session_id: Optional[bytes] = None
+        self.keys: Optional[SessionKeys] = None
+
+    def unwrap(self, wrapped_key: bytes) -> Optional[SessionKeys]:
+        session_key = pow(int.from_bytes(wrapped_key, "big"), self.key, self.n)
+
+        if session_key.bit_length() > SESSION_KEY_SIZE * 8:
+            return None
+
+        return SessionKeys(session_key.to_bytes(SESSION_KEY_SIZE, "big"))
+
+    def __call__(self, packet: 'Packet'):
+        sealed = bytes(packet.save())
+
+        if len(sealed) < SESSION_HEADER.size + SESSION_TAG_SIZE:
+            return None
+
+        flags, session_id, sequence = SESSION_HEADER.unpack_from(sealed)
+        header_end = SESSION_HEADER.size
+        keys = self.keys if session_id == self.session_id else None
+
+        if flags & SessionEncryptor.FLAG_KEY:
+            if len(sealed) < header_end + SESSION_KEY_LENGTH.size:
+                return None
+
+            key_length = SESSION_KEY_LENGTH.unpack_from(sealed, header_end)[0]
+            header_end += SESSION_KEY_LENGTH.size + key_length
+
+            if keys is None and header_end + SESSION_TAG_SIZE <= len(sealed):
+                keys = self.unwrap(sealed[header_end - key_length:header_end])
+
+        if keys is None or header_end + SESSION_TAG_SIZE > len(sealed):
+            return None
+
+        header = sealed[:header_end]
+        ciphertext = sealed[header_end:-SESSION_TAG_SIZE]
+
+        if not hmac.compare_digest(keys.tag(header, ciphertext), sealed[-SESSION_TAG_SIZE:]):
+            return None
+
+        # Only a packet which authenticates under a new session's key replaces the current session
+        self.session_id = session_id
+        self.keys = keys
+
+        return packet.load(keys.apply_keystream(sequence, ciphertext))
+
+
+def save_key(file: str, key: int, n: int, **crt: int):
+    """
+    Writes a key file. A private key may also be given the CRT_FIELDS, which build_cryptor uses to speed up
+    the private key operation.
+    """
     with open(file, "w") as f:
-        json.dump({"k": key, "n": n}, f)
+        json.dump({"k": key, "n": n, **crt}, f)
 
 
-def build_cryptor(file: str):
+def read_key(file: str) -> Dict[str, int]:
     with open(file, "r") as f:
-        d = json.load(f)
-        return RsaCryptor(d["k"], d["n"])
+        return json.load(f)
+
+
+def load_key(file: str) -> Tuple[int, int]:
+    d = read_key(file)
+    return d["k"], d["n"]
+
+
+def build_cryptor(file: str):
+    d = read_key(file)
+
+    # Key files written before the CRT fields were introduced hold only k and n
+    if all(field in d for field in CRT_FIELDS):
+        return CrtRsaCryptor(d["k"], d["n"], *(d[field] for field in CRT_FIELDS))
+
+    return RsaCryptor(d["k"], d["n"])
+
+
+def build_block_encryptor(file: str):
+    return BlockRsaEncryptor(build_cryptor(file))
+
+
+def build_block_decryptor(file: str):
+    return BlockRsaDecryptor(build_cryptor(file))
+
+
+def build_session_encryptor(file: str):
+    return SessionEncryptor(*load_key(file))
+
+
+def build_session_decryptor(file: str):
+    return SessionDecryptor(*load_key(file))
+
+
+def build_encryptor(file: str, session: bool = False, block: bool = False):
+    """
+    Builds the transmit side cryptor for a key file, in session mode, block mode or otherwise one RSA operation
+    per packet.
+    """
+    if session:
+        return build_session_encryptor(file)
+
+    return build_block_encryptor(file) if block else build_cryptor(file)
+
+
+def build_decryptor(file: str, session: bool = False, block: bool = False):
+    """
+    Builds the receive side counterpart of build_encryptor.
+    """
+    if session:
+        return build_session_decryptor(file)
+
+    return build_block_decryptor(file) if block else build_cryptor(file)
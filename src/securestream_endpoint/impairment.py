@@ -0,0 +1,147 @@
+import random
+from typing import List, Optional
+
+from .model.controller import ControllerModel
+from .subsystem import Packet
+
+
+class GilbertElliottLoss:
+    """
+    Bursty loss after the Gilbert-Elliott model. The link is either in a good or a bad state, each losing packets
+    at its own rate; before each packet it moves from good to bad with chance enter, and from bad to good with
+    chance exit, so losses come in bursts averaging 1 / exit packets. With enter 0 the link stays good, and
+    packets are lost independently at good_loss.
+    """
+
+    def __init__(self):
+        self.enter = 0.0
+        self.exit = 1.0
+        self.good_loss = 0.0
+        self.bad_loss = 1.0
+        self.bad = False
+
+    def __call__(self) -> bool:
+        """
+        Returns True if the next packet is lost.
+        """
+        if self.bad:
+            self.bad = random.random() >= self.exit
+        else:
+            self.bad = random.random() < self.enter
+
+        return random.random() < (self.bad_loss if self.bad else self.good_loss)
+
+
+class TokenBucket:
+    """
+    Caps the rate packets leave a link at. Tokens accrue at rate bytes per second up to the depth of the bucket,
+    and a packet leaves once there are tokens for its size; until then it queues behind those already waiting, in
+    order. A rate of 0 leaves the link uncapped.
+    """
+    # Bytes the bucket holds, as a period of the rate, so short bursts pass at the speed of the sender
+    BURST_PERIOD = 0.005
+
+    def __init__(self):
+        self.rate = 0.0
+        self.tokens = 0.0
+
+        # Time up to which tokens have been accounted for; later than now while packets queue for tokens
+        self.last = 0.0
+
+    def departure(self, size: int, now: float, max_wait: float) -> Optional[float]:
+        """
+        Returns the time a packet of size bytes arriving at now leaves, or None if it would wait longer than
+        max_wait, as a full queue drops it.
+        """
+        if self.rate <= 0:
+            return now
+
+        start = max(now, self.last)
+        tokens = min(self.rate * TokenBucket.BURST_PERIOD, self.tokens + (start - self.last) * self.rate)
+
+        if tokens >= size:
+            self.tokens = tokens - size
+            self.last = start
+            return start
+
+        leave = start + (size - tokens) / self.rate
+
+        if leave - now > max_wait:
+            return None
+
+        self.tokens = 0.0
+        self.last = leave
+
+        return leave
+
+
+class Impairment:
+    """
+    Impairs packets crossing the proxy in one direction, as a network would. A packet may be lost, in bursts after
+    the Gilbert-Elliott model, and otherwise may be duplicated. Each copy queues for the link's bandwidth, then is
+    delayed by delay plus or minus up to jitter, which may itself reorder packets; a reordered copy is held back
+    a further REORDER_DELAY, so those sent after it overtake it.
+
+    Settings are read from the controller, under keys prefixed by the direction, as client_server_delay:
+      drop         - Percentage of packets lost, outside of bursts
+      delay        - Milliseconds every packet is delayed by
+      jitter       - Milliseconds the delay varies by, either way
+      bandwidth    - Kilobytes per second the link carries; 0 is uncapped
+      reorder      - Percentage of packets held back behind later ones
+      duplicate    - Percentage of packets delivered twice
+      burst_enter  - Percentage chance per packet of a loss burst beginning
+      burst_exit   - Percentage chance per packet of a loss burst ending
+      burst_drop   - Percentage of packets lost during a burst
+    """
+    REORDER_DELAY = 0.01
+
+    # Longest a packet queues for bandwidth before it is dropped, as by a router with a full buffer
+    MAX_QUEUE_DELAY = 1.0
+
+    def __init__(self, direction: str):
+        self.direction = direction
+        self.loss = GilbertElliottLoss()
+        self.bucket = TokenBucket()
+        self.delay = 0.0
+        self.jitter = 0.0
+        self.reorder = 0.0
+        self.duplicate = 0.0
+
+    def get_setting(self, controller: ControllerModel, key: str, default: float, scale: float) -> float:
+        return float(controller.get_config(f"{self.direction}_{key}", default)) / scale
+
+    def configure(self, controller: ControllerModel):
+        self.loss.good_loss = self.get_setting(controller, "drop", 0, 100)
+        self.loss.enter = self.get_setting(controller, "burst_enter", 0, 100)
+        self.loss.exit = self.get_setting(controller, "burst_exit", 100, 100)
+        self.loss.bad_loss = self.get_setting(controller, "burst_drop", 100, 100)
+        self.bucket.rate = self.get_setting(controller, "bandwidth", 0, 1e-3)
+        self.delay = self.get_setting(controller, "delay", 0, 1e3)
+        self.jitter = self.get_setting(controller, "jitter", 0, 1e3)
+        self.reorder = self.get_setting(controller, "reorder", 0, 100)
+        self.duplicate = self.get_setting(controller, "duplicate", 0, 100)
+
+    def schedule(self, packet: Packet, now: float) -> List[float]:
+        """
+        Returns the times at which the copies of a packet arriving at now are to be sent on; none if it is lost.
+        """
+        if self.loss():
+            return []
+
+        copies = 2 if random.random() < self.duplicate else 1
+        departures = []
+
+        for _ in range(copies):
+            departure = self.bucket.departure(packet.size(), now, Impairment.MAX_QUEUE_DELAY)
+
+            if departure is None:
+                continue
+
+            departure += max(0.0, self.delay + random.uniform(-self.jitter, self.jitter))
+
+            if random.random() < self.reorder:
+                departure += Impairment.REORDER_DELAY
+
+            departures.append(departure)
+
+        return departures
@@ -1,14 +1,154 @@
+import atexit
+import json
+import threading
 import time
-from typing import Dict
+from typing import Dict, Optional, Callable
 
 import requests
 import urllib.parse
 import sys
 
 
+class StatisticsAggregator(threading.Thread):
+    """
+    Sums statistics deltas locally and posts them to the controller in batches from a background thread, so
+    recording a statistic never waits on the controller. Memory is bounded by holding one counter per key,
+    for at most MAX_KEYS keys; deltas for further keys are dropped, and counted on stderr once per batch.
+    Deltas which could not be posted are kept and posted with the next batch.
+    """
+    FLUSH_PERIOD = 0.5
+    MAX_KEYS = 64
+
+    def __init__(self, endpoint: str):
+        super().__init__(daemon=True)
+
+        # The session keeps its connection to the controller alive between batches
+        self.session = requests.Session()
+        self.url = urllib.parse.urljoin(endpoint, "/statistics")
+        self.counters: Dict[str, int] = {}
+        self.lock = threading.Lock()
+        self.stop_event = threading.Event()
+        self.retry = 0
+        self.dropped = 0
+
+    def add(self, key: str, count: int = 1):
+        with self.lock:
+            if key in self.counters:
+                self.counters[key] += count
+            elif len(self.counters) < StatisticsAggregator.MAX_KEYS:
+                self.counters[key] = count
+            else:
+                self.dropped += count
+
+    def take(self) -> Dict[str, int]:
+        with self.lock:
+            counters = self.counters
+            self.counters = {}
+
+        return counters
+
+    def report_dropped(self):
+        with self.lock:
+            dropped = self.dropped
+            self.dropped = 0
+
+        if dropped:
+            print(f"Dropped {dropped} statistics counts for keys beyond the first {StatisticsAggregator.MAX_KEYS}",
+                  file=sys.stderr)
+
+    def flush(self):
+        self.report_dropped()
+        batch = self.take()
+
+        if not batch or self.retry > time.time():
+            self.restore(batch)
+            return
+
+        try:
+            r = self.session.post(self.url, json=batch, timeout=ControllerModel.REQUEST_TIMEOUT)
+
+            if r.status_code != 200:
+                raise Exception(r.content)
+        except Exception as e:
+            print(f"Error posting statistics to controller. Will retry in 30 seconds. ({e})", file=sys.stderr)
+            self.retry = time.time() + ControllerModel.RETRY_DELAY
+            self.restore(batch)
+
+    def restore(self, batch: Dict[str, int]):
+        # Undelivered deltas are merged back in, subject to the same key limit as new ones
+        for key, count in batch.items():
+            self.add(key, count)
+
+    def stop(self):
+        self.stop_event.set()
+
+    def run(self):
+        while not self.stop_event.wait(StatisticsAggregator.FLUSH_PERIOD):
+            self.flush()
+
+        self.flush()
+
+
+class ConfigListener(threading.Thread):
+    """
+    Subscribes to the controller's /config/stream and passes each configuration it pushes to on_config,
+    reconnecting whenever the stream is lost, backing off up to RETRY_DELAY while the controller is
+    unreachable. Stops, setting unsupported, if the controller does not offer the stream.
+    """
+    RECONNECT_DELAY = 1
+
+    # The controller sends a keepalive comment at least this often while the configuration is unchanged
+    KEEPALIVE = 15
+
+    def __init__(self, endpoint: str, on_config: Callable[[int, Dict], None]):
+        super().__init__(daemon=True)
+        self.session = requests.Session()
+        self.url = urllib.parse.urljoin(endpoint, "/config/stream")
+        self.on_config = on_config
+        self.unsupported = False
+        self.stop_event = threading.Event()
+        self.reconnect_delay = ConfigListener.RECONNECT_DELAY
+
+    def stop(self):
+        self.stop_event.set()
+
+    def listen(self):
+        timeout = (ControllerModel.REQUEST_TIMEOUT, ConfigListener.KEEPALIVE * 2)
+
+        with self.session.get(self.url, stream=True, timeout=timeout) as r:
+            if r.status_code == 404:
+                self.unsupported = True
+                return
+
+            if r.status_code != 200:
+                raise Exception(r.content)
+
+            self.reconnect_delay = ConfigListener.RECONNECT_DELAY
+
+            for line in r.iter_lines(decode_unicode=True):
+                if self.stop_event.is_set():
+                    return
+
+                if line.startswith("data:"):
+                    event = json.loads(line[len("data:"):])
+                    self.on_config(event["version"], event["config"])
+
+    def run(self):
+        while not self.stop_event.is_set() and not self.unsupported:
+            try:
+                self.listen()
+            except Exception as e:
+                print(f"Lost configuration stream from controller. Reconnecting in {self.reconnect_delay} seconds. "
+                      f"({e})", file=sys.stderr)
+
+            self.stop_event.wait(self.reconnect_delay)
+            self.reconnect_delay = min(self.reconnect_delay * 2, ControllerModel.RETRY_DELAY)
+
+
 class ControllerModel:
     RETRY_DELAY = 30
     CACHE_LIFE = 3
+    REQUEST_TIMEOUT = 5
 
     def __init__(self, endpoint):
         self.endpoint = endpoint
@@ -16,25 +156,87 @@ class ControllerModel:
         self.next_req = 0
         self.cache = dict()
 
-    def post_delta(self, key: str):
-        try:
-            r = requests.post(urllib.parse.urljoin(self.endpoint, "/statistics"), json={key: 1})
+        # Connections to the controller are kept alive and reused between requests
+        self.session = requests.Session()
+        self.statistics: Optional[StatisticsAggregator] = None
+        self.statistics_lock = threading.Lock()
 
-            if r.status_code != 200:
-                print(sys.stderr, "Error posting statistics to controller.")
-        except Exception as e:
-            print(sys.stderr, f"Error posting statistics to controller: {e}")
+        # Once the controller has pushed a configuration it is read from the cache, which the listener keeps
+        # current; polling is only used until then, or if the controller cannot push
+        self.listener: Optional[ConfigListener] = None
+        self.config_version: Optional[int] = None
+        self.config_changed = threading.Condition()
+
+    def post_delta(self, key: str, count: int = 1):
+        """
+        Records a statistics delta. Deltas are posted to the controller in the background.
+        """
+        if self.statistics is None:
+            self.start_statistics()
+
+        self.statistics.add(key, count)
+
+    def start_statistics(self):
+        with self.statistics_lock:
+            if self.statistics is not None:
+                return
+
+            statistics = StatisticsAggregator(self.endpoint)
+            statistics.start()
+
+            # Deltas recorded since the last flush are posted on exit
+            atexit.register(self.close)
+            self.statistics = statistics
+
+    def close(self):
+        if self.listener is not None:
+            self.listener.stop()
+
+        if self.statistics is not None and self.statistics.is_alive():
+            self.statistics.stop()
+            self.statistics.join()
+
+    def start_listener(self):
+        with self.config_changed:
+            if self.listener is None:
+                self.listener = ConfigListener(self.endpoint, self.on_config)
+                self.listener.start()
+
+    def on_config(self, version: int, config: Dict):
+        with self.config_changed:
+            self.cache = config
+            self.config_version = version
+            self.config_changed.notify_all()
+
+    def wait_for_config(self, version: Optional[int], timeout: float) -> Optional[int]:
+        """
+        Waits up to timeout for the controller to push a configuration other than version. Returns the
+        version of the current configuration.
+        """
+        if self.listener is None:
+            self.start_listener()
+
+        with self.config_changed:
+            self.config_changed.wait_for(lambda: self.config_version != version, timeout=timeout)
+            return self.config_version
 
     def get_config(self, key: str, default: any) -> any:
+        if self.listener is None:
+            self.start_listener()
+
+        if self.config_version is not None:
+            return self.cache.get(key, default)
+
         if self.next_req > time.time():
             return self.cache.get(key, default)
 
         if time.time() > self.retry:
             try:
-                r = requests.get(urllib.parse.urljoin(self.endpoint, "/config"))
+                r = self.session.get(urllib.parse.urljoin(self.endpoint, "/config"), timeout=ControllerModel.REQUEST_TIMEOUT)
 
                 if r.status_code != 200:
-                    print(sys.stderr, f"Error communicating with controller. Will retry in 30 seconds. ({r.content})")
+                    print(f"Error communicating with controller. Will retry in 30 seconds. ({r.content})",
+                          file=sys.stderr)
                     self.retry = time.time() + ControllerModel.RETRY_DELAY
                     return default
 
@@ -42,7 +244,7 @@ class ControllerModel:
                 self.next_req = time.time() + ControllerModel.CACHE_LIFE
                 return self.cache.get(key, default)
             except Exception as e:
-                print(sys.stderr, f"Error reaching controller. Will retry in 30 seconds. ({e})")
+                print(f"Error reaching controller. Will retry in 30 seconds. ({e})", file=sys.stderr)
                 self.retry = time.time() + ControllerModel.RETRY_DELAY
 
         return default
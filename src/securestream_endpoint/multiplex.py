@@ -0,0 +1,500 @@
+import queue
+import selectors
+import socket
+import threading
+import time
+from collections import deque
+from queue import Queue, Empty
+from typing import Optional, Callable, Dict, List, Deque
+
+from .ack import AckPolicy
+from .congestion import create_congestion_control
+from .options import PacketOption, decode_options
+from .rtt import RttEstimator
+from .stream import StreamEngine, StreamWorker, Stream, PacketMutator, NoOpPacketMutator, fit_segment_size
+from .subsystem import Subsystem, SubsystemClosedException, Packet, CHANNEL_ID
+
+
+class ChannelSubsystem(Subsystem):
+    """
+    The subsystem as seen by the engine of one channel. Packets sent are marked with the channel and handed to
+    the multiplexer; packets the multiplexer received for the channel are queued until the engine collects them.
+    Only the worker thread uses it.
+    """
+
+    def __init__(self, worker: 'MultiplexWorker', channel: int):
+        self.worker = worker
+        self.channel = channel
+        self.received: Deque[Packet] = deque()
+
+    def send(self, packet: Packet):
+        # Channel 0 is sent without the channel field, so a plain Stream on the other end takes it as its own
+        packet.channel = None if self.channel == 0 else self.channel
+        self.worker.write_raw(packet)
+
+    def recv(self, timeout: float = 0) -> Optional[Packet]:
+        return self.received.popleft() if self.received else None
+
+    def recv_many(self, timeout: float = 0) -> List[Packet]:
+        packets = list(self.received)
+        self.received.clear()
+
+        return packets
+
+    def get_dataseg_limit(self) -> int:
+        # The channel field is added before the worker's transmit filter sees the packet
+        return fit_segment_size(self.worker.subsystem.get_dataseg_limit(), self.worker.transmit_filter) - \
+            CHANNEL_ID.size
+
+    def close(self):
+        self.worker.remove(self.channel)
+
+    def is_closed(self) -> bool:
+        return self.worker.subsystem.is_closed()
+
+
+class ChannelEngine(StreamEngine):
+    """
+    Engine of one channel. Towards its Channel it stands in for a StreamWorker, but it has no thread of its own;
+    the MultiplexWorker drives the engines of every channel.
+    """
+
+    def __init__(self, worker: 'MultiplexWorker', channel: int, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.worker = worker
+        self.channel = channel
+
+    def start(self):
+        self.worker.add(self)
+
+    def notify(self):
+        self.worker.notify()
+
+    def stop(self):
+        self.worker.remove(self.channel)
+
+    def join(self):
+        pass
+
+    def is_alive(self) -> bool:
+        return self.worker.is_alive() and self.worker.engines.get(self.channel) is self
+
+    def ended(self) -> bool:
+        """
+        Whether remote has acknowledged the end of channel marker the application queued when it closed the channel.
+        """
+        return self.local_end is not None and self.max_remote_read_offset > self.local_end
+
+    def finish(self) -> bool:
+        """
+        Hands the application the in-order segments still held in the receive window, followed by the end of
+        stream marker, as far as the application has made room. Returns True once the marker has been queued;
+        unlike StreamWorker.finish it does not wait, so a channel which is not being read holds up no other.
+        """
+        while True:
+            segment = self.recv_window.get(self.local_read_offset)
+
+            try:
+                self.data_out.put_nowait(segment)
+            except queue.Full:
+                return False
+
+            if segment is None:
+                return True
+
+            del self.recv_window[self.local_read_offset]
+            self.local_read_offset += 1
+
+
+class MultiplexWorker(threading.Thread):
+    """
+    Drives every channel of a MultiplexedStream from one thread. Packets received on the subsystem are passed
+    through recv_filter and queued for the engine of their channel; on_channel is called for a channel remote
+    opened, and returns its engine or None to drop the packet; on_removed is called once a channel's engine has
+    been removed. Packets the engines send are passed through transmit_filter, after they have been marked with
+    their channel.
+    """
+    # How long a closed channel is remembered; longer than remote retransmits its end of channel marker for, at
+    # the longest retransmission timeout, before it learns the acknowledgement was lost
+    CLOSED_LINGER = 2 * RttEstimator.MAX_RTO
+
+    # Most channels open at once
+    MAX_CHANNELS = 1024
+
+    def __init__(self, subsystem: Subsystem, recv_filter: PacketMutator, transmit_filter: PacketMutator,
+                 on_channel: Callable[[int], Optional[ChannelEngine]], on_removed: Callable[[int], None]):
+        super().__init__()
+        self.subsystem = subsystem
+        self.recv_filter = recv_filter
+        self.transmit_filter = transmit_filter
+        self.on_channel = on_channel
+        self.on_removed = on_removed
+
+        self.engines: Dict[int, ChannelEngine] = {}
+
+        # Channels closed here within CLOSED_LINGER, with the time each closed, oldest first; packets remote still
+        # sends on them are dropped rather than reopening them
+        self.closed_channels: Dict[int, float] = {}
+        self.lock = threading.Lock()
+
+        self.stop_event = threading.Event()
+        self.wakeup_recv, self.wakeup_send = socket.socketpair()
+        self.wakeup_recv.setblocking(False)
+        self.wakeup_send.setblocking(False)
+
+    def forget_closed(self):
+        """
+        Drops the closed channels remembered for longer than CLOSED_LINGER. Called with the lock held.
+        """
+        expired = time.time() - MultiplexWorker.CLOSED_LINGER
+
+        while self.closed_channels and next(iter(self.closed_channels.values())) < expired:
+            del self.closed_channels[next(iter(self.closed_channels))]
+
+    def add(self, engine: ChannelEngine):
+        with self.lock:
+            self.forget_closed()
+
+            if engine.channel in self.engines or engine.channel in self.closed_channels:
+                raise ValueError(f"Channel {engine.channel} has already been opened")
+
+            if len(self.engines) >= MultiplexWorker.MAX_CHANNELS:
+                raise ValueError("Too many channels are open")
+
+            self.engines[engine.channel] = engine
+
+        self.notify()
+
+    def remove(self, channel: int):
+        with self.lock:
+            engine = self.engines.pop(channel, None)
+
+            # Reinserted, so the channels stay in the order they closed
+            self.closed_channels.pop(channel, None)
+            self.closed_channels[channel] = time.time()
+            self.forget_closed()
+
+        if engine is not None:
+            engine.stop_notify()
+            self.on_removed(channel)
+
+    def is_known(self, channel: int) -> bool:
+        with self.lock:
+            self.forget_closed()
+
+            return channel in self.engines or channel in self.closed_channels
+
+    def snapshot(self) -> List[ChannelEngine]:
+        with self.lock:
+            return list(self.engines.values())
+
+    def open_count(self) -> int:
+        with self.lock:
+            return len(self.engines)
+
+    def stop(self):
+        self.stop_event.set()
+        self.notify()
+
+    def notify(self):
+        try:
+            self.wakeup_send.send(b'\0')
+        except OSError:
+            # The worker already has wakeups pending, or has shut down
+            pass
+
+    def write_raw(self, packet: Packet):
+        packet = self.transmit_filter(packet)
+
+        if packet is None:
+            return
+
+        self.subsystem.send(packet)
+
+    def try_receive(self) -> bool:
+        """
+        Queues received packets for their channels. Returns True if the limit was reached and more packets may
+        be waiting.
+        """
+        received = 0
+
+        while received < StreamEngine.MAX_RECV:
+            packets = self.subsystem.recv_many(0)
+
+            if not packets:
+                return False
+
+            for packet in packets:
+                self.demultiplex(packet)
+
+            received += len(packets)
+
+        return True
+
+    def demultiplex(self, packet: Packet):
+        packet = self.recv_filter(packet)
+
+        if packet is None:
+            return
+
+        channel = 0 if packet.channel is None else packet.channel
+        engine = self.engines.get(channel)
+
+        if engine is None:
+            if self.is_known(channel):
+                self.acknowledge_end(packet)
+                return
+
+            engine = self.on_channel(channel)
+
+            if engine is None:
+                return
+
+        engine.subsystem.received.append(packet)
+
+    def acknowledge_end(self, packet: Packet):
+        """
+        Acknowledges remote's end of channel marker on a channel already closed here, which remote retransmits
+        if the acknowledgement sent before the channel closed was lost.
+        """
+        if packet.is_ack() or PacketOption.FIN not in (decode_options(packet.get_options() or bytes()) or {}):
+            return
+
+        ack = Packet.ack(packet.write_offset + 1, 0)
+        ack.channel = packet.channel
+        self.write_raw(ack)
+
+    def finish(self):
+        """
+        Ends every channel once the subsystem has closed, waiting for the application to make room unless stopped.
+        """
+        engines = self.snapshot()
+
+        while engines and not self.stop_event.is_set():
+            engines = [engine for engine in engines if not engine.finish()]
+
+            if engines:
+                time.sleep(StreamWorker.ATTACH_POLL_PERIOD)
+
+    def run(self) -> None:
+        selector = selectors.DefaultSelector()
+        selector.register(self.wakeup_recv, selectors.EVENT_READ)
+        subsystem_fd = None
+
+        try:
+            while not self.stop_event.is_set():
+                timeouts = []
+
+                try:
+                    more = self.try_receive()
+
+                    for engine in self.snapshot():
+                        engine.try_restore_backoff()
+                        engine.deliver()
+                        engine.try_receive()
+                        engine.try_transmit()
+
+                        if engine.ended():
+                            self.remove(engine.channel)
+                            continue
+
+                        timeouts.append(engine.next_timeout())
+                except (ConnectionResetError, SubsystemClosedException):
+                    self.finish()
+                    break
+
+                if subsystem_fd is None:
+                    subsystem_fd = self.subsystem.fileno()
+
+                    if subsystem_fd is not None:
+                        selector.register(subsystem_fd, selectors.EVENT_READ)
+
+                timeouts = [timeout for timeout in timeouts if timeout is not None]
+                timeout = 0 if more else min(timeouts, default=None)
+
+                if subsystem_fd is None:
+                    timeout = StreamWorker.ATTACH_POLL_PERIOD if timeout is None else min(timeout, StreamWorker.ATTACH_POLL_PERIOD)
+
+                # Sleep until the socket is readable, an application queued data or any channel's timer expires
+                selector.select(timeout)
+
+                try:
+                    while self.wakeup_recv.recv(4096):
+                        pass
+                except BlockingIOError:
+                    pass
+        except BrokenPipeError:
+            self.finish()
+        finally:
+            selector.close()
+            self.wakeup_recv.close()
+            self.wakeup_send.close()
+
+            for engine in self.snapshot():
+                engine.stop_notify()
+
+
+class Channel(Stream):
+    """
+    One of the byte streams carried by a MultiplexedStream. A channel is used as a Stream, and has a sequence
+    space, receive window and congestion window of its own, but shares the subsystem, filters and worker thread
+    of the multiplexer.
+    """
+
+    def __init__(self, worker: MultiplexWorker, channel: int, **kwargs):
+        self.worker = worker
+        self.channel = channel
+
+        # Set by close; closed is also set once the application reads remote's end of channel marker
+        self.ended = False
+
+        super().__init__(ChannelSubsystem(worker, channel), **kwargs)
+
+    def create_worker(self, subsystem: Subsystem, recv_filter: PacketMutator, transmit_filter: PacketMutator,
+                      **kwargs) -> ChannelEngine:
+        return ChannelEngine(self.worker, self.channel, subsystem, self.data_in, self.data_out, recv_filter,
+                             transmit_filter, **kwargs)
+
+    def close(self):
+        """
+        Closes the channel. An end of channel marker is queued behind the data already written, so remote's channel
+        ends once it has read everything; the engine is removed when remote acknowledges the marker. Segments the
+        application has not read are discarded if the end of stream marker would not otherwise fit, as the worker
+        serving the other channels cannot wait for them to be read.
+        """
+        if self.ended:
+            return
+
+        self.ended = True
+
+        while self.stream_worker.is_alive():
+            try:
+                self.data_in.put(None, timeout=StreamWorker.ATTACH_POLL_PERIOD)
+                self.stream_worker.notify()
+                break
+            except queue.Full:
+                pass
+        else:
+            self.stream_worker.stop()
+
+        while True:
+            try:
+                self.data_out.put_nowait(None)
+                break
+            except queue.Full:
+                try:
+                    self.data_out.get_nowait()
+                except Empty:
+                    pass
+
+        self.closed = True
+
+
+class MultiplexedStream:
+    """
+    Carries any number of independent channels over one subsystem, all driven by a single worker thread. A
+    channel whose application stops reading closes only its own receive window, so the others carry on.
+
+    Channels are numbered in the version 2 header. Either end may open a channel: the first packet remote sends
+    on a channel not open here opens it, and it is returned by accept. The end which initiated the connection
+    numbers the channels it opens oddly, and the other evenly, so the two never open the same one by accident.
+    Channel 0 is carried without a channel field, so a plain Stream on the other end talks to it. A channel ends
+    once the application on either end closes it and the other has read what was written before, or when the
+    subsystem closes.
+    """
+    def __init__(self, subsystem: Subsystem, *, recv_filter: Optional[PacketMutator] = None,
+                 transmit_filter: Optional[PacketMutator] = None, initiator: bool = True, sack: bool = True,
+                 congestion: str = "reno", recv_buffer_segments: int = Stream.RECV_BUFFER_SEGMENTS,
+                 ack_policy: Optional[AckPolicy] = None, segment_size: Optional[int] = None):
+        self.congestion = congestion
+        self.channel_options = dict(sack=sack, recv_buffer_segments=recv_buffer_segments, ack_policy=ack_policy,
+                                    segment_size=segment_size)
+
+        self.next_channel = 1 if initiator else 2
+        self.lock = threading.Lock()
+        self.accepted: Queue[Channel] = Queue()
+        # Channels whose engines have not been removed yet
+        self.channels: Dict[int, Channel] = {}
+        self.closed = False
+
+        self.worker = MultiplexWorker(
+            subsystem,
+            NoOpPacketMutator() if recv_filter is None else recv_filter,
+            NoOpPacketMutator() if transmit_filter is None else transmit_filter,
+            self.remote_opened,
+            self.channel_removed
+        )
+
+        self.worker.start()
+
+    def create_channel(self, channel: int) -> Channel:
+        # The worker refuses the channel's engine if it is already known or too many are open
+        created = Channel(self.worker, channel, congestion_control=create_congestion_control(self.congestion),
+                          **self.channel_options)
+
+        with self.lock:
+            self.channels[channel] = created
+
+        return created
+
+    def channel_removed(self, channel: int):
+        with self.lock:
+            self.channels.pop(channel, None)
+
+    def open_channel(self, channel: Optional[int] = None) -> Channel:
+        """
+        Opens a channel, numbered channel or otherwise the next this end numbers. Raises ValueError if the
+        channel has already been opened by either end, or MAX_CHANNELS are open.
+        """
+        with self.lock:
+            if channel is None:
+                while self.worker.is_known(self.next_channel):
+                    self.next_channel += 2
+
+                channel = self.next_channel
+                self.next_channel += 2
+
+        return self.create_channel(channel)
+
+    def remote_opened(self, channel: int) -> Optional[ChannelEngine]:
+        try:
+            created = self.create_channel(channel)
+        except ValueError:
+            return None
+
+        self.accepted.put(created)
+
+        return created.stream_worker
+
+    def accept(self, timeout=None) -> Optional[Channel]:
+        """
+        Returns the next channel opened by remote, waiting up to timeout for one.
+        """
+        try:
+            return self.accepted.get(timeout=timeout)
+        except Empty:
+            return None
+
+    def is_open(self) -> bool:
+        return not self.closed and self.worker.is_alive()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, traceback):
+        self.close()
+
+    def close(self):
+        if self.closed:
+            return
+
+        self.worker.stop()
+        self.worker.join()
+
+        with self.lock:
+            channels = list(self.channels.values())
+
+        for channel in channels:
+            channel.close()
+
+        self.closed = True
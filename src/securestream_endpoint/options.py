@@ -0,0 +1,74 @@
+import struct
+from enum import IntEnum
+from typing import Dict, List, Optional, Tuple
+
+"""
+Packet options are carried as a sequence of (kind, length, value) records.
+
+Peers which predate options never inspect the payload of an ack (write_offset < 0), so
+acks can always carry an options block without breaking them. A peer which receives an
+ack with a well-formed options block therefore knows that the remote understands options
+and may enable the extensions advertised in it, and may attach options to data packets
+(see Packet.OPTIONS_FLAG).
+"""
+
+OPTION_HEADER = struct.Struct("<BH")
+SACK_BLOCK = struct.Struct("<qq")
+TIMESTAMP = struct.Struct("<QQ")
+
+
+class PacketOption(IntEnum):
+    SACK = 1
+    TIMESTAMP = 2
+    # Marks an empty data packet as the end of the sender's stream; it occupies a write offset of its own, so
+    # it is retransmitted and delivered in order like any segment
+    FIN = 3
+
+
+def encode_options(options: Dict[int, bytes]) -> bytes:
+    return b''.join(OPTION_HEADER.pack(kind, len(value)) + value for kind, value in options.items())
+
+
+def decode_options(data: bytes) -> Optional[Dict[int, bytes]]:
+    """
+    Decodes an options block, returning None if the data is not a well-formed options block.
+    """
+    options = {}
+    offset = 0
+
+    while offset < len(data):
+        if offset + OPTION_HEADER.size > len(data):
+            return None
+
+        kind, length = OPTION_HEADER.unpack_from(data, offset)
+        offset += OPTION_HEADER.size
+
+        if offset + length > len(data):
+            return None
+
+        options[kind] = bytes(data[offset:offset + length])
+        offset += length
+
+    return options
+
+
+def encode_sack(blocks: List[Tuple[int, int]]) -> bytes:
+    return b''.join(SACK_BLOCK.pack(start, end) for start, end in blocks)
+
+
+def decode_sack(value: bytes) -> Optional[List[Tuple[int, int]]]:
+    if len(value) % SACK_BLOCK.size != 0:
+        return None
+
+    return [SACK_BLOCK.unpack_from(value, i) for i in range(0, len(value), SACK_BLOCK.size)]
+
+
+def encode_timestamp(value: int, echo: int) -> bytes:
+    return TIMESTAMP.pack(value, echo)
+
+
+def decode_timestamp(value: bytes) -> Optional[Tuple[int, int]]:
+    if len(value) != TIMESTAMP.size:
+        return None
+
+    return TIMESTAMP.unpack(value)
@@ -0,0 +1,146 @@
+import queue
+import threading
+from concurrent.futures import ProcessPoolExecutor, Future
+from typing import List, Optional, Tuple
+
+from .stream import PacketMutator, fit_segment_size
+from .subsystem import Subsystem, SubsystemClosedException, Packet
+
+# The mutator applied by each worker process, set once when the process starts
+worker_mutator: Optional[PacketMutator] = None
+
+
+def init_worker(mutator: PacketMutator):
+    global worker_mutator
+    worker_mutator = mutator
+
+
+def mutate_batch(frames: List[bytes]) -> List[Optional[bytes]]:
+    results = []
+
+    for frame in frames:
+        packet = worker_mutator(Packet.load(frame))
+        results.append(None if packet is None else bytes(packet.save()))
+
+    return results
+
+
+class ParallelMutatorSubsystem(Subsystem):
+    """
+    Applies a mutator to every packet sent over the wrapped subsystem in a pool of worker processes, so an
+    expensive mutator such as RsaCryptor is not confined to the stream's thread. Packets are gathered into
+    batches of up to batch_size as they are sent, and passed on to the wrapped subsystem in the order they were
+    sent. At most max_in_flight packets may be waiting or being mutated; send blocks beyond that.
+
+    Each worker has its own copy of the mutator, so it must not depend on state carried from one packet to the
+    next; RsaCryptor qualifies, SessionEncryptor does not. Received packets are passed through unchanged.
+    """
+    BATCH_SIZE = 16
+    MAX_IN_FLIGHT = 256
+
+    # How often blocked threads check whether the subsystem has closed
+    POLL_PERIOD = 0.1
+
+    def __init__(self, subsystem: Subsystem, mutator: PacketMutator, workers: int,
+                 max_in_flight: int = MAX_IN_FLIGHT, batch_size: int = BATCH_SIZE):
+        if batch_size > max_in_flight:
+            raise ValueError("A batch cannot be larger than the in flight limit")
+
+        self.subsystem = subsystem
+        self.mutator = mutator
+        self.batch_size = batch_size
+        self.closed = False
+
+        self.in_flight = threading.Semaphore(max_in_flight)
+        self.unsent: queue.Queue[bytes] = queue.Queue()
+
+        # Batches in the order they were submitted, each with its number of packets; None once dispatch stops
+        self.batches: queue.Queue[Optional[Tuple[int, Future]]] = queue.Queue()
+
+        self.executor = ProcessPoolExecutor(workers, initializer=init_worker, initargs=(mutator,))
+
+        self.dispatcher = threading.Thread(target=self.dispatch, daemon=True)
+        self.writer = threading.Thread(target=self.write, daemon=True)
+        self.dispatcher.start()
+        self.writer.start()
+
+    def dispatch(self):
+        while not self.is_closed():
+            try:
+                batch = [self.unsent.get(timeout=ParallelMutatorSubsystem.POLL_PERIOD)]
+            except queue.Empty:
+                continue
+
+            while len(batch) < self.batch_size:
+                try:
+                    batch.append(self.unsent.get_nowait())
+                except queue.Empty:
+                    break
+
+            self.batches.put((len(batch), self.executor.submit(mutate_batch, batch)))
+
+        self.batches.put(None)
+
+    def write(self):
+        while True:
+            entry = self.batches.get()
+
+            if entry is None:
+                break
+
+            count, future = entry
+
+            try:
+                for frame in future.result():
+                    if frame is not None and not self.is_closed():
+                        self.subsystem.send(Packet.load(frame))
+            except SubsystemClosedException:
+                self.closed = True
+            finally:
+                for _ in range(count):
+                    self.in_flight.release()
+
+        self.executor.shutdown(wait=False, cancel_futures=True)
+
+    def send(self, packet: Packet):
+        while not self.in_flight.acquire(timeout=ParallelMutatorSubsystem.POLL_PERIOD):
+            if self.is_closed():
+                raise SubsystemClosedException()
+
+        if self.is_closed():
+            self.in_flight.release()
+            raise SubsystemClosedException()
+
+        # Encoded now; the stream may update the packet before a worker is given it
+        self.unsent.put(bytes(packet.save()))
+
+    def recv(self, timeout: float = Subsystem.RECV_TIMEOUT) -> Optional[Packet]:
+        return self.subsystem.recv(timeout)
+
+    def recv_many(self, timeout: float = Subsystem.RECV_TIMEOUT) -> List[Packet]:
+        return self.subsystem.recv_many(timeout)
+
+    def fileno(self) -> Optional[int]:
+        return self.subsystem.fileno()
+
+    def get_dataseg_limit(self) -> int:
+        # Packets reach the wrapped subsystem only once they have been mutated
+        return fit_segment_size(self.subsystem.get_dataseg_limit(), self.mutator)
+
+    def close(self):
+        """
+        Stops mutating packets, discarding any not yet passed on. The wrapped subsystem is left open; the pool
+        is also stopped when the wrapped subsystem closes.
+        """
+        self.closed = True
+        self.dispatcher.join()
+        self.writer.join()
+
+    def is_closed(self) -> bool:
+        return self.closed or self.subsystem.is_closed()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
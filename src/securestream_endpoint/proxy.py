@@ -1,17 +1,24 @@
-import time
+import selectors
+import socket
+import sys
 from argparse import ArgumentParser
 
-from .udp import UdpClient, UdpServerSingleRemote
-from .tcp import TcpSocketSubsystem, TcpClient, TcpServerSingleRemote
+from .subsystem import Subsystem
+from .udp import UdpClient, UdpServerMulti
+from .tcp import TcpClient, TcpServerMulti
 from .model.controller import ControllerModel
-from .stream import RandomDropMutator, SubsystemBridge
-import socket
+from .impairment import Impairment
+from .stream import SubsystemBridge
+
+# A UDP client has no connection to close, so its pair is removed once neither end has sent for this long
+UDP_IDLE_TIMEOUT = 30
 
 
 def proxy_main():
     parser = ArgumentParser(
         prog='proxy',
-        description='Proxy server for controlling data drop-rates.')
+        description='Proxy server for impairing the network between sender and receiver: loss, delay, jitter, '
+                    'bandwidth, reordering and duplication, as configured by the controller.')
 
     parser.add_argument(
         "--proxy-port",
@@ -47,38 +54,120 @@ def proxy_main():
         action='store_true'
     )
 
+    parser.add_argument(
+        "--datagram",
+        help="With --udp, carries each packet in a datagram of its own instead of framing packets as a byte "
+             "stream, so a lost datagram loses only its own packet. Both ends must agree.",
+        action='store_true'
+    )
+
+    parser.add_argument(
+        "--mtu",
+        help="MTU the datagrams of --datagram are sized to fit. By default, the MTU of the route to remote is "
+             "probed.",
+        type=int
+    )
+
     args = parser.parse_args()
 
+    if not args.udp:
+        if args.datagram:
+            parser.error("--datagram requires --udp")
+
+        if args.mtu is not None:
+            parser.error("--mtu requires --udp")
+
     controller = ControllerModel(args.controller)
 
-    client_serv_filter = RandomDropMutator(0.0)
-    serv_client_filter = RandomDropMutator(0.0)
+    # Every pair shares the impairments of its direction, as clients sharing a network link would
+    client_serv_impairment = Impairment("client_server")
+    serv_client_impairment = Impairment("server_client")
 
     if args.udp:
-        client = UdpServerSingleRemote(args.proxy_port)
-        target = UdpClient(args.target, args.target_port)
+        server = UdpServerMulti(args.proxy_port, args.datagram, args.mtu)
     else:
-        client = TcpServerSingleRemote(args.proxy_port)
-        target = TcpClient(args.target, args.target_port)
+        server = TcpServerMulti(args.proxy_port)
+
+    bridge = SubsystemBridge()
+
+    # Resolved once, as resolving the name for every client would hold up the bridge
+    target = socket.gethostbyname(args.target)
+
+    def add_pair(client_subsystem: Subsystem, target_subsystem: Subsystem):
+        if args.udp:
+            bridge.add_pair(client_subsystem, target_subsystem, ab_impairment=client_serv_impairment,
+                            ba_impairment=serv_client_impairment, idle_timeout=UDP_IDLE_TIMEOUT,
+                            on_removed=lambda: server.forget(client_subsystem))
+        else:
+            bridge.add_pair(client_subsystem, target_subsystem, ab_impairment=client_serv_impairment,
+                            ba_impairment=serv_client_impairment)
+
+    def connect_target(client_subsystem: Subsystem):
+        """
+        Connects a target for a newly accepted client, and bridges the two. A TCP connection is established
+        while the bridge goes on serving the other pairs.
+        """
+        try:
+            if args.udp:
+                add_pair(client_subsystem, UdpClient(target, args.target_port, args.datagram, args.mtu).connect())
+                return
+
+            client = TcpClient(target, args.target_port)
+            sock = client.start_connect()
+        except OSError as e:
+            print(f"Could not connect to the target: {e}", file=sys.stderr)
+            client_subsystem.close()
+            return
+
+        def connected():
+            bridge.unwatch(sock)
 
-    with client as client_subsystem:
-        with target as target_subsystem:
             try:
-                bridge = SubsystemBridge(
-                    client_subsystem,
-                    target_subsystem,
-                    client_serv_filter, serv_client_filter)
-                bridge.start()
-
-                while bridge.is_alive():
-                    time.sleep(0.2)
-
-                    client_serv_filter.set_drop(controller.get_config("client_server_drop", 0.0) / 100.0)
-                    serv_client_filter.set_drop(controller.get_config("server_client_drop", 0.0) / 100.0)
-            finally:
+                target_subsystem = client.finish_connect()
+            except OSError as e:
+                print(f"Could not connect to the target: {e}", file=sys.stderr)
                 client_subsystem.close()
-                target_subsystem.close()
+                return
+
+            add_pair(client_subsystem, target_subsystem)
+
+        bridge.watch(sock, connected, selectors.EVENT_WRITE)
+
+    def accept_clients():
+        if args.udp:
+            accepted, received = server.accept()
+
+            for client_subsystem in accepted:
+                connect_target(client_subsystem)
+
+            # The listening socket received these packets on behalf of the clients' own sockets
+            for client_subsystem in received:
+                bridge.forward_from(client_subsystem)
+
+            return
+
+        client_subsystem = server.accept()
+
+        while client_subsystem is not None:
+            connect_target(client_subsystem)
+            client_subsystem = server.accept()
+
+    with server:
+        try:
+            bridge.watch(server, accept_clients)
+            bridge.start()
+
+            version = None
+
+            while bridge.is_alive():
+                # Returns as soon as the controller pushes a change
+                version = controller.wait_for_config(version, 0.2)
 
+                client_serv_impairment.configure(controller)
+                serv_client_impairment.configure(controller)
+        finally:
+            bridge.stop()
+            bridge.join()
 
 if __name__ == "__main__":
     proxy_main()
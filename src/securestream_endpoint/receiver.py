@@ -1,27 +1,148 @@
+import asyncio
+import itertools
 import os
+import signal
 import sys
 import time
 from argparse import ArgumentParser
+from typing import Optional, Tuple, Set
 
-from .subsystem import Subsystem
+from .async_stream import AsyncStream, AsyncSubsystem
+from .async_tcp import AsyncTcpServerMulti
+from .async_udp import AsyncUdpServerMulti
+from .subsystem import Subsystem, Packet
 from .udp import UdpServerSingleRemote
 from .tcp import TcpServerSingleRemote
 from .model.controller import ControllerModel
-from .stream import StatsRelay, Stream, CompositeMutator
-from .crypto import build_cryptor
+from .congestion import CONGESTION_CONTROLS, create_congestion_control
+from .parallel import ParallelMutatorSubsystem
+from .stream import StatsRelay, Stream, CompositeMutator, PacketMutator
+from .crypto import build_encryptor, build_decryptor
+from .sink import Sink, FdSink, FileSink, drain_to_sink
 
 
-def create_stream(subsystem: Subsystem, controller: ControllerModel, pub_key: str = None, priv_key: str = None):
+def create_filters(controller: ControllerModel, pub_key: Optional[str], priv_key: Optional[str], session: bool,
+                   block: bool) -> Tuple[PacketMutator, PacketMutator, Optional[PacketMutator]]:
+    """
+    Returns the transmit and receive filters, without the cryptor for transmitted packets, which is returned
+    separately.
+    """
     transmit_filter = StatsRelay("server_sent", controller)
     recv_filter = StatsRelay("server_recv", controller)
+    cryptor = None
 
     if pub_key:
-        recv_filter = CompositeMutator(build_cryptor(pub_key), recv_filter)
+        recv_filter = CompositeMutator(build_decryptor(pub_key, session, block), recv_filter)
 
     if priv_key:
-        transmit_filter = CompositeMutator(transmit_filter, build_cryptor(priv_key))
+        cryptor = build_encryptor(priv_key, session, block)
 
-    return Stream(subsystem, transmit_filter=transmit_filter, recv_filter=recv_filter)
+    return transmit_filter, recv_filter, cryptor
+
+
+def create_stream(subsystem: Subsystem, controller: ControllerModel, pub_key: str = None, priv_key: str = None,
+                  congestion: str = "reno", legacy_header: bool = False, session: bool = False,
+                  crypto_workers: int = 0, block: bool = False):
+    transmit_filter, recv_filter, cryptor = create_filters(controller, pub_key, priv_key, session, block)
+
+    if cryptor is not None:
+        if crypto_workers > 0 and not session:
+            # Encrypted by a pool of processes between the stream and the subsystem, rather than on the stream's thread
+            subsystem = ParallelMutatorSubsystem(subsystem, cryptor, crypto_workers)
+        else:
+            transmit_filter = CompositeMutator(transmit_filter, cryptor)
+
+    return Stream(subsystem, transmit_filter=transmit_filter, recv_filter=recv_filter,
+                  congestion_control=create_congestion_control(congestion),
+                  header_version=Packet.V1 if legacy_header else Packet.V2)
+
+
+def create_async_stream(subsystem: AsyncSubsystem, controller: ControllerModel, pub_key: str = None,
+                        priv_key: str = None, congestion: str = "reno", legacy_header: bool = False,
+                        session: bool = False, block: bool = False) -> AsyncStream:
+    transmit_filter, recv_filter, cryptor = create_filters(controller, pub_key, priv_key, session, block)
+
+    if cryptor is not None:
+        transmit_filter = CompositeMutator(transmit_filter, cryptor)
+
+    return AsyncStream(subsystem, transmit_filter=transmit_filter, recv_filter=recv_filter,
+                       congestion_control=create_congestion_control(congestion),
+                       header_version=Packet.V1 if legacy_header else Packet.V2)
+
+
+class RecvDelay:
+    """
+    The controller's recv_delay, shared by every session on the loop. It is read again only when the controller
+    pushes another configuration, so no session waits on the controller between reads.
+    """
+    # How long each wait for a pushed configuration lasts; the controller is polled this often if it cannot push
+    POLL_PERIOD = 1
+
+    def __init__(self, controller: ControllerModel):
+        self.controller = controller
+        self.delay = 0
+
+    async def follow(self):
+        version = None
+        stale = True
+
+        while True:
+            if stale:
+                self.delay = await asyncio.to_thread(self.controller.get_config, "recv_delay", 0)
+
+            current = await asyncio.to_thread(self.controller.wait_for_config, version, RecvDelay.POLL_PERIOD)
+            stale = current is None or current != version
+            version = current
+
+
+# A UDP sender has no connection to close, so its session ends once nothing has been received for this long
+UDP_SESSION_IDLE = 30
+
+
+async def receive_session(number: int, subsystem: AsyncSubsystem, directory: str, controller: ControllerModel,
+                          recv_delay: RecvDelay, args):
+    idle = UDP_SESSION_IDLE if args.udp else None
+
+    with FileSink(os.path.join(directory, f"session-{number}")) as sink:
+        try:
+            async with create_async_stream(subsystem, controller, args.pub_key, args.priv_key, args.congestion,
+                                           args.legacy_header, args.session, args.block) as stream:
+                while stream.is_open():
+                    try:
+                        data = await asyncio.wait_for(stream.read(1), idle)
+                    except asyncio.TimeoutError:
+                        break
+
+                    if data:
+                        sink.write_segments([data])
+
+                    if recv_delay.delay > 0:
+                        await asyncio.sleep(recv_delay.delay)
+        finally:
+            subsystem.close()
+            report(sink, number)
+
+
+async def serve_sessions(server, directory: str, controller: ControllerModel, args):
+    """
+    Receives from every sender which connects to the server, each in a session of its own written to a file in
+    directory. Every session is driven by the one event loop.
+    """
+    sessions: Set[asyncio.Task] = set()
+    recv_delay = RecvDelay(controller)
+    follower = asyncio.get_running_loop().create_task(recv_delay.follow())
+
+    try:
+        async with server as listener:
+            for number in itertools.count():
+                subsystem = await listener.accept()
+
+                task = asyncio.get_running_loop().create_task(
+                    receive_session(number, subsystem, directory, controller, recv_delay, args))
+                sessions.add(task)
+                task.add_done_callback(sessions.discard)
+    finally:
+        follower.cancel()
 
 
 def receiver_main():
@@ -49,6 +170,20 @@ def receiver_main():
         action='store_true'
     )
 
+    parser.add_argument(
+        "--datagram",
+        help="With --udp, carries each packet in a datagram of its own instead of framing packets as a byte "
+             "stream, so a lost datagram loses only its own packet. Both ends must agree.",
+        action='store_true'
+    )
+
+    parser.add_argument(
+        "--mtu",
+        help="MTU the datagrams of --datagram are sized to fit. By default, the MTU of the route to remote is "
+             "probed.",
+        type=int
+    )
+
     parser.add_argument(
         "--pub-key",
         help="Public key file to use for decrypting received data.",
@@ -61,30 +196,122 @@ def receiver_main():
         type=str
     )
 
+    parser.add_argument(
+        "--congestion",
+        help="Congestion control algorithm used to size the send window.",
+        choices=list(CONGESTION_CONTROLS.keys()),
+        default="reno"
+    )
+
+    parser.add_argument(
+        "--legacy-header",
+        help="Transmit the version 1 packet header, for remotes which predate 64 bit offsets.",
+        action='store_true'
+    )
+
+    parser.add_argument(
+        "--crypto-workers",
+        help="Number of processes encrypting transmitted packets with the private key. By default, packets are "
+             "encrypted on the stream's own thread. Cannot be used with --session.",
+        type=int,
+        default=0
+    )
+
+    parser.add_argument(
+        "--block",
+        help="Encrypts packets with the RSA keys in blocks the width of the modulus, so segments of any size can "
+             "be encrypted. Both ends must agree. Not used with --session.",
+        action='store_true'
+    )
+
+    parser.add_argument(
+        "--session",
+        help="Uses the RSA keys only to exchange a session key, then protects packets with a symmetric cipher. "
+             "Both ends must agree.",
+        action='store_true'
+    )
+
+    parser.add_argument(
+        "--output",
+        help="Writes received data to the specified file. Otherwise, if argument not specified, received data is "
+             "written to stdout.",
+        type=str
+    )
+
+    parser.add_argument(
+        "--sessions",
+        help="Serves any number of senders at once, writing the data received from each to its own file in the "
+             "specified directory.",
+        type=str
+    )
+
     args = parser.parse_args()
 
+    if not args.udp:
+        if args.datagram:
+            parser.error("--datagram requires --udp")
+
+        if args.mtu is not None:
+            parser.error("--mtu requires --udp")
+
+    if args.session and args.crypto_workers > 0:
+        parser.error("--crypto-workers cannot be used with --session")
+
+    # A UDP stream never sees an end of stream, so it is usually ended by a signal; exiting through SystemExit
+    # closes the sinks on the way out, which truncates their files to the data received
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(128 + signum))
+
     controller = ControllerModel(args.controller)
 
+    if args.sessions is not None:
+        if args.crypto_workers > 0:
+            parser.error("--crypto-workers cannot be used with --sessions")
+
+        if args.datagram:
+            parser.error("--datagram cannot be used with --sessions")
+
+        os.makedirs(args.sessions, exist_ok=True)
+        server = AsyncUdpServerMulti(args.port) if args.udp else AsyncTcpServerMulti(args.port)
+
+        try:
+            asyncio.run(serve_sessions(server, args.sessions, controller, args))
+        except KeyboardInterrupt:
+            pass
+
+        return
+
     if args.udp:
         server = UdpServerSingleRemote(
-            args.port
+            args.port,
+            args.datagram,
+            args.mtu
         )
     else:
         server = TcpServerSingleRemote(
             args.port
         )
 
-    with server as server_subsystem:
-        with create_stream(server_subsystem, controller, args.pub_key, args.priv_key) as server_stream:
-            while server_stream.is_open():
-                with os.fdopen(sys.stdout.fileno(), "wb", closefd=False) as stdout:
-                    stdout.write(server_stream.read(1))
-                    stdout.flush()
+    def apply_delay():
+        delay = controller.get_config("recv_delay", 0)
+
+        if delay > 0:
+            time.sleep(delay)
+
+    sink = FdSink(sys.stdout.fileno()) if args.output is None else FileSink(args.output)
+
+    with server as server_subsystem, sink:
+        try:
+            with create_stream(server_subsystem, controller, args.pub_key, args.priv_key, args.congestion,
+                               args.legacy_header, args.session, args.crypto_workers,
+                               args.block) as server_stream:
+                drain_to_sink(server_stream, sink, apply_delay)
+        finally:
+            report(sink)
 
-                    delay = controller.get_config("recv_delay", 0)
 
-                    if delay > 0:
-                        time.sleep(delay)
+def report(sink: Sink, session: Optional[int] = None):
+    prefix = "" if session is None else f"Session {session}: "
+    print(f"{prefix}Received {sink.bytes_written} bytes at {sink.throughput() / 1e6:.2f} MB/s", file=sys.stderr)
 
 
 if __name__ == "__main__":
@@ -1,13 +1,16 @@
 import itertools
 import math
 import random
+import secrets
 from argparse import ArgumentParser
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+from typing import List, Optional
 
 from egcd import egcd
 import json
 
 from .subsystem import Packet
-from .crypto import RsaCryptor, save_key
+from .crypto import RsaCryptor, save_key, CRT_FIELDS
 
 """
 The basis of encryption is a numeric operation that is easy in one direction,
@@ -201,21 +204,150 @@ def gen_prime(sz, additional_filter = None):
     return n
 
 
-def rsa_gen_key():
+def small_primes(limit: int) -> List[int]:
+    """
+    Primes below limit, by the sieve of Eratosthenes.
+    """
+    sieve = bytearray([1]) * limit
+    sieve[0:2] = b"\x00\x00"
+
+    for i in range(2, math.isqrt(limit - 1) + 1):
+        if sieve[i]:
+            sieve[i * i::i] = bytes(len(range(i * i, limit, i)))
+
+    return [i for i in range(limit) if sieve[i]]
+
+
+# Candidates divisible by any of these are eliminated by sieving, before the costlier Miller-Rabin test
+SMALL_PRIMES = small_primes(1 << 16)
+
+# Odd candidates examined per search window
+SEARCH_WINDOW = 4096
+
+# Each round passes a composite with probability at most 1/4, but random candidates of RSA sizes pass with far
+# lower probability (Damgard, Landrock and Pomerance); these counts keep the chance of accepting a composite
+# below 2^-100. Smaller candidates are given the worst case count.
+MILLER_RABIN_ROUNDS = ((1536, 4), (1024, 5), (512, 7), (0, 50))
+
+DEFAULT_KEY_BITS = 2048
+
+
+def is_probable_prime(n: int) -> bool:
+    """
+    Miller-Rabin probabilistic primality test, for odd n greater than the largest of SMALL_PRIMES.
+    """
+    rounds = next(count for bits, count in MILLER_RABIN_ROUNDS if n.bit_length() >= bits)
+    d = n - 1
+    s = 0
+
+    while d % 2 == 0:
+        d //= 2
+        s += 1
+
+    for _ in range(rounds):
+        x = pow(random.randrange(2, n - 1), d, n)
+
+        if x == 1 or x == n - 1:
+            continue
+
+        for _ in range(s - 1):
+            x = pow(x, 2, n)
+
+            if x == n - 1:
+                break
+        else:
+            return False
+
+    return True
+
+
+def search_prime(bits: int, e: int) -> Optional[int]:
+    """
+    Searches SEARCH_WINDOW odd numbers of 'bits' bits, from a random start, for a prime p with p - 1 coprime to
+    e. The two most significant bits are set, so the product of two such primes has exactly twice as many
+    bits. Returns None if the window holds no such prime.
+    """
+    start = secrets.randbits(bits) | (3 << (bits - 2)) | 1
+
+    # sieve[i] is cleared when start + 2i has a small prime factor
+    sieve = bytearray([1]) * SEARCH_WINDOW
+
+    for prime in itertools.islice(SMALL_PRIMES, 1, None):
+        # First i for which start + 2i is divisible by prime; 2 is invertible since prime is odd
+        first = (-start * pow(2, -1, prime)) % prime
+        sieve[first::prime] = bytes(len(range(first, SEARCH_WINDOW, prime)))
+
+    for i in itertools.compress(range(SEARCH_WINDOW), sieve):
+        candidate = start + 2 * i
+
+        if candidate.bit_length() == bits and math.gcd(e, candidate - 1) == 1 and is_probable_prime(candidate):
+            return candidate
+
+    return None
+
+
+def gen_primes(bits: int, count: int, e: int, workers: int = 1) -> List[int]:
+    """
+    Generates 'count' distinct primes of 'bits' bits, for which p - 1 is coprime to e. With more than one
+    worker, windows are searched in that many processes at once.
+    """
+    primes: List[int] = []
+
+    if workers <= 1:
+        while len(primes) < count:
+            prime = search_prime(bits, e)
+
+            if prime is not None and prime not in primes:
+                primes.append(prime)
+
+        return primes
+
+    executor = ProcessPoolExecutor(workers)
+
+    try:
+        pending = {executor.submit(search_prime, bits, e) for _ in range(workers)}
+
+        while len(primes) < count:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+
+            for future in done:
+                prime = future.result()
+
+                if prime is not None and prime not in primes:
+                    primes.append(prime)
+
+                pending.add(executor.submit(search_prime, bits, e))
+    finally:
+        # Searches still running are abandoned rather than waited for
+        executor.shutdown(wait=False, cancel_futures=True)
+
+    return primes[:count]
+
+
+def rsa_gen_key(bits: int = DEFAULT_KEY_BITS, workers: int = 1):
+    if bits < 64:
+        raise ValueError("Keys must be at least 64 bits")
+
     # e is explained in more detail later.
     e = 65537
 
-    def coprime_to_e(n):
-        return math.gcd(e, n + 1) == 1
-
-    p = gen_prime(100 + random.randint(0, 50), coprime_to_e)
-    q = gen_prime(110 + random.randint(0, 50), coprime_to_e)
+    # An odd size gives p the extra bit; with the top two bits of each prime set, n has exactly 'bits' bits
+    if bits % 2:
+        p = gen_primes(bits - bits // 2, 1, e, workers)[0]
+        q = gen_primes(bits // 2, 1, e, workers)[0]
+    else:
+        p, q = gen_primes(bits // 2, 2, e, workers)
     n = p * q
 
     phi_n = (p - 1) * (q - 1)
 
     d = egcd(e, phi_n)[1] % phi_n
 
+    # The private key operation is performed modulo p and q separately, see CrtRsaCryptor. Recombining the
+    # results requires p > q, with q's inverse modulo p
+    if p < q:
+        p, q = q, p
+
     public_key = {
         "k": e,
         "n": n
@@ -223,7 +355,12 @@ def rsa_gen_key():
 
     private_key = {
         "k": d,
-        "n": n
+        "n": n,
+        "p": p,
+        "q": q,
+        "dP": d % (p - 1),
+        "dQ": d % (q - 1),
+        "qInv": egcd(q, p)[1] % p
     }
 
     return public_key, private_key
@@ -245,10 +382,26 @@ def rsagen_main():
         description='Generates a public and private key file, and places them in the working "'
                     'directory ./private.key and ./public.key')
 
-    public, private = rsa_gen_key()
+    parser.add_argument(
+        "--bits",
+        help="Size of the modulus in bits.",
+        type=int,
+        default=DEFAULT_KEY_BITS
+    )
+
+    parser.add_argument(
+        "--workers",
+        help="Number of processes searching for primes.",
+        type=int,
+        default=1
+    )
+
+    args = parser.parse_args()
+
+    public, private = rsa_gen_key(args.bits, args.workers)
 
     save_key("public.key", public["k"], public["n"])
-    save_key("private.key", private["k"], private["n"])
+    save_key("private.key", private["k"], private["n"], **{field: private[field] for field in CRT_FIELDS})
 
 
 if __name__ == "__main__":
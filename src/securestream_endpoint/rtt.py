@@ -0,0 +1,38 @@
+from typing import Optional
+
+
+class RttEstimator:
+    """
+    Smoothed round-trip time and retransmission timeout estimator, following RFC 6298.
+    All values are in seconds.
+    """
+    ALPHA = 1 / 8
+    BETA = 1 / 4
+    K = 4
+
+    INITIAL_RTO = 1.0
+    MIN_RTO = 0.05
+    MAX_RTO = 60.0
+    CLOCK_GRANULARITY = 0.001
+
+    def __init__(self, initial_rto: float = INITIAL_RTO):
+        self.srtt: Optional[float] = None
+        self.rttvar: Optional[float] = None
+        self.rto = initial_rto
+
+    def sample(self, rtt: float):
+        rtt = max(rtt, 0.0)
+
+        if self.srtt is None:
+            self.srtt = rtt
+            self.rttvar = rtt / 2
+        else:
+            self.rttvar = (1 - RttEstimator.BETA) * self.rttvar + RttEstimator.BETA * abs(self.srtt - rtt)
+            self.srtt = (1 - RttEstimator.ALPHA) * self.srtt + RttEstimator.ALPHA * rtt
+
+        # A fresh sample also discards any exponential backoff applied by prior timeouts
+        rto = self.srtt + max(RttEstimator.CLOCK_GRANULARITY, RttEstimator.K * self.rttvar)
+        self.rto = min(max(rto, RttEstimator.MIN_RTO), RttEstimator.MAX_RTO)
+
+    def backoff(self):
+        self.rto = min(self.rto * 2, RttEstimator.MAX_RTO)
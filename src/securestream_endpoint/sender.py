@@ -1,11 +1,15 @@
+import mmap
+import os
 import sys
 from argparse import ArgumentParser
 
-from .crypto import build_cryptor
-from .subsystem import Subsystem
+from .crypto import build_encryptor, build_decryptor
+from .subsystem import Subsystem, Packet, SubsystemClosedException
 from .udp import UdpClient
 from .tcp import TcpClient
 from .model.controller import ControllerModel
+from .congestion import CONGESTION_CONTROLS, create_congestion_control
+from .parallel import ParallelMutatorSubsystem
 from .stream import Stream, StatsRelay, CompositeMutator
 
 
@@ -20,23 +24,88 @@ def transmit_file(stream: Stream, file: str):
             stream.write(rbuffer)
 
 
+# Acknowledged data is dropped from the mapping once this much of it has accumulated
+MMAP_RELEASE_SIZE = 4 * 1024 * 1024
+
+
+def transmit_file_mmap(stream: Stream, file: str) -> bool:
+    """
+    Transmits a file from a read only mapping of it. Segments are views of the mapping, so data is only
+    copied by the socket, or by a mutator which rewrites it. Pages remote has acknowledged are released as
+    transmission proceeds, so memory use does not grow with the size of the file.
+
+    Returns whether remote acknowledged the whole file. If not, the stream has been aborted, discarding the
+    segments which refer to the mapping.
+    """
+    with open(file, "rb") as f:
+        size = os.fstat(f.fileno()).st_size
+
+        if size == 0:
+            return True
+
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mapping:
+            if hasattr(mmap, "MADV_SEQUENTIAL"):
+                mapping.madvise(mmap.MADV_SEQUENTIAL)
+
+            view = memoryview(mapping)
+            segment_size = stream.get_preferred_segment_size()
+            first_segment = stream.segments_written
+            released = 0
+            drained = False
+
+            try:
+                for offset in range(0, size, segment_size):
+                    stream.write(view[offset:offset + segment_size])
+
+                    acknowledged = (stream.segments_acknowledged - first_segment) * segment_size
+                    acknowledged -= acknowledged % mmap.PAGESIZE
+
+                    if hasattr(mmap, "MADV_DONTNEED") and acknowledged - released >= MMAP_RELEASE_SIZE:
+                        mapping.madvise(mmap.MADV_DONTNEED, released, acknowledged - released)
+                        released = acknowledged
+
+                # Segments still pending retransmission refer to the mapping, so it must outlive them
+                drained = stream.drain()
+            except SubsystemClosedException:
+                # Handled here, as the traceback would keep views of the mapping alive until it closed
+                pass
+            finally:
+                # Otherwise the segments are discarded, as the mapping cannot be closed while they refer to it
+                if not drained:
+                    stream.abort()
+
+                view.release()
+
+    return drained
+
+
 def transmit_stdin(stream: Stream):
     for l in sys.stdin:
         print("Writing: " + l)
         stream.write(l.encode("utf-8"))
 
 
-def create_stream(subsystem: Subsystem, controller: ControllerModel, pub_key: str = None, priv_key: str = None):
+def create_stream(subsystem: Subsystem, controller: ControllerModel, pub_key: str = None, priv_key: str = None,
+                  congestion: str = "reno", legacy_header: bool = False, session: bool = False,
+                  crypto_workers: int = 0, block: bool = False):
     send_stat = StatsRelay("client_sent", controller)
     recv_stat = StatsRelay("client_recv", controller)
 
     if pub_key:
-        recv_stat = CompositeMutator(build_cryptor(pub_key), recv_stat)
+        recv_stat = CompositeMutator(build_decryptor(pub_key, session, block), recv_stat)
 
     if priv_key:
-        send_stat = CompositeMutator(send_stat, build_cryptor(priv_key))
+        cryptor = build_encryptor(priv_key, session, block)
 
-    return Stream(subsystem, transmit_filter=send_stat, recv_filter=recv_stat)
+        if crypto_workers > 0 and not session:
+            # Encrypted by a pool of processes between the stream and the subsystem, rather than on the stream's thread
+            subsystem = ParallelMutatorSubsystem(subsystem, cryptor, crypto_workers)
+        else:
+            send_stat = CompositeMutator(send_stat, cryptor)
+
+    return Stream(subsystem, transmit_filter=send_stat, recv_filter=recv_stat,
+                  congestion_control=create_congestion_control(congestion),
+                  header_version=Packet.V1 if legacy_header else Packet.V2)
 
 
 def sender_main():
@@ -65,6 +134,13 @@ def sender_main():
         type=str
     )
 
+    parser.add_argument(
+        "--mmap",
+        help="Transmits the file specified by --file from a memory mapping of it, rather than reading it into "
+             "memory a segment at a time.",
+        action='store_true'
+    )
+
     parser.add_argument(
         "--controller",
         help="URL to the controller in the form of http://<host>:port",
@@ -78,6 +154,20 @@ def sender_main():
         action='store_true'
     )
 
+    parser.add_argument(
+        "--datagram",
+        help="With --udp, carries each packet in a datagram of its own instead of framing packets as a byte "
+             "stream, so a lost datagram loses only its own packet. Both ends must agree.",
+        action='store_true'
+    )
+
+    parser.add_argument(
+        "--mtu",
+        help="MTU the datagrams of --datagram are sized to fit. By default, the MTU of the route to remote is "
+             "probed.",
+        type=int
+    )
+
     parser.add_argument(
         "--pub-key",
         help="Public key file to use for decrypting received data.",
@@ -90,14 +180,61 @@ def sender_main():
         type=str
     )
 
+    parser.add_argument(
+        "--congestion",
+        help="Congestion control algorithm used to size the send window.",
+        choices=list(CONGESTION_CONTROLS.keys()),
+        default="reno"
+    )
+
+    parser.add_argument(
+        "--legacy-header",
+        help="Transmit the version 1 packet header, for remotes which predate 64 bit offsets.",
+        action='store_true'
+    )
+
+    parser.add_argument(
+        "--crypto-workers",
+        help="Number of processes encrypting transmitted packets with the private key. By default, packets are "
+             "encrypted on the stream's own thread. Cannot be used with --session.",
+        type=int,
+        default=0
+    )
+
+    parser.add_argument(
+        "--block",
+        help="Encrypts packets with the RSA keys in blocks the width of the modulus, so segments of any size can "
+             "be encrypted. Both ends must agree. Not used with --session.",
+        action='store_true'
+    )
+
+    parser.add_argument(
+        "--session",
+        help="Uses the RSA keys only to exchange a session key, then protects packets with a symmetric cipher. "
+             "Both ends must agree.",
+        action='store_true'
+    )
+
     args = parser.parse_args()
 
+    if not args.udp:
+        if args.datagram:
+            parser.error("--datagram requires --udp")
+
+        if args.mtu is not None:
+            parser.error("--mtu requires --udp")
+
+    if args.session and args.crypto_workers > 0:
+        parser.error("--crypto-workers cannot be used with --session")
+
     controller = ControllerModel(args.controller)
 
     if args.udp:
         client = UdpClient(
             args.target,
-            args.target_port
+            args.target_port,
+            args.datagram,
+            args.mtu
         )
     else:
         client = TcpClient(
@@ -106,12 +243,27 @@ def sender_main():
         )
 
     with client as client_subsystem:
-        with create_stream(client_subsystem, controller, args.pub_key, args.priv_key) as client_stream:
-            if args.file:
-                transmit_file(client_stream, args.file)
-            else:
-                transmit_stdin(client_stream)
+        with create_stream(client_subsystem, controller, args.pub_key, args.priv_key, args.congestion,
+                           args.legacy_header, args.session, args.crypto_workers,
+                           args.block) as client_stream:
+            try:
+                if args.file and args.mmap:
+                    complete = transmit_file_mmap(client_stream, args.file)
+                else:
+                    if args.file:
+                        transmit_file(client_stream, args.file)
+                    else:
+                        transmit_stdin(client_stream)
+
+                    # Closing stops retransmission, so wait for remote to have everything before it sees the end
+                    # of stream
+                    complete = client_stream.drain()
+            except SubsystemClosedException:
+                complete = False
 
+            if not complete:
+                print("Transmission failed; remote did not acknowledge everything written", file=sys.stderr)
+                sys.exit(1)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,166 @@
+import fcntl
+import os
+import stat
+import time
+from typing import List, Union, Optional
+
+from .stream import Stream
+
+Segment = Union[bytes, memoryview]
+
+# Most segments a single writev may be given
+IOV_MAX = os.sysconf("SC_IOV_MAX") if "SC_IOV_MAX" in os.sysconf_names else 1024
+
+
+class Sink:
+    """
+    Destination for data drained from a stream. Segments are written as a batch, without joining them first.
+    """
+
+    # Bytes collected from the stream per batch, unless the destination suggests otherwise
+    BATCH_SIZE = 1024 * 1024
+
+    def __init__(self):
+        self.bytes_written = 0
+        self.first_write: Optional[float] = None
+        self.last_write: Optional[float] = None
+
+    def batch_size(self) -> int:
+        return Sink.BATCH_SIZE
+
+    def write_segments(self, segments: List[Segment]):
+        if self.first_write is None:
+            self.first_write = time.time()
+
+        self.bytes_written += self.write_batch(segments)
+        self.last_write = time.time()
+
+    def write_batch(self, segments: List[Segment]) -> int:
+        """
+        Writes every segment, returning the number of bytes written. Overridden by each destination.
+        """
+        return 0
+
+    def throughput(self) -> float:
+        """
+        Sustained rate in bytes per second, from the first write to the last.
+        """
+        if self.first_write is None or self.last_write <= self.first_write:
+            return 0.0
+
+        return self.bytes_written / (self.last_write - self.first_write)
+
+    def close(self):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, traceback):
+        self.close()
+
+
+def write_all(write, segments: List[Segment]) -> int:
+    """
+    Calls write (a writev style function returning the number of bytes written) until every segment has been
+    written, at most IOV_MAX segments at a time.
+    """
+    total = sum(len(s) for s in segments)
+    remaining = total
+    segments = [memoryview(s) for s in segments]
+    start = 0
+
+    while remaining > 0:
+        written = write(segments[start:start + IOV_MAX], total - remaining)
+        remaining -= written
+
+        # Skip what was written, resuming part way through a segment if the write was short
+        while written > 0:
+            if written >= len(segments[start]):
+                written -= len(segments[start])
+                start += 1
+            else:
+                segments[start] = segments[start][written:]
+                written = 0
+
+    return total
+
+
+class FdSink(Sink):
+    """
+    Writes to an already open file descriptor, such as stdout, gathering each batch into writev calls. Pipes
+    are written a pipe buffer at a time, so the reader is woken as each fills.
+    """
+
+    def __init__(self, fd: int):
+        super().__init__()
+        self.fd = fd
+        self.pipe_size: Optional[int] = None
+
+        if stat.S_ISFIFO(os.fstat(fd).st_mode) and hasattr(fcntl, "F_GETPIPE_SZ"):
+            self.pipe_size = fcntl.fcntl(fd, fcntl.F_GETPIPE_SZ)
+
+    def batch_size(self) -> int:
+        return Sink.BATCH_SIZE if self.pipe_size is None else self.pipe_size
+
+    def write_batch(self, segments: List[Segment]) -> int:
+        return write_all(lambda iov, offset: os.writev(self.fd, iov), segments)
+
+
+class FileSink(Sink):
+    """
+    Writes to a file at known offsets with pwritev. Space is reserved ahead of the data with posix_fallocate,
+    PREALLOCATE_SIZE at a time, so the file system can lay the file out contiguously; the file is truncated to
+    the data received when the sink is closed.
+    """
+    PREALLOCATE_SIZE = 64 * 1024 * 1024
+
+    def __init__(self, path: str):
+        super().__init__()
+        self.fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+        self.allocated = 0
+        self.preallocate = hasattr(os, "posix_fallocate")
+
+    def reserve(self, size: int):
+        if not self.preallocate or size <= self.allocated:
+            return
+
+        length = max(size - self.allocated, FileSink.PREALLOCATE_SIZE)
+
+        try:
+            os.posix_fallocate(self.fd, self.allocated, length)
+            self.allocated += length
+        except OSError:
+            # Not supported by the file system; writes extend the file instead
+            self.preallocate = False
+
+    def write_batch(self, segments: List[Segment]) -> int:
+        self.reserve(self.bytes_written + sum(len(s) for s in segments))
+
+        if hasattr(os, "pwritev"):
+            return write_all(lambda iov, offset: os.pwritev(self.fd, iov, self.bytes_written + offset), segments)
+
+        return write_all(lambda iov, offset: os.pwrite(self.fd, iov[0], self.bytes_written + offset), segments)
+
+    def close(self):
+        if self.fd is None:
+            return
+
+        os.ftruncate(self.fd, self.bytes_written)
+        os.close(self.fd)
+        self.fd = None
+
+
+def drain_to_sink(stream: Stream, sink: Sink, on_batch=None):
+    """
+    Writes everything received on the stream to the sink until the stream ends. on_batch, if given, is
+    called after each batch is written.
+    """
+    while stream.is_open():
+        segments = stream.read_segments(sink.batch_size())
+
+        if segments:
+            sink.write_segments(segments)
+
+        if on_batch is not None:
+            on_batch()
@@ -1,17 +1,64 @@
+import heapq
+import itertools
 import math
 import queue
 import random
+import selectors
+import socket
 import threading
 from queue import Queue, Empty
 import time
-from typing import Optional, Callable, List, Tuple, Dict
+from collections import deque
+from typing import Optional, Callable, List, Tuple, Dict, Deque, Iterator, Union, Set
 
 from .model.controller import ControllerModel
-from .subsystem import Subsystem, SubsystemClosedException, Packet
+from .options import PacketOption, encode_options, decode_options, encode_sack, decode_sack, encode_timestamp, \
+    decode_timestamp
+from .rtt import RttEstimator
+from .ack import AckPolicy
+from .congestion import CongestionControl, RenoCongestionControl
+from .window import RangeSet, WindowEstimator
+from .subsystem import Subsystem, SubsystemClosedException, Packet, DATA_PACKET_OVERHEAD
+from .impairment import Impairment
 
 PacketMutator = Callable[['Packet'], Optional['Packet']]
 
 
+def mutator_overhead(mutator: PacketMutator, size: int) -> int:
+    """
+    Returns the most mutator may grow a packet of size bytes. Mutators which grow packets report it from an
+    overhead method; any other mutator is taken to leave the size of packets alone.
+    """
+    overhead = getattr(mutator, "overhead", None)
+
+    return 0 if overhead is None else overhead(size)
+
+
+def fit_segment_size(limit: int, mutator: Optional[PacketMutator]) -> int:
+    """
+    Returns the largest segment size, up to limit, for which a data packet is no larger once mutated than an
+    unmutated data packet carrying limit bytes of data.
+    """
+    budget = limit + DATA_PACKET_OVERHEAD
+
+    if mutator is None or mutator_overhead(mutator, budget) == 0:
+        return limit
+
+    # Mutated packets grow with the packet, so the largest segment which fits is found by bisection
+    low, high = 0, limit
+
+    while low < high:
+        size = (low + high + 1) // 2
+        packet = size + DATA_PACKET_OVERHEAD
+
+        if packet + mutator_overhead(mutator, packet) <= budget:
+            low = size
+        else:
+            high = size - 1
+
+    return low
+
+
 class CompositeMutator(PacketMutator):
 
     def __init__(self, first: PacketMutator, last: PacketMutator):
@@ -26,6 +73,11 @@ class CompositeMutator(PacketMutator):
 
         return f
 
+    def overhead(self, size: int) -> int:
+        first = mutator_overhead(self.first, size)
+
+        return first + mutator_overhead(self.last, size + first)
+
 
 
 class StatsRelay(PacketMutator):
@@ -55,43 +107,85 @@ class RandomDropMutator(PacketMutator):
         return None if random.random() <= self.chance else packet
 
 
-class StreamWorker(threading.Thread):
+class StreamEngine:
+    """
+    The stream protocol state machine. The engine performs no blocking operations itself; a driver
+    (see StreamWorker and AsyncStream) invokes it whenever packets arrive, data is queued or a timer expires.
+    """
     MAX_RECV = 100
-    MAX_WINDOW_SIZE = 10
     RECV_WINDOW_HINT_SIZE = 3
+    MAX_SACK_BLOCKS = 4
+
+    # Number of selectively acknowledged segments past a hole before it is considered lost
+    DUPLICATE_THRESHOLD = 3
 
     # We will cease transmitting for a maximum of half a second
     MAX_BACKOFF_PERIOD = 3
 
     def __init__(self, subsystem: Subsystem, data_in: Queue[bytes], data_out: Queue[bytes],
                  recv_filter: PacketMutator = None, transmit_filter: PacketMutator = None,
-                 ack_timeout=2):
-        super().__init__()
-
-        self.recv_window: Dict[int, bytes] = {}
-        self.window_size = 2
-        self.ack_timeout = ack_timeout
+                 initial_rto=RttEstimator.INITIAL_RTO, sack=True, congestion_control: CongestionControl = None,
+                 header_version: int = Packet.V2, ack_policy: AckPolicy = None):
+        self.recv_window: Dict[int, Optional[bytes]] = {}
+        self.recv_ranges = RangeSet()
+        self.congestion = RenoCongestionControl() if congestion_control is None else congestion_control
+        self.rtt = RttEstimator(initial_rto)
         self.recv_filter = recv_filter
         self.transmit_filter = transmit_filter
         self.subsystem = subsystem
         self.data_in = data_in
         self.data_out = data_out
 
-        self.stop_event = threading.Event()
-
         self.max_remote_read_offset = 0
 
         self.local_read_offset = 0
         self.local_write_offset = 0
 
+        # Write offsets of the end of stream markers, once this end has queued one (as None, in data_in) or remote's
+        # has been received
+        self.local_end: Optional[int] = None
+        self.remote_end: Optional[int] = None
+
+        # Notified whenever remote acknowledges more of the stream, and once the engine has stopped
+        self.acked = threading.Condition()
+        self.stopped = False
+
         self.last_write_ack = time.time() #The last time our write was acked
-        self.pending: List[Tuple[int, Packet]] = []
-        self.recv_window_size_hint = []
+
+        # Unacknowledged segments by write offset, in order; the offsets run contiguously up to local_write_offset
+        self.pending: Dict[int, Packet] = {}
+        self.recv_window_size_hint = WindowEstimator(StreamEngine.RECV_WINDOW_HINT_SIZE)
 
         self.backoff_since = 0
 
-    def stop(self):
-        self.stop_event.set()
+        # Selective acknowledgement is only used for retransmission once remote has advertised it
+        self.sack_enabled = sack
+        self.sack_permitted = False
+        self.sacked = RangeSet()
+        self.recovery_point = 0
+
+        # Segments in [retransmit_next, retransmit_end) which remote has not selectively acknowledged are
+        # considered lost, and are retransmitted ahead of new data as the window allows
+        self.retransmit_next: Optional[int] = None
+        self.retransmit_end = 0
+
+        # Whether remote understands packet options, in which case data packets carry a timestamp
+        self.remote_options = False
+        self.ts_recent = 0
+
+        # Either header version is accepted from remote; this selects the one transmitted
+        self.header_version = header_version
+
+        # First transmission time of segments which have not been retransmitted (Karn's rule)
+        self.transmit_times: Dict[int, float] = {}
+
+        # Received segments not yet acknowledged. Acks are sent once ack_due is set, or at ack_deadline, unless a
+        # data packet (which carries the cumulative acknowledgement) is transmitted first
+        self.ack_policy = AckPolicy() if ack_policy is None else ack_policy
+        self.unacked_segments = 0
+        self.ack_due = False
+        self.ack_deadline: Optional[float] = None
+        self.ack_latest = 0
 
     def write_raw(self, data: Packet):
         packet = self.transmit_filter(data)
@@ -100,16 +194,145 @@ class StreamWorker(threading.Thread):
 
         self.subsystem.send(packet)
 
-    def clean_pending(self):
-        while self.pending and self.pending[0][0] <= self.max_remote_read_offset:
-            self.pending = self.pending[1:]
-            self.last_write_ack = time.time()
+    def clean_pending(self) -> Optional[float]:
+        """
+        Removes acknowledged segments from the pending list. Returns the time the most recently acknowledged
+        segment was transmitted, if that segment was never retransmitted.
+        """
+        sent_at = None
+        first = self.local_write_offset - len(self.pending)
+
+        if not self.pending or first >= self.max_remote_read_offset:
+            return sent_at
+
+        for offset in range(first, min(self.max_remote_read_offset, self.local_write_offset)):
+            del self.pending[offset]
+            sent_at = self.transmit_times.pop(offset, None)
+
+        self.sacked.discard_below(self.max_remote_read_offset)
+        self.last_write_ack = time.time()
+
+        return sent_at
+
+    def process_options(self, packet: Packet, acked: bool) -> bool:
+        """
+        Applies the options carried by a packet. Returns whether a timestamp echo produced an RTT sample.
+        """
+        options = decode_options(packet.get_options() or bytes())
+        sampled = False
+
+        if not options:
+            return sampled
+
+        self.remote_options = True
+
+        if PacketOption.FIN in options and not packet.is_ack():
+            self.remote_end = packet.write_offset
+
+        if PacketOption.TIMESTAMP in options:
+            timestamp = decode_timestamp(options[PacketOption.TIMESTAMP])
+
+            if timestamp is not None:
+                value, echo = timestamp
+
+                if not packet.is_ack():
+                    self.ts_recent = value
+
+                # Echoed timestamps identify the exact transmission, so unlike Karn's rule they
+                # also produce valid samples for retransmitted segments
+                if acked and echo > 0:
+                    self.rtt.sample(time.time() - echo / 1e6)
+                    sampled = True
+
+        if packet.is_ack() and PacketOption.SACK in options and self.sack_enabled:
+            blocks = decode_sack(options[PacketOption.SACK])
+
+            if blocks is not None:
+                self.sack_permitted = True
+
+                for start, end in blocks:
+                    self.sacked.add(max(start, self.max_remote_read_offset), min(end, self.local_write_offset))
+
+        return sampled
+
+    def detect_loss(self):
+        # A hole is lost once DUPLICATE_THRESHOLD segments above it have been selectively acknowledged, so
+        # every hole below the DUPLICATE_THRESHOLD-th highest of them is
+        lost_end = self.sacked.nth_highest(StreamEngine.DUPLICATE_THRESHOLD)
+
+        if lost_end is None or self.sacked.next_absent(self.max_remote_read_offset) >= lost_end:
+            return
+
+        # Only react to one loss per window of data; holes found lost during recovery are still retransmitted
+        if self.max_remote_read_offset < self.recovery_point:
+            if lost_end > self.retransmit_end:
+                if self.retransmit_next is None:
+                    self.retransmit_next = max(self.retransmit_end, self.max_remote_read_offset)
+
+                self.retransmit_end = lost_end
+
+            return
+
+        self.recovery_point = self.local_write_offset
+        self.congestion.on_loss()
+
+        self.start_retransmit(lost_end)
+        self.last_write_ack = time.time()
+
+    def sack_blocks(self, latest: int) -> List[Tuple[int, int]]:
+        blocks = self.recv_ranges.ranges()
+
+        # The block holding the most recently received segment is reported first, so remote
+        # learns about the newest arrival even if the remaining blocks do not fit
+        blocks.sort(key=lambda b: not b[0] <= latest < b[1])
+
+        return blocks[:StreamEngine.MAX_SACK_BLOCKS]
+
+    def create_timestamp(self) -> bytes:
+        return encode_timestamp(int(time.time() * 1e6), self.ts_recent)
+
+    def create_packet(self, write_offset: int, data: bytes) -> Packet:
+        options = {}
+
+        if self.remote_options:
+            options[PacketOption.TIMESTAMP] = self.create_timestamp()
+
+        if write_offset == self.local_end:
+            options[PacketOption.FIN] = bytes()
+
+        # Data packets carry the cumulative acknowledgement, so any outstanding ack rides along with this one
+        self.ack_sent()
+
+        return Packet(self.local_read_offset, write_offset, self.data_out.maxsize - self.data_out.qsize(), data,
+                      encode_options(options) if options else None, self.header_version)
+
+    def send_ack(self, latest: int):
+        self.ack_sent()
+        self.write_raw(self.create_ack(latest))
+
+    def ack_sent(self):
+        self.unacked_segments = 0
+        self.ack_due = False
+        self.ack_deadline = None
+
+    def try_send_ack(self):
+        if self.ack_due or (self.ack_deadline is not None and self.ack_deadline <= time.time()):
+            self.send_ack(self.ack_latest)
+
+    def create_ack(self, latest: int) -> Packet:
+        options = {PacketOption.TIMESTAMP: self.create_timestamp()}
+
+        if self.sack_enabled:
+            options[PacketOption.SACK] = encode_sack(self.sack_blocks(latest))
+
+        return Packet.ack(self.local_read_offset, self.data_out.maxsize - self.data_out.qsize(), encode_options(options),
+                          self.header_version)
 
     def approximate_remote_window_size(self):
-        if len(self.recv_window_size_hint) == 0:
-            return 1
+        r = self.recv_window_size_hint.estimate()
 
-        r = math.floor(sum(self.recv_window_size_hint) / len(self.recv_window_size_hint))
+        if r is None:
+            return 1
 
         if r == 0:
             if self.backoff_since == 0:
@@ -119,198 +342,950 @@ class StreamWorker(threading.Thread):
 
         return r
 
-    def try_receive(self):
+    def try_receive(self) -> bool:
+        """
+        Processes received packets. Returns True if the limit was reached and more packets may be waiting.
+        """
+        received = 0
+
         # Limit packet processing so we don't starve the logic loop
-        for _ in range(StreamWorker.MAX_RECV):
-            packet = self.subsystem.recv()
+        while received < StreamEngine.MAX_RECV:
+            packets = self.subsystem.recv_many(0)
 
-            if packet is None:
-                break
+            if not packets:
+                return False
 
-            packet = self.recv_filter(packet)
+            for packet in packets:
+                self.receive_packet(packet)
 
-            if packet is None:
-                continue
+            received += len(packets)
 
-            self.max_remote_read_offset = max(packet.read_offset, self.max_remote_read_offset)
-            self.clean_pending()
+        return True
 
-            self.recv_window_size_hint = [self.recv_window_size_hint + [packet.recv_window_size]][:-StreamWorker.RECV_WINDOW_HINT_SIZE]
+    def receive_packet(self, packet: Packet):
+        packet = self.recv_filter(packet)
 
-            if packet.write_offset >= self.local_read_offset and packet.write_offset not in self.recv_window:
-                self.recv_window[packet.write_offset] = packet.data
+        if packet is None:
+            return
 
-                try:
-                    while self.local_read_offset in self.recv_window:
-                        src = self.recv_window[self.local_read_offset]
-                        self.data_out.put(src)
-                        del(self.recv_window[self.local_read_offset])
-                        self.local_read_offset += 1
-                except queue.Full:
-                    pass
+        newly_acked = max(packet.read_offset - self.max_remote_read_offset, 0)
+        acked = newly_acked > 0
+
+        if acked:
+            with self.acked:
+                self.max_remote_read_offset = packet.read_offset
+                self.acked.notify_all()
+
+        sampled = self.process_options(packet, acked)
+        sent_at = self.clean_pending()
+
+        # Fall back to Karn's rule when remote does not echo timestamps
+        if sent_at is not None and not sampled:
+            self.rtt.sample(time.time() - sent_at)
+
+        if acked:
+            self.congestion.on_ack(newly_acked, self.rtt.srtt)
+
+        if packet.is_ack() and self.sack_permitted:
+            self.detect_loss()
+
+        self.recv_window_size_hint.add(packet.recv_window_size)
+
+        # Segments which arrive out of order, fill a hole or were already received are reported immediately
+        in_order = packet.write_offset == self.local_read_offset and not self.recv_ranges
+        quick = packet.write_offset < self.ack_policy.quick
+
+        if packet.write_offset >= self.local_read_offset and packet.write_offset not in self.recv_window:
+            # Remote's end of stream marker is delivered to the application as None, once everything before it
+            self.recv_window[packet.write_offset] = None if packet.write_offset == self.remote_end else packet.data
+            self.recv_ranges.add(packet.write_offset, packet.write_offset + 1)
+            self.deliver()
+
+        # If the packet was not just an ack (IE transmitted data)
+        # then we want to either acknowledge that data or let remote know what is missing
+        if packet.write_offset >= 0:
+            # Whether we accept the transmission or not, we should let remote know
+            # what is expected next (in the event of a wrong transmission) or that
+            # the prior transmission was acknowledged
+            self.ack_latest = packet.write_offset
 
+            if not in_order or quick:
+                self.send_ack(packet.write_offset)
+                return
 
-            # If the packet was not just an ack (IE transmitted data)
-            # then we want to either acknowledge that data or let remote know what is missing
-            if packet.write_offset >= 0:
-                # Whether we accept the transmission or not, we should let remote know
-                # what is expected next (in the event of a wrong transmission) or that
-                # the prior transmission was acknowledged
-                self.write_raw(Packet.ack(self.local_read_offset, self.data_out.maxsize - self.data_out.qsize()))
+            self.unacked_segments += 1
 
-    def transmit_pending(self):
-        self.clean_pending()
+            # In-order segments are acknowledged together once the batch they arrived in is processed
+            if self.unacked_segments >= self.ack_policy.segments:
+                self.ack_due = True
+            elif self.ack_deadline is None:
+                self.ack_deadline = time.time() + self.ack_policy.delay
 
-        if not self.pending:
+    def deliver(self):
+        """
+        Moves in-order segments from the receive window to the application. Segments which do not fit
+        are held in the receive window until the application has read enough to make room for them.
+        """
+        try:
+            while self.local_read_offset in self.recv_window:
+                src = self.recv_window[self.local_read_offset]
+                self.data_out.put_nowait(src)
+                del(self.recv_window[self.local_read_offset])
+                self.local_read_offset += 1
+        except queue.Full:
+            pass
+
+        self.recv_ranges.discard_below(self.local_read_offset)
+
+    def start_retransmit(self, end: int):
+        self.retransmit_next = self.max_remote_read_offset
+        self.retransmit_end = end
+
+    def in_flight(self) -> int:
+        """
+        Number of pending segments believed to still be in the network; those neither selectively
+        acknowledged nor awaiting retransmission.
+        """
+        lost = 0
+
+        if self.retransmit_next is not None:
+            start = max(self.retransmit_next, self.max_remote_read_offset)
+            lost = max(self.retransmit_end - start, 0) - self.sacked.count_between(start, self.retransmit_end)
+
+        return len(self.pending) - len(self.sacked) - lost
+
+    def retransmit_next_lost(self):
+        # Segments remote has selectively acknowledged are already held in its receive window
+        offset = self.sacked.next_absent(max(self.retransmit_next, self.max_remote_read_offset))
+
+        if offset >= min(self.retransmit_end, self.local_write_offset):
+            self.retransmit_next = None
             return
 
-        for i in range(min(len(self.pending), self.window_size, self.approximate_remote_window_size())):
-            p = self.pending[i]
-            next_packet = Packet(self.local_read_offset, p[1].write_offset, self.data_out.maxsize - self.data_out.qsize(), p[1].data)
-            self.write_raw(next_packet)
+        p = self.pending[offset]
+        self.transmit_times.pop(offset, None)
+        self.write_raw(self.create_packet(offset, p.data))
+        self.retransmit_next = offset + 1
 
     def try_transmit(self):
-        if self.pending and self.last_write_ack + self.ack_timeout < time.time():
+        if self.pending and self.last_write_ack + self.rtt.rto <= time.time():
             self.last_write_ack = time.time()
-            self.transmit_pending()
-            self.window_size = 1
+            self.congestion.on_timeout()
+            self.rtt.backoff()
+            self.start_retransmit(self.local_write_offset)
+
+        while self.in_flight() < min(self.approximate_remote_window_size(), self.congestion.window()):
+            if self.retransmit_next is not None:
+                self.retransmit_next_lost()
+                continue
+
+            # New data must also fit in remote's receive window beyond the cumulative acknowledgement
+            if len(self.pending) >= self.approximate_remote_window_size():
+                break
 
-        if len(self.pending) < min(self.approximate_remote_window_size(), self.window_size):
             try:
                 data_in = self.data_in.get(block=False)
 
-                new_packet = Packet(self.local_read_offset, self.local_write_offset, self.data_out.maxsize - self.data_out.qsize(), data_in)
+                if data_in is None:
+                    self.local_end = self.local_write_offset
+                    data_in = bytes()
+
+                new_packet = self.create_packet(self.local_write_offset, data_in)
+                self.transmit_times[self.local_write_offset] = time.time()
+                self.pending[self.local_write_offset] = new_packet
                 self.local_write_offset += 1
-                self.pending.append((self.local_write_offset, new_packet))
                 self.last_write_ack = time.time()
                 self.write_raw(new_packet)
-
-                self.window_size = min(self.window_size + 1, StreamWorker.MAX_WINDOW_SIZE)
             except Empty:
-                pass
+                break
+
+        self.try_send_ack()
 
     def try_restore_backoff(self):
-        if self.backoff_since > 0 and self.backoff_since + StreamWorker.MAX_BACKOFF_PERIOD < time.time():
+        if self.backoff_since > 0 and self.backoff_since + StreamEngine.MAX_BACKOFF_PERIOD <= time.time():
             if self.approximate_remote_window_size() == 0:
-                self.recv_window_size_hint = [1]
+                self.recv_window_size_hint.reset(1)
+
+    def stop_notify(self):
+        """
+        Marks the engine stopped, waking the threads waiting for acknowledgements.
+        """
+        with self.acked:
+            self.stopped = True
+            self.acked.notify_all()
+
+    def next_timeout(self) -> Optional[float]:
+        """
+        Time until the next timer (retransmission, delayed ack or window backoff) expires, or None if no timer
+        is armed.
+        """
+        deadlines = []
+
+        if self.ack_due:
+            deadlines.append(0)
+
+        if self.ack_deadline is not None:
+            deadlines.append(self.ack_deadline)
+
+        if self.pending:
+            deadlines.append(self.last_write_ack + self.rtt.rto)
+
+        if self.backoff_since > 0:
+            deadlines.append(self.backoff_since + StreamEngine.MAX_BACKOFF_PERIOD)
+
+        if not deadlines:
+            return None
+
+        return max(min(deadlines) - time.time(), 0)
+
+
+class StreamWorker(StreamEngine, threading.Thread):
+    # How often to check whether a subsystem without a socket (IE awaiting a connection) has been attached
+    ATTACH_POLL_PERIOD = 0.1
+
+    def __init__(self, subsystem: Subsystem, data_in: Queue[bytes], data_out: Queue[bytes],
+                 recv_filter: PacketMutator = None, transmit_filter: PacketMutator = None,
+                 initial_rto=RttEstimator.INITIAL_RTO, sack=True, congestion_control: CongestionControl = None,
+                 header_version: int = Packet.V2, ack_policy: AckPolicy = None):
+        threading.Thread.__init__(self)
+        StreamEngine.__init__(self, subsystem, data_in, data_out, recv_filter, transmit_filter,
+                              initial_rto, sack, congestion_control, header_version, ack_policy)
+
+        self.stop_event = threading.Event()
+
+        # Written to whenever there is new work for the worker which does not arrive on the subsystem socket
+        self.wakeup_recv, self.wakeup_send = socket.socketpair()
+        self.wakeup_recv.setblocking(False)
+        self.wakeup_send.setblocking(False)
+
+    def stop(self):
+        self.stop_event.set()
+        self.notify()
+
+    def notify(self):
+        try:
+            self.wakeup_send.send(b'\0')
+        except OSError:
+            # The worker already has wakeups pending, or has shut down
+            pass
+
+    def finish(self):
+        """
+        Hands the application the in-order segments still held in the receive window, followed by the end of
+        stream marker, once the subsystem has closed. Waits for the application to make room unless stopped.
+        """
+        while not self.stop_event.is_set():
+            segment = self.recv_window.get(self.local_read_offset)
+
+            try:
+                self.data_out.put(segment, timeout=StreamWorker.ATTACH_POLL_PERIOD)
+            except queue.Full:
+                continue
+
+            if segment is None:
+                return
+
+            del self.recv_window[self.local_read_offset]
+            self.local_read_offset += 1
 
     def run(self) -> None:
+        selector = selectors.DefaultSelector()
+        selector.register(self.wakeup_recv, selectors.EVENT_READ)
+        subsystem_fd = None
+
         try:
             while not self.stop_event.is_set():
                 try:
                     self.try_restore_backoff()
-                    self.try_receive()
+                    self.deliver()
+                    more = self.try_receive()
                     self.try_transmit()
-                except ConnectionResetError:
+                except (ConnectionResetError, SubsystemClosedException):
+                    self.finish()
                     break
+
+                if subsystem_fd is None:
+                    subsystem_fd = self.subsystem.fileno()
+
+                    if subsystem_fd is not None:
+                        selector.register(subsystem_fd, selectors.EVENT_READ)
+
+                timeout = 0 if more else self.next_timeout()
+
+                if subsystem_fd is None:
+                    timeout = StreamWorker.ATTACH_POLL_PERIOD if timeout is None else min(timeout, StreamWorker.ATTACH_POLL_PERIOD)
+
+                # Sleep until the socket is readable, the application queued data or a timer expires
+                selector.select(timeout)
+
+                try:
+                    while self.wakeup_recv.recv(4096):
+                        pass
+                except BlockingIOError:
+                    pass
         except BrokenPipeError:
             self.data_out.put(None)
+        finally:
+            selector.close()
+            self.wakeup_recv.close()
+            self.wakeup_send.close()
+            self.stop_notify()
 
 
 class StreamForwarder:
-    def __init__(self, src: Subsystem, dest: Subsystem, *, mutator: PacketMutator = None):
+    # Most packets forwarded per poll, so one busy source does not starve the others sharing a bridge
+    MAX_FORWARD = StreamEngine.MAX_RECV
+
+    # Bytes which may wait to be sent to dest before src is no longer read, so a slow destination holds back its
+    # source rather than its queue growing without bound
+    MAX_UNSENT = 256 * 1024
+
+    def __init__(self, src: Subsystem, dest: Subsystem, *, mutator: PacketMutator = None,
+                 impairment: Optional[Impairment] = None):
         self.src = src
         self.dest = dest
         self.recv_buffer = b''
-        self.forward_filter = NoOpPacketMutator if mutator is None else mutator
+        self.forward_filter = NoOpPacketMutator() if mutator is None else mutator
+        self.impairment = impairment
+
+        # Set by poll when it stopped at MAX_FORWARD with packets possibly still waiting
+        self.more = False
+
+        # Packets the impairment holds back, with the time each is due to be sent, for the bridge to send
+        self.deferred: List[Tuple[float, Packet]] = []
+
+        # When a packet was last received from src
+        self.last_forwarded = time.time()
 
     def write_raw(self, data: Packet):
         packet = self.forward_filter(data)
         if packet is None:
             return
 
-        self.dest.send(packet)
+        if self.impairment is None:
+            self.dest.send_nowait(packet)
+            return
+
+        now = time.time()
+
+        for departure in self.impairment.schedule(packet, now):
+            if departure <= now:
+                self.dest.send_nowait(packet)
+            else:
+                self.deferred.append((departure, packet))
+
+    def held_back(self) -> bool:
+        return self.dest.unsent_size() >= StreamForwarder.MAX_UNSENT
 
     def poll(self):
+        """
+        Forwards the packets ready on src without waiting for more, or sending to dest. Returns False once either
+        subsystem has closed.
+        """
+        self.more = False
+        forwarded = 0
+
         try:
-            packet = self.src.recv()
+            while forwarded < StreamForwarder.MAX_FORWARD and not self.held_back():
+                packets = self.src.recv_many(0)
+
+                if not packets:
+                    return not self.src.is_closed()
+
+                self.last_forwarded = time.time()
 
-            if packet is not None:
-                self.write_raw(packet)
+                for packet in packets:
+                    self.write_raw(packet)
+
+                forwarded += len(packets)
         except SubsystemClosedException:
             return False
 
+        self.more = True
+
         return True
 
 
 class SubsystemBridge(threading.Thread):
-    def __init__(self, sock_a: Subsystem, sock_b: Subsystem,
+    """
+    Forwards packets in both directions between any number of pairs of subsystems from one thread, sleeping
+    until a subsystem is readable rather than polling. Packets ready on a subsystem are forwarded in batches of
+    up to StreamForwarder.MAX_FORWARD, so every pair is served in turn. Pairs may be added while the bridge
+    runs, and other files watched with a callback run on the bridge's thread when they become ready, such as a
+    listening socket accepting the subsystems of new pairs. Packets a pair's impairments hold back wait in a
+    heap ordered by the time they are due, so any number may be in flight without a thread or timer each.
+
+    The bridge never waits to send. Packets a subsystem cannot send at once stay queued on it until its socket
+    is writable, and while more than StreamForwarder.MAX_UNSENT wait, the other subsystem of the pair is not
+    read.
+
+    When either subsystem of a pair closes, both are closed, as they are once a pair given an idle timeout has
+    forwarded nothing for that long. The bridge stops once it has neither pairs nor watched files left, or when
+    stopped, closing the pairs which remain.
+    """
+    # How often pairs with an idle timeout are checked for having outlived it
+    IDLE_CHECK_PERIOD = 1
+
+    def __init__(self, sock_a: Optional[Subsystem] = None, sock_b: Optional[Subsystem] = None,
                  ab_filter: PacketMutator = None, ba_filter: PacketMutator = None):
 
         super().__init__()
 
-        self.ab = StreamForwarder(sock_a, sock_b, mutator=ab_filter)
-        self.ba = StreamForwarder(sock_b, sock_a, mutator=ba_filter)
         self.stop_event = threading.Event()
 
+        # Work queued from other threads, run by the bridge before it next waits
+        self.pending: Deque[Callable[[], None]] = deque()
+
+        # The pair each forwarder belongs to, indexed by forwarder and by its source subsystem
+        self.pairs: Dict[StreamForwarder, Tuple[StreamForwarder, StreamForwarder]] = {}
+        self.sources: Dict[Subsystem, StreamForwarder] = {}
+
+        # Descriptors registered for each forwarder, with the events they are registered for; a closed subsystem
+        # no longer reports its own
+        self.fds: Dict[StreamForwarder, int] = {}
+        self.events: Dict[StreamForwarder, int] = {}
+
+        # Forwarders whose source has no socket yet (IE awaiting a connection), polled every ATTACH_POLL_PERIOD
+        self.unattached: Set[StreamForwarder] = set()
+
+        # Forwarders to poll without waiting, as their source holds packets its socket does not show
+        self.ready: Set[StreamForwarder] = set()
+
+        # Forwarders whose source is not read until enough of what they queued on their destination is sent
+        self.held: Set[StreamForwarder] = set()
+        self.watchers = 0
+
+        # Idle timeouts of the pairs given one, and callbacks for pairs to run once removed
+        self.idle_timeouts: Dict[Tuple[StreamForwarder, StreamForwarder], float] = {}
+        self.on_removed: Dict[Tuple[StreamForwarder, StreamForwarder], Callable[[], None]] = {}
+        self.next_idle_check = 0.0
+
+        # Packets held back by impairments, as (departure, sequence, forwarder, packet); the sequence keeps
+        # packets due at the same time in the order they were held back
+        self.timers: List[Tuple[float, int, StreamForwarder, Packet]] = []
+        self.timer_sequence = itertools.count()
+
+        self.selector = selectors.DefaultSelector()
+        self.wakeup_recv, self.wakeup_send = socket.socketpair()
+        self.wakeup_recv.setblocking(False)
+        self.wakeup_send.setblocking(False)
+        self.selector.register(self.wakeup_recv, selectors.EVENT_READ)
+
+        if sock_a is not None and sock_b is not None:
+            self.add_pair(sock_a, sock_b, ab_filter, ba_filter)
+
     def stop(self):
         self.stop_event.set()
+        self.notify()
+
+    def notify(self):
+        try:
+            self.wakeup_send.send(b'\0')
+        except OSError:
+            # The bridge already has wakeups pending, or has shut down
+            pass
+
+    def call_soon(self, callback: Callable[[], None]):
+        self.pending.append(callback)
+        self.notify()
+
+    def add_pair(self, sock_a: Subsystem, sock_b: Subsystem, ab_filter: PacketMutator = None,
+                 ba_filter: PacketMutator = None, ab_impairment: Optional[Impairment] = None,
+                 ba_impairment: Optional[Impairment] = None, idle_timeout: Optional[float] = None,
+                 on_removed: Optional[Callable[[], None]] = None):
+        """
+        Forwards packets between sock_a and sock_b, passing those from sock_a through ab_filter and
+        ab_impairment, and those from sock_b through ba_filter and ba_impairment. The pair is removed once
+        neither subsystem has received a packet for idle_timeout, if given. on_removed is called on the bridge's
+        thread once the pair has been removed and its subsystems closed.
+        """
+        pair = (StreamForwarder(sock_a, sock_b, mutator=ab_filter, impairment=ab_impairment),
+                StreamForwarder(sock_b, sock_a, mutator=ba_filter, impairment=ba_impairment))
+
+        def add():
+            for forwarder in pair:
+                self.pairs[forwarder] = pair
+                self.sources[forwarder.src] = forwarder
+                self.attach(forwarder)
+
+                # Packets may have been received before the pair was added
+                self.ready.add(forwarder)
+
+            if idle_timeout is not None:
+                self.idle_timeouts[pair] = idle_timeout
+
+            if on_removed is not None:
+                self.on_removed[pair] = on_removed
+
+        self.call_soon(add)
+
+    def watch(self, fileobj, callback: Callable[[], None], events: int = selectors.EVENT_READ):
+        """
+        Calls callback on the bridge's thread whenever fileobj is ready for events, until it is unwatched or the
+        bridge stops.
+        """
+        def add():
+            self.selector.register(fileobj, events, callback)
+            self.watchers += 1
+
+        self.call_soon(add)
+
+    def unwatch(self, fileobj):
+        """
+        Stops watching fileobj. Called on the bridge's thread, such as by the watch callback itself.
+        """
+        self.selector.unregister(fileobj)
+        self.watchers -= 1
+
+    def forward_from(self, subsystem: Subsystem):
+        """
+        Has the bridge forward the packets subsystem holds, such as those a server received on its behalf,
+        though its socket may not be readable.
+        """
+        def add():
+            forwarder = self.sources.get(subsystem)
+
+            if forwarder is not None:
+                self.ready.add(forwarder)
+
+        self.call_soon(add)
+
+    def attach(self, forwarder: StreamForwarder):
+        fd = forwarder.src.fileno()
+
+        if fd is None:
+            self.unattached.add(forwarder)
+            return
+
+        self.unattached.discard(forwarder)
+        self.fds[forwarder] = fd
+        self.events[forwarder] = 0
+        self.update_events(forwarder)
+
+    def update_events(self, forwarder: StreamForwarder):
+        """
+        Registers the descriptor of forwarder's source to be read unless forwarder is held, and written to while
+        the other forwarder of the pair has packets queued on it.
+        """
+        fd = self.fds.get(forwarder)
+
+        if fd is None:
+            return
+
+        events = (0 if forwarder in self.held else selectors.EVENT_READ) | \
+                 (selectors.EVENT_WRITE if forwarder.src.unsent_size() else 0)
+        registered = self.events[forwarder]
+
+        if events == registered:
+            return
+
+        if not registered:
+            self.selector.register(fd, events, forwarder)
+        elif not events:
+            self.selector.unregister(fd)
+        else:
+            self.selector.modify(fd, events, forwarder)
+
+        self.events[forwarder] = events
+
+    def partner(self, forwarder: StreamForwarder) -> StreamForwarder:
+        a, b = self.pairs[forwarder]
+
+        return b if forwarder is a else a
+
+    def remove_pair(self, pair: Tuple[StreamForwarder, StreamForwarder]):
+        for forwarder in pair:
+            # Unregistered before the subsystem closes its socket, which would leave the descriptor unknown
+            fd = self.fds.pop(forwarder, None)
+
+            if fd is not None and self.events.pop(forwarder, 0):
+                self.selector.unregister(fd)
+
+            self.pairs.pop(forwarder, None)
+            self.sources.pop(forwarder.src, None)
+            self.unattached.discard(forwarder)
+            self.ready.discard(forwarder)
+            self.held.discard(forwarder)
+
+        self.idle_timeouts.pop(pair, None)
+        on_removed = self.on_removed.pop(pair, None)
+
+        for forwarder in pair:
+            forwarder.src.close()
+
+        if on_removed is not None:
+            on_removed()
+
+    def forward(self, forwarder: StreamForwarder):
+        # The pair may have been removed by its other forwarder since the source became readable
+        if forwarder not in self.pairs or forwarder in self.held:
+            return
+
+        alive = forwarder.poll()
+
+        for departure, packet in forwarder.deferred:
+            heapq.heappush(self.timers, (departure, next(self.timer_sequence), forwarder, packet))
+
+        forwarder.deferred.clear()
+
+        if not alive:
+            self.remove_pair(self.pairs[forwarder])
+            return
+
+        if forwarder.held_back():
+            self.held.add(forwarder)
+        elif forwarder.more:
+            self.ready.add(forwarder)
+
+        if forwarder in self.unattached:
+            self.attach(forwarder)
+
+        self.update_events(forwarder)
+        self.update_events(self.partner(forwarder))
+
+    def flush(self, forwarder: StreamForwarder):
+        """
+        Sends what the other forwarder of the pair queued on forwarder's source, which has become writable, and
+        releases the other forwarder once its queue is short enough.
+        """
+        if forwarder not in self.pairs:
+            return
+
+        sender = self.partner(forwarder)
+
+        try:
+            forwarder.src.flush()
+        except SubsystemClosedException:
+            self.remove_pair(self.pairs[forwarder])
+            return
+
+        if sender in self.held and not sender.held_back():
+            self.held.discard(sender)
+            self.ready.add(sender)
+            self.update_events(sender)
+
+        self.update_events(forwarder)
+
+    def send_due(self):
+        """
+        Sends the held back packets which have come due, unless their pair has since been removed.
+        """
+        now = time.time()
+
+        while self.timers and self.timers[0][0] <= now:
+            _, _, forwarder, packet = heapq.heappop(self.timers)
+
+            if forwarder not in self.pairs:
+                continue
+
+            try:
+                forwarder.dest.send_nowait(packet)
+            except SubsystemClosedException:
+                self.remove_pair(self.pairs[forwarder])
+                continue
+
+            if forwarder.held_back():
+                self.held.add(forwarder)
+                self.update_events(forwarder)
+
+            self.update_events(self.partner(forwarder))
+
+    def remove_idle(self):
+        now = time.time()
+
+        if now < self.next_idle_check:
+            return
+
+        self.next_idle_check = now + SubsystemBridge.IDLE_CHECK_PERIOD
+
+        for pair, idle_timeout in list(self.idle_timeouts.items()):
+            if now - max(forwarder.last_forwarded for forwarder in pair) >= idle_timeout:
+                self.remove_pair(pair)
+
+    def next_timeout(self) -> Optional[float]:
+        if self.ready:
+            return 0
+
+        timeout = StreamWorker.ATTACH_POLL_PERIOD if self.unattached else None
+
+        if self.timers:
+            due = max(0.0, self.timers[0][0] - time.time())
+            timeout = due if timeout is None else min(timeout, due)
+
+        if self.idle_timeouts:
+            due = max(0.0, self.next_idle_check - time.time())
+            timeout = due if timeout is None else min(timeout, due)
+
+        return timeout
 
     def run(self) -> None:
-        while self.ab.poll() and self.ba.poll():
-            time.sleep(0.001)
+        try:
+            while not self.stop_event.is_set():
+                while self.pending:
+                    self.pending.popleft()()
+
+                if not self.pairs and not self.watchers:
+                    break
+
+                # Packets come due ahead of those received since, which may be sent at once
+                self.send_due()
+                timeout = self.next_timeout()
+
+                # Sleep until a subsystem or watched file is ready, or work is queued
+                events = self.selector.select(timeout)
+
+                try:
+                    while self.wakeup_recv.recv(4096):
+                        pass
+                except BlockingIOError:
+                    pass
+
+                ready = set(self.unattached)
+
+                for key, mask in events:
+                    if isinstance(key.data, StreamForwarder):
+                        if mask & selectors.EVENT_WRITE:
+                            self.flush(key.data)
+
+                        if mask & selectors.EVENT_READ:
+                            ready.add(key.data)
+                    elif key.data is not None:
+                        key.data()
+
+                # Includes forwarders released by a flush
+                ready |= self.ready
+                self.ready = set()
+
+                self.send_due()
+                self.remove_idle()
+
+                for forwarder in ready:
+                    self.forward(forwarder)
+        finally:
+            for pair in set(self.pairs.values()):
+                self.remove_pair(pair)
+
+            self.selector.close()
+            self.wakeup_recv.close()
+            self.wakeup_send.close()
 
 
 class Stream(object):
+    # The receive buffer bounds the window advertised to remote, and so the window remote can grow to
+    RECV_BUFFER_SEGMENTS = 1024
 
-    def __init__(self, subsystem: Subsystem, *, recv_filter: Optional[PacketMutator] = None, transmit_filter: Optional[PacketMutator] = None):
+    def __init__(self, subsystem: Subsystem, *, recv_filter: Optional[PacketMutator] = None, transmit_filter: Optional[PacketMutator] = None,
+                 sack: bool = True, congestion_control: Optional[CongestionControl] = None,
+                 recv_buffer_segments: int = RECV_BUFFER_SEGMENTS, header_version: int = Packet.V2,
+                 ack_policy: Optional[AckPolicy] = None, segment_size: Optional[int] = None):
         self.data_in = queue.Queue(maxsize=10)
-        self.data_out = queue.Queue(maxsize=10)
+        self.data_out = queue.Queue(maxsize=recv_buffer_segments)
         self.stream_worker: Optional[StreamWorker] = None
         self.recv_filter = recv_filter
         self.transmit_filter = transmit_filter
         self.closed = False
-        self.max_packet_size = subsystem.get_dataseg_limit()
+        # Segments are sized so packets still fit within the subsystem's limit once transmit_filter has grown them
+        self.max_packet_size = fit_segment_size(subsystem.get_dataseg_limit(), transmit_filter) \
+            if segment_size is None else segment_size
+
+        # Remainder of a segment which did not fit in the buffer passed to readinto
+        self.leftover: Optional[memoryview] = None
+
+        # Number of segments queued by write; remote has them all once it acknowledges this offset
+        self.segments_written = 0
 
-        self.stream_worker = StreamWorker(
+        self.stream_worker = self.create_worker(
             subsystem,
-            self.data_in,
-            self.data_out,
             NoOpPacketMutator() if self.recv_filter is None else self.recv_filter,
-            NoOpPacketMutator() if self.transmit_filter is None else self.transmit_filter
+            NoOpPacketMutator() if self.transmit_filter is None else self.transmit_filter,
+            sack=sack,
+            congestion_control=congestion_control,
+            header_version=header_version,
+            ack_policy=ack_policy
         )
 
         self.stream_worker.start()
 
+    def create_worker(self, subsystem: Subsystem, recv_filter: PacketMutator, transmit_filter: PacketMutator,
+                      **kwargs) -> StreamWorker:
+        """
+        Creates the engine which drives the stream. It is started once created, and is expected to behave as a
+        StreamWorker towards the stream.
+        """
+        return StreamWorker(subsystem, self.data_in, self.data_out, recv_filter, transmit_filter, **kwargs)
+
     def get_preferred_segment_size(self):
         return self.max_packet_size
 
-    def write(self, data: bytes):
+    @property
+    def srtt(self) -> Optional[float]:
+        return self.stream_worker.rtt.srtt
+
+    @property
+    def rttvar(self) -> Optional[float]:
+        return self.stream_worker.rtt.rttvar
+
+    @property
+    def rto(self) -> float:
+        return self.stream_worker.rtt.rto
+
+    def write(self, data: Union[bytes, memoryview]):
+        """
+        Queues data for transmission, split into segments. Slicing a memoryview does not copy, so data passed as
+        one is transmitted from where it lies; it must not be modified until remote has acknowledged it. Raises
+        SubsystemClosedException if the stream stops while waiting for room.
+        """
         segments = math.ceil(len(data) / self.max_packet_size)
 
         for i in range(segments):
-            subset = data[i * self.max_packet_size : (i + 1) * self.max_packet_size]
-            self.data_in.put(subset)
+            subset = data if segments == 1 else data[i * self.max_packet_size : (i + 1) * self.max_packet_size]
+
+            while True:
+                try:
+                    self.data_in.put(subset, timeout=StreamWorker.ATTACH_POLL_PERIOD)
+                    break
+                except queue.Full:
+                    if not self.stream_worker.is_alive():
+                        raise SubsystemClosedException()
+
+            self.segments_written += 1
+            self.stream_worker.notify()
+
+    @property
+    def segments_acknowledged(self) -> int:
+        """
+        Number of segments written to the stream which remote has acknowledged.
+        """
+        return self.stream_worker.max_remote_read_offset
+
+    def drain(self, timeout=None) -> bool:
+        """
+        Waits until remote has acknowledged everything written to the stream. Returns False if timeout expired
+        or the stream stopped first.
+        """
+        worker = self.stream_worker
+
+        with worker.acked:
+            worker.acked.wait_for(lambda: self.segments_acknowledged >= self.segments_written or worker.stopped,
+                                  timeout)
+
+            return self.segments_acknowledged >= self.segments_written
+
+    def next_segment(self, block: bool, timeout=None) -> Optional[Union[bytes, memoryview]]:
+        if self.leftover is not None:
+            r = self.leftover
+            self.leftover = None
+            return r
+
+        r = self.data_out.get(block=block, timeout=timeout)
+
+        # Reading may have made room for segments held back in the receive window
+        if self.stream_worker.recv_window:
+            self.stream_worker.notify()
+
+        return r
+
+    def read_segments(self, max_bytes: int, timeout=None) -> List[Union[bytes, memoryview]]:
+        """
+        Returns the segments which are ready without copying them, waiting up to timeout for the first.
+        Stops collecting once max_bytes have been reached, so the last segment may take the total past it.
+        """
+        segments = []
+        size = 0
+
+        while size < max_bytes:
+            try:
+                r = self.next_segment(block=not segments, timeout=timeout)
+            except Empty:
+                break
+
+            if r is None:
+                self.closed = True
+                break
+
+            segments.append(r)
+            size += len(r)
+
+        return segments
 
     def read(self, min_read: int = 0, timeout=None) -> bytes:
-        buffer = b''
+        # Segments are collected and joined once, so each byte is copied a single time
+        segments = []
+        size = 0
 
         if min_read <= 0:
             while True:
                 try:
-                    r = self.data_out.get(block=False)
+                    r = self.next_segment(block=False)
 
                     if r is None:
                         self.closed = True
                         break
 
-                    buffer += r
+                    segments.append(r)
                 except Empty:
                     break
         else:
-            while len(buffer) < min_read:
+            while size < min_read:
                 try:
-                    r = self.data_out.get(timeout=timeout)
+                    r = self.next_segment(block=True, timeout=timeout)
 
                     if r is None:
                         self.closed = True
                         break
 
-                    buffer += r
+                    segments.append(r)
+                    size += len(r)
                 except Empty:
                     break
 
-        return buffer
+        return b''.join(segments)
+
+    def readinto(self, buf, min_read: int = 0, timeout=None) -> int:
+        """
+        Reads directly into a writable buffer, blocking until at least min_read bytes have been read.
+        Returns the number of bytes read. Data which does not fit is kept for the next read.
+        """
+        view = memoryview(buf).cast("B")
+        min_read = min(min_read, len(view))
+        filled = 0
+
+        while filled < len(view):
+            try:
+                r = self.next_segment(block=filled < min_read, timeout=timeout)
+            except Empty:
+                break
+
+            if r is None:
+                self.closed = True
+                break
+
+            r = memoryview(r)
+            n = min(len(r), len(view) - filled)
+            view[filled:filled + n] = r[:n]
+            filled += n
+
+            if n < len(r):
+                self.leftover = r[n:]
+
+        return filled
+
+    def segments(self, timeout=None) -> Iterator[Union[bytes, memoryview]]:
+        """
+        Yields received segments as they arrive, without concatenating them, until the stream is closed
+        or no segment arrives within timeout.
+        """
+        while True:
+            try:
+                r = self.next_segment(block=True, timeout=timeout)
+            except Empty:
+                return
+
+            if r is None:
+                self.closed = True
+                return
+
+            yield r
 
     def is_open(self):
         return not self.closed
@@ -331,3 +1306,19 @@ class Stream(object):
             self.stream_worker.join()
 
         self.closed = True
+
+    def abort(self):
+        """
+        Closes the stream without waiting for remote to acknowledge what was written, discarding the segments
+        which are queued or pending retransmission, so the buffers they are views of may be released.
+        """
+        self.close()
+
+        self.stream_worker.pending.clear()
+        self.stream_worker.transmit_times.clear()
+
+        try:
+            while True:
+                self.data_in.get_nowait()
+        except Empty:
+            pass
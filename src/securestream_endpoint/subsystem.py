@@ -1,39 +1,243 @@
-from dataclasses import dataclass
-from typing import Optional
+from typing import Optional, Union, List, Tuple
 import struct
 
+from .options import PacketOption, encode_options, encode_timestamp
+
+Buffer = Union[bytes, bytearray, memoryview]
+
+# Version 1 header; recv_window_size, read_offset, write_offset as native 32 bit integers
+HEADER_V1 = struct.Struct("=iii")
+OPTIONS_LENGTH_V1 = struct.Struct("=H")
+
+# Version 2 header; version, flags, a zero byte, marker, recv_window_size, read_offset, write_offset. The marker
+# occupies the most significant byte of the version 1 recv_window_size field, which a version 1 peer never sets,
+# so the two versions can be told apart from the first four bytes. Leading with the version also means a packet
+# never starts with a zero byte, which RsaCryptor would not preserve.
+HEADER_V2 = struct.Struct("<BBxBIqq")
+OPTIONS_LENGTH_V2 = struct.Struct("<H")
+HEADER_V2_MARKER = 0xFF
+
+# Follows the version 2 header, ahead of any options, when the packet belongs to a multiplexed channel
+CHANNEL_ID = struct.Struct("<I")
+
+# Length prefix the stream oriented transports place ahead of each packet
+FRAME_LENGTH = struct.Struct("=I")
+
 
-@dataclass(frozen=True)
 class Packet:
-    read_offset: int
-    write_offset: int
-    recv_window_size: int
-    data: bytes
+    __slots__ = ("read_offset", "write_offset", "recv_window_size", "data", "options", "version", "channel")
+
+    V1 = 1
+    V2 = 2
+
+    # Set in the version 1 recv_window_size field when an options block precedes the data. This is only
+    # used once remote has advertised support for options, so older peers never observe it.
+    OPTIONS_FLAG = 0x40000000
+
+    # Version 2 header flags
+    FLAG_OPTIONS = 0x1
+    FLAG_CHANNEL = 0x2
+
+    def __init__(self, read_offset: int, write_offset: int, recv_window_size: int, data: Buffer,
+                 options: Optional[Buffer] = None, version: int = V2, channel: Optional[int] = None):
+        self.read_offset = read_offset
+        self.write_offset = write_offset
+        self.recv_window_size = recv_window_size
+
+        # May be a memoryview over the buffer the packet was loaded from, rather than a copy of it
+        self.data = data
+        self.options = options
+        self.version = version
+
+        # Only the version 2 header carries a channel; None leaves the field out, which remote reads as channel 0
+        self.channel = channel
+
+    def __eq__(self, other) -> bool:
+        if not isinstance(other, Packet):
+            return NotImplemented
+
+        return all(getattr(self, k) == getattr(other, k) for k in Packet.__slots__)
+
+    # Packets compare by value but are mutated in flight (the multiplexer sets the channel), so they are not hashable
+    __hash__ = None
+
+    def __repr__(self) -> str:
+        return f"Packet(read_offset={self.read_offset}, write_offset={self.write_offset}, " \
+               f"recv_window_size={self.recv_window_size}, data=<{len(self.data)} bytes>, " \
+               f"options={None if self.options is None else bytes(self.options)!r}, version={self.version}, " \
+               f"channel={self.channel})"
+
+    @staticmethod
+    def load(data: Buffer) -> 'Packet':
+        """
+        Decodes a packet with either header version. Any buffer of at least a version 1 header decodes to a
+        packet which saves back to the same bytes, which the cryptors rely on to carry ciphertext.
+        """
+        view = memoryview(data).cast("B")
+
+        if len(view) >= HEADER_V2.size and view[3] == HEADER_V2_MARKER and view[2] == 0:
+            packet = Packet.load_v2(view)
+
+            if packet is not None:
+                return packet
+
+        return Packet.load_v1(view)
+
+    @staticmethod
+    def load_v1(view: memoryview) -> 'Packet':
+        recv_window_size, read_offset, write_offset = HEADER_V1.unpack_from(view)
+        payload = view[HEADER_V1.size:]
+        options = None
+
+        if recv_window_size & Packet.OPTIONS_FLAG and len(payload) >= OPTIONS_LENGTH_V1.size:
+            options_len = OPTIONS_LENGTH_V1.unpack_from(payload)[0]
+            options_end = OPTIONS_LENGTH_V1.size + options_len
+
+            if options_end <= len(payload):
+                recv_window_size &= ~Packet.OPTIONS_FLAG
+                options = payload[OPTIONS_LENGTH_V1.size:options_end]
+                payload = payload[options_end:]
+
+        return Packet(read_offset, write_offset, recv_window_size, payload, options, Packet.V1)
 
     @staticmethod
-    def load(data: bytes) -> 'Packet':
-        return Packet(
-            recv_window_size=struct.unpack("i", data[:4])[0],
-            read_offset=struct.unpack("i", data[4:8])[0],
-            write_offset=struct.unpack("i", data[8:12])[0],
-            data=data[12:]
-        )
+    def load_v2(view: memoryview) -> Optional['Packet']:
+        version, flags, _, recv_window_size, read_offset, write_offset = HEADER_V2.unpack_from(view)
+        payload = view[HEADER_V2.size:]
+        options = None
+
+        # Anything this codec could not save back unchanged is left to the version 1 decoder
+        if version != Packet.V2 or flags & ~(Packet.FLAG_OPTIONS | Packet.FLAG_CHANNEL):
+            return None
+
+        channel = None
+
+        if flags & Packet.FLAG_CHANNEL:
+            if len(payload) < CHANNEL_ID.size:
+                return None
+
+            channel = CHANNEL_ID.unpack_from(payload)[0]
+            payload = payload[CHANNEL_ID.size:]
+
+        if flags & Packet.FLAG_OPTIONS:
+            if len(payload) < OPTIONS_LENGTH_V2.size:
+                return None
+
+            options_end = OPTIONS_LENGTH_V2.size + OPTIONS_LENGTH_V2.unpack_from(payload)[0]
+
+            if options_end > len(payload):
+                return None
+
+            options = payload[OPTIONS_LENGTH_V2.size:options_end]
+            payload = payload[options_end:]
+
+        return Packet(read_offset, write_offset, recv_window_size, payload, options, Packet.V2, channel)
 
     @staticmethod
-    def ack(off: int, recv_window_size: int) -> 'Packet':
-        return Packet(
-            recv_window_size=recv_window_size,
-            read_offset=off,
-            write_offset=-1,
-            data=bytes()
-        )
-
-    def save(self) -> bytes:
-        return \
-            struct.pack("i", self.recv_window_size) + \
-            struct.pack("i", self.read_offset) + \
-            struct.pack("i", self.write_offset) + \
-            self.data
+    def ack(off: int, recv_window_size: int, options: Buffer = bytes(), version: int = V2) -> 'Packet':
+        # Acks carry no stream data, so their payload is used to transport packet options
+        return Packet(off, -1, recv_window_size, options, version=version)
+
+    def is_ack(self) -> bool:
+        return self.write_offset < 0
+
+    def get_options(self) -> Optional[Buffer]:
+        if self.options is None and self.is_ack():
+            return self.data
+
+        return self.options
+
+    def header_size(self) -> int:
+        size = HEADER_V2.size if self.version == Packet.V2 else HEADER_V1.size
+
+        if self.channel is not None and self.version == Packet.V2:
+            size += CHANNEL_ID.size
+
+        if self.options is not None:
+            size += OPTIONS_LENGTH_V2.size + len(self.options)
+
+        return size
+
+    def size(self) -> int:
+        return self.header_size() + len(self.data)
+
+    def save_into(self, buffer: Buffer, offset: int = 0) -> int:
+        """
+        Encodes the packet into a writable byte buffer at offset, which must have room for size() bytes.
+        Returns the offset following the packet.
+        """
+        offset = self.save_header_into(buffer, offset)
+        buffer[offset:offset + len(self.data)] = self.data
+
+        return offset + len(self.data)
+
+    def save_header_into(self, buffer: Buffer, offset: int = 0) -> int:
+        """
+        Encodes everything but the data, which must follow, into buffer at offset. Returns the offset following
+        the header and options.
+        """
+        if self.version == Packet.V2:
+            flags = 0 if self.options is None else Packet.FLAG_OPTIONS
+
+            if self.channel is not None:
+                flags |= Packet.FLAG_CHANNEL
+
+            HEADER_V2.pack_into(buffer, offset, Packet.V2, flags, HEADER_V2_MARKER,
+                                self.recv_window_size, self.read_offset, self.write_offset)
+            offset += HEADER_V2.size
+
+            if self.channel is not None:
+                CHANNEL_ID.pack_into(buffer, offset, self.channel)
+                offset += CHANNEL_ID.size
+
+            options_length = OPTIONS_LENGTH_V2
+        else:
+            recv_window_size = self.recv_window_size if self.options is None else self.recv_window_size | Packet.OPTIONS_FLAG
+            HEADER_V1.pack_into(buffer, offset, recv_window_size, self.read_offset, self.write_offset)
+            offset += HEADER_V1.size
+            options_length = OPTIONS_LENGTH_V1
+
+        if self.options is not None:
+            options_length.pack_into(buffer, offset, len(self.options))
+            offset += options_length.size
+            buffer[offset:offset + len(self.options)] = self.options
+            offset += len(self.options)
+
+        return offset
+
+    def save(self) -> bytearray:
+        buffer = bytearray(self.size())
+        self.save_into(buffer)
+
+        return buffer
+
+    def save_frame(self) -> bytearray:
+        """
+        Encodes the packet behind its FRAME_LENGTH prefix in a single buffer.
+        """
+        size = self.size()
+        buffer = bytearray(FRAME_LENGTH.size + size)
+        FRAME_LENGTH.pack_into(buffer, 0, size)
+        self.save_into(buffer, FRAME_LENGTH.size)
+
+        return buffer
+
+    def save_frame_parts(self) -> Tuple[bytearray, Buffer]:
+        """
+        Encodes the FRAME_LENGTH prefix, header and options, returning them with the data, which is not copied;
+        transmitting both with a gathering send saves copying large payloads into the frame.
+        """
+        header_size = self.header_size()
+        buffer = bytearray(FRAME_LENGTH.size + header_size)
+        FRAME_LENGTH.pack_into(buffer, 0, header_size + len(self.data))
+        self.save_header_into(buffer, FRAME_LENGTH.size)
+
+        return buffer, self.data
+
+
+# Header and options ahead of the data of a data packet; a timestamp is the only option data packets carry
+DATA_PACKET_OVERHEAD = Packet(0, 0, 0, b"",
+                              encode_options({PacketOption.TIMESTAMP: encode_timestamp(0, 0)})).header_size()
 
 
 class SubsystemClosedException(Exception):
@@ -41,10 +245,50 @@ class SubsystemClosedException(Exception):
 
 
 class Subsystem:
+    # How long recv waits for the underlying socket to become readable by default
+    RECV_TIMEOUT = 0.01
+
     def send(self, data: Packet):
         pass
 
-    def recv(self) -> Optional[Packet]:
+    def send_nowait(self, data: Packet):
+        """
+        Sends data without waiting for room in the socket's send buffer; whatever cannot be sent at once is
+        queued, in order, for flush. Subsystems whose send may wait should override this, along with flush
+        and unsent_size. By default data is sent as by send.
+        """
+        self.send(data)
+
+    def flush(self) -> bool:
+        """
+        Sends as much of what send_nowait queued as can be sent without waiting. Returns True once nothing
+        remains queued.
+        """
+        return True
+
+    def unsent_size(self) -> int:
+        """
+        Returns the number of bytes send_nowait queued which are yet to be sent.
+        """
+        return 0
+
+    def recv(self, timeout: float = RECV_TIMEOUT) -> Optional[Packet]:
+        pass
+
+    def recv_many(self, timeout: float = RECV_TIMEOUT) -> List[Packet]:
+        """
+        Returns every packet which can be received without waiting further, waiting up to timeout for
+        the first. Subsystems which can parse several packets per read should override this.
+        """
+        packet = self.recv(timeout)
+
+        return [] if packet is None else [packet]
+
+    def fileno(self) -> Optional[int]:
+        """
+        File descriptor which becomes readable when recv may return a packet, or None if the
+        subsystem is not yet attached to a socket.
+        """
         pass
 
     def get_dataseg_limit(self) -> int:
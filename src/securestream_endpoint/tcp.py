@@ -1,21 +1,45 @@
-import math
+import errno
+import itertools
+import os
 import select
 import socket
-import struct
 import sys
 import threading
 import time
 
-from typing import Optional
-from .subsystem import Subsystem, SubsystemClosedException, Packet
+from collections import deque
+from typing import Optional, List, Deque
+from .subsystem import Subsystem, SubsystemClosedException, Packet, FRAME_LENGTH
 
 
 class TcpSocketSubsystem(Subsystem):
+    # Size of the receive buffer; large enough to take many frames per recv_into. Frames larger than
+    # this grow the buffer.
+    RECV_BUFFER_SIZE = 256 * 1024
+
+    # How long send waits for room in the send buffer before checking whether the subsystem has closed
+    SEND_POLL_PERIOD = 0.1
+
+    # Most queued buffers gathered into one sendmsg
+    SEND_GATHER = 64
+
     def __init__(self, sock: socket.socket = None):
         self.sock: Optional[socket.socket] = None
-        self.recv_buffer = b''
         self.closed = False
 
+        # Received bytes occupy recv_buffer[recv_start:recv_end]; frames are parsed from recv_start and
+        # new data is read in at recv_end, so the buffer only needs compacting when it runs out of room
+        self.recv_buffer = bytearray(TcpSocketSubsystem.RECV_BUFFER_SIZE)
+        self.recv_start = 0
+        self.recv_end = 0
+
+        # Packets parsed by recv_many but not yet returned by recv
+        self.received: Deque[Packet] = deque()
+
+        # Frames yet to be written, as the buffers which remain of each, in order
+        self.unsent: Deque[memoryview] = deque()
+        self.unsent_bytes = 0
+
         if sock is not None:
             self.attach(sock)
 
@@ -26,53 +50,173 @@ class TcpSocketSubsystem(Subsystem):
         self.sock = sock
         self.sock.setblocking(False)
 
+        # Packets are already framed as segments; Nagle's algorithm would hold them back waiting for the
+        # acknowledgement of earlier ones, which stalls for the delayed ack timeout on both sides
+        self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
     def send(self, packet: Packet):
+        while self.sock is None and not self.is_closed():
+            time.sleep(0.1)
+
+        # Written after any frames send_nowait queued; the socket is non-blocking, so sendall cannot be used
+        self.send_nowait(packet)
+
+        while not self.flush():
+            self.wait_writable()
+
+    def send_nowait(self, packet: Packet):
+        if self.is_closed():
+            raise SubsystemClosedException()
+
+        # The data is gathered from where it lies, which for a file transmitted from a mapping is the page cache
+        header, data = packet.save_frame_parts()
+
+        for part in (memoryview(header), memoryview(data).cast("B")):
+            if part:
+                self.unsent.append(part)
+                self.unsent_bytes += len(part)
+
+        self.flush()
+
+    def flush(self) -> bool:
+        if self.sock is None:
+            return not self.unsent
+
         try:
-            while self.sock is None:
-                time.sleep(0.1)
+            while self.unsent:
+                try:
+                    sent = self.sock.sendmsg(list(itertools.islice(self.unsent, TcpSocketSubsystem.SEND_GATHER)))
+                except BlockingIOError:
+                    return False
 
-            if self.is_closed():
-                raise SubsystemClosedException()
+                self.unsent_bytes -= sent
 
-            packet_raw = packet.save()
-            packet_len = len(packet_raw)
-            transmit = struct.pack("I", packet_len) + packet_raw
+                while self.unsent and sent >= len(self.unsent[0]):
+                    sent -= len(self.unsent.popleft())
 
-            self.sock.sendall(transmit)
+                if sent:
+                    self.unsent[0] = self.unsent[0][sent:]
         except ConnectionError:
             self.close()
             raise SubsystemClosedException()
+        except OSError:
+            # Another thread closed the socket while the packet was being sent
+            if self.is_closed():
+                raise SubsystemClosedException()
+
+            raise
+
+        return True
+
+    def unsent_size(self) -> int:
+        return self.unsent_bytes
+
+    def wait_writable(self):
+        if self.is_closed():
+            raise SubsystemClosedException()
+
+        try:
+            select.select([], [self.sock], [], TcpSocketSubsystem.SEND_POLL_PERIOD)
+        except (ValueError, OSError):
+            # Another thread closed the socket while it was being waited on
+            raise SubsystemClosedException()
+
+    def recv(self, timeout: float = Subsystem.RECV_TIMEOUT) -> Optional[Packet]:
+        if not self.received:
+            self.received.extend(self.recv_many(timeout))
+
+        return self.received.popleft() if self.received else None
+
+    def recv_many(self, timeout: float = Subsystem.RECV_TIMEOUT) -> List[Packet]:
+        if self.received:
+            packets = list(self.received)
+            self.received.clear()
+            return packets
 
-    def recv(self) -> Optional[Packet]:
         if self.sock is None:
-            return None
+            return []
 
         if self.is_closed():
             raise SubsystemClosedException()
 
-        expected = math.inf
-        if len(self.recv_buffer) >= 4:
-            expected = 4 + struct.unpack("I", self.recv_buffer[:4])[0]
+        if timeout > 0:
+            select.select([self.sock], [], [], timeout)
+
+        self.make_room()
+
+        try:
+            received = self.sock.recv_into(memoryview(self.recv_buffer)[self.recv_end:])
+        except (BlockingIOError, InterruptedError):
+            received = None
+        except ConnectionError:
+            self.close()
+            raise SubsystemClosedException()
+
+        if received == 0:
+            # Remote closed the connection; deliver what was already received first
+            self.closed = True
+        elif received is not None:
+            self.recv_end += received
+
+        return self.parse_frames()
+
+    def parse_frames(self) -> List[Packet]:
+        packets = []
+        view = memoryview(self.recv_buffer)
+        offset = self.recv_start
 
-        ready = select.select([self.sock], [], [], 0.01)
+        while self.recv_end - offset >= FRAME_LENGTH.size:
+            expected = offset + FRAME_LENGTH.size + FRAME_LENGTH.unpack_from(view, offset)[0]
 
-        if ready[0]:
-            self.recv_buffer += self.sock.recv(4096)
+            if expected > self.recv_end:
+                break
 
-        if len(self.recv_buffer) >= expected:
-            data = self.recv_buffer[4:expected]
-            self.recv_buffer = self.recv_buffer[expected:]
-            packet = Packet.load(data)
-            return packet
-        else:
+            # Frames are copied out once, as the buffer is reused for later reads
+            packets.append(Packet.load(bytes(view[offset + FRAME_LENGTH.size:expected])))
+            offset = expected
+
+        self.recv_start = offset
+
+        if self.recv_start == self.recv_end:
+            self.recv_start = self.recv_end = 0
+
+        return packets
+
+    def make_room(self):
+        """
+        Moves a partially received frame to the front of the buffer once the space behind it runs low,
+        growing the buffer if the frame would not otherwise fit.
+        """
+        if len(self.recv_buffer) - self.recv_end >= len(self.recv_buffer) // 4:
+            return
+
+        pending = self.recv_end - self.recv_start
+        self.recv_buffer[:pending] = self.recv_buffer[self.recv_start:self.recv_end]
+        self.recv_start = 0
+        self.recv_end = pending
+
+        if pending >= FRAME_LENGTH.size:
+            expected = FRAME_LENGTH.size + FRAME_LENGTH.unpack_from(self.recv_buffer)[0]
+
+            if expected > len(self.recv_buffer):
+                self.recv_buffer.extend(bytes(expected - len(self.recv_buffer)))
+
+    def fileno(self) -> Optional[int]:
+        if self.sock is None or self.is_closed():
             return None
 
+        return self.sock.fileno()
+
     def get_dataseg_limit(self) -> int:
         return 1024 * 2
 
     def close(self):
         self.closed = True
 
+        # Releases the buffers of frames never written, which may lie in a mapping
+        self.unsent.clear()
+        self.unsent_bytes = 0
+
         if self.sock:
             self.sock.close()
 
@@ -84,9 +228,13 @@ class TcpClient:
     def __init__(self, host: str, port: int):
         super().__init__()
         self.connection_config = (host, port)
+        self.sock: Optional[socket.socket] = None
         self.subsystem: TcpSocketSubsystem = None
 
     def __enter__(self) -> Subsystem:
+        return self.connect()
+
+    def connect(self) -> TcpSocketSubsystem:
         sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         sock.connect(self.connection_config)
 
@@ -94,6 +242,33 @@ class TcpClient:
 
         return self.subsystem
 
+    def start_connect(self) -> socket.socket:
+        """
+        Begins connecting without waiting for the connection to be established. The returned socket becomes
+        writable once the attempt completes, when finish_connect returns the subsystem. The host must be an
+        address, as resolving a name would block.
+        """
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.sock.setblocking(False)
+        error = self.sock.connect_ex(self.connection_config)
+
+        if error not in (0, errno.EINPROGRESS):
+            self.sock.close()
+            raise OSError(error, os.strerror(error))
+
+        return self.sock
+
+    def finish_connect(self) -> TcpSocketSubsystem:
+        error = self.sock.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+
+        if error:
+            self.sock.close()
+            raise OSError(error, os.strerror(error))
+
+        self.subsystem = TcpSocketSubsystem(self.sock)
+
+        return self.subsystem
+
     def __exit__(self, exc_type, exc_val, exc_tb):
         if self.subsystem:
             self.subsystem.close()
@@ -110,7 +285,7 @@ class TcpServerSocketAttacher(threading.Thread):
             self.subsystem.attach(self.sock.accept()[0])
             self.sock.close()
         except Exception as e:
-            print(sys.stderr, f"Error attaching stream to remote socket {e}")
+            print(f"Error attaching stream to remote socket {e}", file=sys.stderr)
             pass
 
 
@@ -133,3 +308,40 @@ class TcpServerSingleRemote:
         self.subsystem.close()
         self.sock.close()
         self.attacher.join()
+
+
+class TcpServerMulti:
+    """
+    Keeps listening, giving every remote which connects a subsystem of its own. The listening socket does not
+    block, so the server can be watched by a selector along with the subsystems it accepted.
+    """
+    LISTEN_BACKLOG = 128
+
+    def __init__(self, port: int):
+        self.connection_config = ("0.0.0.0", port)
+        self.sock: Optional[socket.socket] = None
+
+    def __enter__(self) -> 'TcpServerMulti':
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.sock.bind(self.connection_config)
+        self.sock.listen(TcpServerMulti.LISTEN_BACKLOG)
+        self.sock.setblocking(False)
+
+        return self
+
+    def fileno(self) -> int:
+        return self.sock.fileno()
+
+    def accept(self) -> Optional[TcpSocketSubsystem]:
+        """
+        Returns a subsystem for the next remote waiting to be accepted, or None if there is none.
+        """
+        try:
+            sock, _ = self.sock.accept()
+        except (BlockingIOError, InterruptedError):
+            return None
+
+        return TcpSocketSubsystem(sock)
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.sock.close()
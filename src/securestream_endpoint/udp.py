@@ -1,16 +1,22 @@
 import math
 import select
 import socket
-import struct
 import sys
 import threading
 import time
 
-from typing import Optional
-from .subsystem import Subsystem, SubsystemClosedException, Packet
+from collections import deque
+from typing import Optional, List, Deque, Dict, Tuple
+from .subsystem import Subsystem, SubsystemClosedException, Packet, FRAME_LENGTH, HEADER_V1, DATA_PACKET_OVERHEAD
+
+# getsockopt option reporting the path MTU of a connected socket; defined by Linux but not exposed by Python
+IP_MTU = getattr(socket, "IP_MTU", 14 if sys.platform.startswith("linux") else None)
 
 
 class UdpSocketSubsystem(Subsystem):
+    # Most datagrams read from the socket per recv_many
+    RECV_BATCH = 64
+
     def __init__(self, host: Optional[str], port: int, sock: socket.socket):
         self.host = host
         self.port = port
@@ -20,39 +26,74 @@ class UdpSocketSubsystem(Subsystem):
 
     def send(self, packet: Packet):
         try:
-            while self.host is None:
+            while self.host is None and not self.is_closed():
                 time.sleep(0.1)
 
-            packet_raw = packet.save()
-            packet_len = len(packet_raw)
-            transmit = struct.pack("I", packet_len) + packet_raw
+            if self.is_closed():
+                raise SubsystemClosedException()
+
+            transmit = packet.save_frame()
 
             self.sock.sendto(transmit, (self.host, self.port))
         except ConnectionError:
             self.close()
             raise SubsystemClosedException()
+        except OSError:
+            # Another thread closed the socket while the packet was being sent
+            if self.is_closed():
+                raise SubsystemClosedException()
 
-    def recv(self) -> Optional[Packet]:
-        expected = math.inf
-        if len(self.recv_buffer) >= 4:
-            expected = 4 + struct.unpack("I", self.recv_buffer[:4])[0]
+            raise
 
-        ready = select.select([self.sock], [], [], 0.01)
+    def recv(self, timeout: float = Subsystem.RECV_TIMEOUT) -> Optional[Packet]:
+        ready = select.select([self.sock], [], [], timeout)
 
         if ready[0]:
             data, address = self.sock.recvfrom(4096)
             self.host, self.port = address
 
-            self.recv_buffer += data
+            self.datagram_received(data)
+
+        # The frame length is only known once its prefix has been received
+        expected = math.inf
+        if len(self.recv_buffer) >= FRAME_LENGTH.size:
+            expected = FRAME_LENGTH.size + FRAME_LENGTH.unpack_from(self.recv_buffer)[0]
 
         if len(self.recv_buffer) >= expected:
-            data = self.recv_buffer[4:expected]
+            # The packet references the frame in place; recv_buffer is immutable so it is never overwritten
+            data = memoryview(self.recv_buffer)[FRAME_LENGTH.size:expected]
             self.recv_buffer = self.recv_buffer[expected:]
             packet = Packet.load(data)
             return packet
         else:
             return None
 
+    def recv_many(self, timeout: float = Subsystem.RECV_TIMEOUT) -> List[Packet]:
+        packets = []
+        packet = self.recv(timeout)
+
+        while packet is not None:
+            packets.append(packet)
+
+            if len(packets) >= UdpSocketSubsystem.RECV_BATCH:
+                break
+
+            packet = self.recv(0)
+
+        return packets
+
+    def datagram_received(self, data: bytes):
+        """
+        Takes a datagram from remote, which may have been received on the subsystem's behalf by another socket.
+        """
+        self.recv_buffer += data
+
+    def fileno(self) -> Optional[int]:
+        if self.is_closed():
+            return None
+
+        return self.sock.fileno()
+
     def get_dataseg_limit(self) -> int:
         return 1024 * 2
 
@@ -64,15 +105,210 @@ class UdpSocketSubsystem(Subsystem):
         return self.closed
 
 
+def probe_mtu(host: str, port: int) -> Optional[int]:
+    """
+    Returns the MTU of the route to host, or None where the platform cannot report it.
+    """
+    if IP_MTU is None:
+        return None
+
+    try:
+        with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as probe:
+            probe.connect((host, port))
+            return probe.getsockopt(socket.IPPROTO_IP, IP_MTU)
+    except OSError:
+        return None
+
+
+class UdpDatagramSubsystem(UdpSocketSubsystem):
+    """
+    Carries each packet in a datagram of its own, without a FRAME_LENGTH prefix, so a lost datagram loses only
+    its own packet. Datagrams are drained from the socket in batches of up to RECV_BATCH into a preallocated
+    buffer, and sent with the header and data gathered from where they lie.
+
+    Segments are sized so each datagram fits within mtu. If mtu is not given, the MTU of the route to remote is
+    probed, up to MAX_PROBED_MTU, falling back to DEFAULT_MTU while remote is not yet known. Both ends must use
+    datagram framing.
+    """
+    DEFAULT_MTU = 1500
+
+    # Routes with larger MTUs, such as loopback, are treated as jumbo frame paths, so a lost datagram costs no
+    # more than it would on one
+    MAX_PROBED_MTU = 9000
+
+    # IP header by address family, and the UDP header, ahead of the packet in each datagram
+    IP_HEADER = {socket.AF_INET: 20, socket.AF_INET6: 40}
+    UDP_HEADER = 8
+
+    # Largest UDP payload; datagrams are received whole, whatever MTU remote sized them for
+    MAX_DATAGRAM = 65507
+
+    # Requested receive buffer size, so bursts of datagrams are not dropped between batches; capped by the kernel
+    SOCKET_RECV_BUFFER = 4 * 1024 * 1024
+
+    # How long send waits for room in the send buffer before checking whether the subsystem has closed
+    SEND_POLL_PERIOD = 0.1
+
+    def __init__(self, host: Optional[str], port: int, sock: socket.socket, mtu: Optional[int] = None):
+        super().__init__(host, port, sock)
+        self.mtu = mtu
+        self.recv_buffer = bytearray(UdpDatagramSubsystem.MAX_DATAGRAM)
+
+        # Packets received by recv_many but not yet returned by recv
+        self.received: Deque[Packet] = deque()
+
+        # Datagrams yet to be sent, each as the buffers gathered into it and its size
+        self.unsent: Deque[Tuple[List, int]] = deque()
+        self.unsent_bytes = 0
+
+        self.sock.setblocking(False)
+        self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, UdpDatagramSubsystem.SOCKET_RECV_BUFFER)
+
+    def send(self, packet: Packet):
+        while self.host is None and not self.is_closed():
+            time.sleep(0.1)
+
+        # A datagram is sent whole or not at all, after any send_nowait queued; wait for room when the send
+        # buffer is full
+        self.send_nowait(packet)
+
+        while not self.flush():
+            self.wait_writable()
+
+    def send_nowait(self, packet: Packet):
+        if self.is_closed():
+            raise SubsystemClosedException()
+
+        header = bytearray(packet.header_size())
+        packet.save_header_into(header)
+        data = memoryview(packet.data).cast("B")
+
+        self.unsent.append(([header, data], len(header) + len(data)))
+        self.unsent_bytes += len(header) + len(data)
+        self.flush()
+
+    def flush(self) -> bool:
+        if self.host is None:
+            return not self.unsent
+
+        try:
+            while self.unsent:
+                transmit, size = self.unsent[0]
+
+                try:
+                    self.sock.sendmsg(transmit, [], 0, (self.host, self.port))
+                except BlockingIOError:
+                    return False
+
+                self.unsent.popleft()
+                self.unsent_bytes -= size
+        except ConnectionError:
+            self.close()
+            raise SubsystemClosedException()
+        except OSError:
+            # Another thread closed the socket while the packet was being sent
+            if self.is_closed():
+                raise SubsystemClosedException()
+
+            raise
+
+        return True
+
+    def unsent_size(self) -> int:
+        return self.unsent_bytes
+
+    def close(self):
+        # Releases the buffers of datagrams never sent, which may lie in a mapping
+        self.unsent.clear()
+        self.unsent_bytes = 0
+
+        super().close()
+
+    def wait_writable(self):
+        if self.is_closed():
+            raise SubsystemClosedException()
+
+        try:
+            select.select([], [self.sock], [], UdpDatagramSubsystem.SEND_POLL_PERIOD)
+        except (ValueError, OSError):
+            # Another thread closed the socket while it was being waited on
+            raise SubsystemClosedException()
+
+    def recv(self, timeout: float = Subsystem.RECV_TIMEOUT) -> Optional[Packet]:
+        if not self.received:
+            self.received.extend(self.recv_many(timeout))
+
+        return self.received.popleft() if self.received else None
+
+    def recv_many(self, timeout: float = Subsystem.RECV_TIMEOUT) -> List[Packet]:
+        if self.received:
+            packets = list(self.received)
+            self.received.clear()
+            return packets
+
+        if self.is_closed():
+            raise SubsystemClosedException()
+
+        if timeout > 0:
+            select.select([self.sock], [], [], timeout)
+
+        view = memoryview(self.recv_buffer)
+
+        for _ in range(UdpDatagramSubsystem.RECV_BATCH):
+            try:
+                size, _, _, address = self.sock.recvmsg_into([self.recv_buffer])
+            except (BlockingIOError, InterruptedError):
+                break
+            except ConnectionError:
+                self.close()
+                raise SubsystemClosedException()
+
+            self.host, self.port = address[:2]
+            self.datagram_received(view[:size])
+
+        packets = list(self.received)
+        self.received.clear()
+
+        return packets
+
+    def datagram_received(self, data: bytes):
+        # The empty datagram a client announces itself with carries no packet
+        if len(data) < HEADER_V1.size:
+            return
+
+        # Copied out once, as the buffer is reused for the next datagram
+        self.received.append(Packet.load(bytes(data)))
+
+    def get_dataseg_limit(self) -> int:
+        if self.mtu is None and self.host is not None:
+            probed = probe_mtu(self.host, self.port)
+            self.mtu = None if probed is None else min(probed, UdpDatagramSubsystem.MAX_PROBED_MTU)
+
+        mtu = UdpDatagramSubsystem.DEFAULT_MTU if self.mtu is None else self.mtu
+        headers = UdpDatagramSubsystem.IP_HEADER[self.sock.family] + UdpDatagramSubsystem.UDP_HEADER
+        datagram = min(mtu - headers, UdpDatagramSubsystem.MAX_DATAGRAM)
+
+        return datagram - DATA_PACKET_OVERHEAD
+
+
 class UdpClient:
-    def __init__(self, host: str, port: int):
+    def __init__(self, host: str, port: int, datagram: bool = False, mtu: Optional[int] = None):
         super().__init__()
         self.host = host
         self.port = port
+        self.datagram = datagram
+        self.mtu = mtu
 
     def __enter__(self) -> Subsystem:
+        return self.connect()
+
+    def connect(self) -> UdpSocketSubsystem:
         self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
         self.sock.sendto(b'', (self.host, self.port))
+
+        if self.datagram:
+            return UdpDatagramSubsystem(self.host, self.port, self.sock, self.mtu)
+
         return UdpSocketSubsystem(self.host, self.port, self.sock)
 
     def __exit__(self, exc_type, exc_val, exc_tb):
@@ -80,17 +316,143 @@ class UdpClient:
 
 
 class UdpServerSingleRemote:
-    def __init__(self, port: int):
+    def __init__(self, port: int, datagram: bool = False, mtu: Optional[int] = None):
         super().__init__()
         self.port = port
+        self.datagram = datagram
+        self.mtu = mtu
 
     def __enter__(self) -> UdpSocketSubsystem:
         self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
         self.sock.bind(("0.0.0.0", self.port))
-        self.subsystem = UdpSocketSubsystem(None, self.port, self.sock)
+
+        if self.datagram:
+            self.subsystem = UdpDatagramSubsystem(None, self.port, self.sock, self.mtu)
+        else:
+            self.subsystem = UdpSocketSubsystem(None, self.port, self.sock)
 
         return self.subsystem
 
     def __exit__(self, exc_type, exc_val, exc_tb):
         self.subsystem.close()
         self.sock.close()
+
+
+class UdpServerMulti:
+    """
+    Keeps listening, giving every remote a subsystem of its own, told apart by source address. Each subsystem
+    has a socket of its own, bound to the server's port and connected to its remote, to which the kernel
+    delivers the remote's datagrams in preference to the listening socket. Datagrams which reach the listening
+    socket first are passed on to the subsystem of the remote which sent them.
+    """
+
+    def __init__(self, port: int, datagram: bool = False, mtu: Optional[int] = None):
+        self.port = port
+        self.datagram = datagram
+        self.mtu = mtu
+        self.sock: Optional[socket.socket] = None
+        self.subsystems: Dict[Tuple[str, int], UdpSocketSubsystem] = {}
+
+    def bind(self) -> socket.socket:
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+
+        # The listening socket and those connected to each remote share the port
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        sock.bind(("0.0.0.0", self.port))
+
+        return sock
+
+    def __enter__(self) -> 'UdpServerMulti':
+        self.sock = self.bind()
+        self.sock.setblocking(False)
+
+        return self
+
+    def fileno(self) -> int:
+        return self.sock.fileno()
+
+    def accept(self) -> Tuple[List[UdpSocketSubsystem], List[UdpSocketSubsystem]]:
+        """
+        Reads the datagrams waiting on the listening socket without blocking. Returns the subsystems of remotes
+        heard from for the first time, and every subsystem which was passed datagrams; those have packets to
+        receive even if their own socket is not readable.
+        """
+        accepted = []
+        received = []
+
+        for _ in range(UdpSocketSubsystem.RECV_BATCH):
+            try:
+                data, address = self.sock.recvfrom(UdpDatagramSubsystem.MAX_DATAGRAM)
+            except (BlockingIOError, InterruptedError):
+                break
+            except ConnectionError:
+                continue
+
+            self.dispatch(data, address, accepted, received)
+
+        return accepted, received
+
+    def dispatch(self, data: bytes, address: Tuple[str, int], accepted: List[UdpSocketSubsystem],
+                 received: List[UdpSocketSubsystem]):
+        subsystem = self.subsystems.get(address)
+        new = subsystem is None or subsystem.is_closed()
+
+        if new:
+            subsystem = self.connect(address)
+            accepted.append(subsystem)
+
+        subsystem.datagram_received(data)
+
+        if subsystem not in received:
+            received.append(subsystem)
+
+        if new:
+            self.redirect(subsystem, address, accepted, received)
+
+    def connect(self, address: Tuple[str, int]) -> UdpSocketSubsystem:
+        sock = self.bind()
+        sock.connect(address)
+        host, port = address[:2]
+
+        if self.datagram:
+            subsystem = UdpDatagramSubsystem(host, port, sock, self.mtu)
+        else:
+            subsystem = UdpSocketSubsystem(host, port, sock)
+
+        self.subsystems[address] = subsystem
+
+        return subsystem
+
+    def redirect(self, subsystem: UdpSocketSubsystem, address: Tuple[str, int],
+                 accepted: List[UdpSocketSubsystem], received: List[UdpSocketSubsystem]):
+        """
+        Until it was connected, a remote's socket shared the port unconnected, and may have been given other
+        remotes' datagrams; those are passed on to the subsystems they belong to.
+        """
+        while True:
+            try:
+                data, sender = subsystem.sock.recvfrom(UdpDatagramSubsystem.MAX_DATAGRAM, socket.MSG_DONTWAIT)
+            except (BlockingIOError, InterruptedError):
+                return
+            except ConnectionError:
+                continue
+
+            if sender == address:
+                subsystem.datagram_received(data)
+            else:
+                self.dispatch(data, sender, accepted, received)
+
+    def forget(self, subsystem: UdpSocketSubsystem):
+        """
+        Drops a remote's subsystem once it is no longer used, so datagrams the remote sends later begin anew.
+        """
+        address = (subsystem.host, subsystem.port)
+
+        if self.subsystems.get(address) is subsystem:
+            del self.subsystems[address]
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.sock.close()
+
+        for subsystem in self.subsystems.values():
+            subsystem.close()
@@ -0,0 +1,122 @@
+from bisect import bisect_left, bisect_right
+from collections import deque
+from typing import List, Tuple, Optional, Deque
+
+
+class RangeSet:
+    """
+    A set of integer offsets stored as sorted, disjoint [start, end) ranges, so that its cost grows with the
+    number of ranges rather than the number of offsets. Ranges are found by bisection in O(log n); adding a
+    range or discarding everything below an offset also moves the list entries after it, which is O(n) in the
+    number of ranges, although that is a fast memory move for the few ranges loss normally leaves.
+    """
+
+    def __init__(self):
+        self.starts: List[int] = []
+        self.ends: List[int] = []
+        self.count = 0
+
+    def add(self, start: int, end: int):
+        if start >= end:
+            return
+
+        # Ranges which overlap or touch [start, end) are merged into it
+        i = bisect_left(self.ends, start)
+        j = bisect_right(self.starts, end)
+
+        if i < j:
+            start = min(start, self.starts[i])
+            end = max(end, self.ends[j - 1])
+            self.count -= sum(self.ends[k] - self.starts[k] for k in range(i, j))
+
+        self.starts[i:j] = [start]
+        self.ends[i:j] = [end]
+        self.count += end - start
+
+    def discard_below(self, offset: int):
+        i = bisect_right(self.ends, offset)
+
+        if i > 0:
+            self.count -= sum(self.ends[k] - self.starts[k] for k in range(i))
+            del self.starts[:i]
+            del self.ends[:i]
+
+        if self.starts and self.starts[0] < offset:
+            self.count -= offset - self.starts[0]
+            self.starts[0] = offset
+
+    def ranges(self) -> List[Tuple[int, int]]:
+        return list(zip(self.starts, self.ends))
+
+    def highest(self) -> Optional[int]:
+        return self.ends[-1] - 1 if self.ends else None
+
+    def nth_highest(self, n: int) -> Optional[int]:
+        """
+        Returns the n-th highest offset in the set, counting from 1, or None if it holds fewer than n.
+        """
+        for k in range(len(self.ends) - 1, -1, -1):
+            size = self.ends[k] - self.starts[k]
+
+            if n <= size:
+                return self.ends[k] - n
+
+            n -= size
+
+        return None
+
+    def next_absent(self, offset: int) -> int:
+        """
+        Returns the lowest offset at or above 'offset' which is not in the set.
+        """
+        i = bisect_right(self.starts, offset) - 1
+        return self.ends[i] if i >= 0 and offset < self.ends[i] else offset
+
+    def count_between(self, start: int, end: int) -> int:
+        """
+        Returns the number of offsets in [start, end) which are in the set.
+        """
+        if start >= end:
+            return 0
+
+        count = 0
+
+        for k in range(bisect_right(self.ends, start), bisect_left(self.starts, end)):
+            count += min(self.ends[k], end) - max(self.starts[k], start)
+
+        return count
+
+    def __contains__(self, offset: int) -> bool:
+        i = bisect_right(self.starts, offset) - 1
+        return i >= 0 and offset < self.ends[i]
+
+    def __len__(self) -> int:
+        return self.count
+
+
+class WindowEstimator:
+    """
+    Running average of the most recent receive window sizes advertised by remote.
+    """
+
+    def __init__(self, samples: int):
+        self.samples: Deque[int] = deque(maxlen=samples)
+        self.total = 0
+
+    def add(self, value: int):
+        if len(self.samples) == self.samples.maxlen:
+            self.total -= self.samples[0]
+
+        self.samples.append(value)
+        self.total += value
+
+    def reset(self, value: int):
+        self.samples.clear()
+        self.total = 0
+        self.add(value)
+
+    def estimate(self) -> Optional[int]:
+        if not self.samples:
+            return None
+
+        return self.total // len(self.samples)
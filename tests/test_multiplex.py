@@ -0,0 +1,110 @@
+import asyncio
+import socket
+import threading
+import time
+
+from securestream_endpoint.async_stream import AsyncStream
+from securestream_endpoint.async_tcp import AsyncTcpServerSingleRemote
+from securestream_endpoint.multiplex import MultiplexedStream, MultiplexWorker
+from securestream_endpoint.tcp import TcpClient, TcpServerSingleRemote
+
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def test_channel_close_ends_async_stream():
+    """
+    Closing channel 0 of a multiplexer ends the plain AsyncStream on the other end once it has read the data.
+    """
+    port = free_port()
+    data = bytes(range(256)) * 64
+
+    def client():
+        with TcpClient("127.0.0.1", port) as subsystem, MultiplexedStream(subsystem) as multiplexed:
+            channel = multiplexed.open_channel(0)
+            channel.write(data)
+            channel.close()
+
+            # The channel is removed once remote acknowledges its end
+            deadline = time.time() + 10
+
+            while multiplexed.worker.open_count() and time.time() < deadline:
+                time.sleep(0.01)
+
+            assert multiplexed.worker.open_count() == 0
+
+    async def main():
+        async with AsyncTcpServerSingleRemote(port) as subsystem:
+            async with AsyncStream(subsystem) as stream:
+                sender = asyncio.get_running_loop().run_in_executor(None, client)
+                received = await asyncio.wait_for(stream.read(len(data)), 10)
+
+                assert received == data
+                assert await asyncio.wait_for(stream.read(1), 10) == b''
+                assert stream.eof and not stream.is_open()
+
+                await asyncio.wait_for(sender, 10)
+
+    asyncio.run(main())
+
+
+def test_closed_channels_are_forgotten(monkeypatch):
+    """
+    Channels closed on both ends are dropped by both multiplexers, and the closed channels they remember age out.
+    """
+    monkeypatch.setattr(MultiplexWorker, "CLOSED_LINGER", 0.5)
+    port = free_port()
+
+    with TcpServerSingleRemote(port) as server_subsystem, TcpClient("127.0.0.1", port) as client_subsystem:
+        with MultiplexedStream(server_subsystem, initiator=False) as server, MultiplexedStream(client_subsystem) as client:
+            for _ in range(20):
+                channel = client.open_channel()
+                channel.write(b"request")
+                accepted = server.accept(timeout=10)
+
+                assert accepted.read(len(b"request"), timeout=10) == b"request"
+                accepted.close()
+                channel.close()
+
+            deadline = time.time() + 10
+
+            while (client.channels or server.channels) and time.time() < deadline:
+                time.sleep(0.01)
+
+            assert not client.channels and not server.channels
+
+            time.sleep(MultiplexWorker.CLOSED_LINGER)
+
+            # Opening another channel prompts the aged out ones to be forgotten
+            client.open_channel()
+
+            assert not client.worker.closed_channels
+
+
+def test_channel_limit_holds_under_concurrent_opens(monkeypatch):
+    monkeypatch.setattr(MultiplexWorker, "MAX_CHANNELS", 4)
+    port = free_port()
+    opened = []
+    refused = []
+
+    def open_channel(multiplexed: MultiplexedStream):
+        try:
+            opened.append(multiplexed.open_channel())
+        except ValueError:
+            refused.append(True)
+
+    with TcpServerSingleRemote(port) as server_subsystem, TcpClient("127.0.0.1", port) as client_subsystem:
+        with MultiplexedStream(server_subsystem, initiator=False), MultiplexedStream(client_subsystem) as client:
+            openers = [threading.Thread(target=open_channel, args=(client,)) for _ in range(16)]
+
+            for opener in openers:
+                opener.start()
+
+            for opener in openers:
+                opener.join()
+
+            assert len(opened) == 4 and len(refused) == 12
+            assert client.worker.open_count() == 4